@@ -0,0 +1,236 @@
+"""
+Asyncio Modbus TCP client that keeps several range reads in flight.
+
+Used for the modbus and sungrow connection types when pipeline_depth is set.
+Plain Modbus TCP responses are matched to requests by transaction ID. The
+Sungrow encrypted protocol replaces the transaction ID with a fixed header, so
+for it responses are matched in the order requests were sent.
+"""
+
+import asyncio
+import logging
+import struct
+import time
+from collections import OrderedDict
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Sungrow encryption handshake, see SungrowModbusTcpClient
+PRIV_KEY = b'Grow#0*2Sun68CbE'
+NO_CRYPTO1 = b'\x00' * 16
+NO_CRYPTO2 = b'\xff' * 16
+GET_KEY = b'\x68\x68\x00\x00\x00\x06\xf7\x04\x0a\xe7\x00\x08'
+HEADER = bytes([0x68, 0x68])
+
+FUNCTION_CODES = {"read": 0x04, "hold": 0x03}
+
+
+class ModbusException(Exception):
+    """ The inverter answered with a Modbus exception, the connection is still fine """
+
+
+class AsyncModbusTcpClient():
+
+    def __init__(self, host, port=502, timeout=10, retries=3, slave=1, encrypted=False, depth=4, **kwargs):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.slave = slave
+        self.encrypted = encrypted
+        self.depth = max(1, int(depth))
+        self.loop = asyncio.new_event_loop()
+        self.reader = None
+        self.writer = None
+        self.cipher = None
+        self.key_date = None
+        self.transaction_id = 0
+        self.pending = OrderedDict()    # transaction ID: future, in the order sent
+        self.round_trips = []           # Seconds from request sent to response, since getRoundTrips
+        self.exceptions = set()         # Blocks of the last read_blocks answered with a Modbus exception
+        self.receiver = None
+
+    def __str__(self):
+        return f"AsyncModbusTcpClient({self.host}:{self.port}, depth={self.depth}{', encrypted' if self.encrypted else ''})"
+
+    def connect(self):
+        return self.loop.run_until_complete(self._connect())
+
+    def close(self):
+        self.loop.run_until_complete(self._close())
+
+    def is_socket_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    def probe(self):
+        # Let the receiver handle anything sent while idle, a close ends the session, late replies are dropped
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return self.is_socket_open()
+
+    def read_blocks(self, blocks):
+        """
+        Read (register type, start, count) blocks, returns a list of words (or None
+        if that block failed) in the same order as blocks.
+        """
+        return self.loop.run_until_complete(self._read_blocks(blocks))
+
+    def getExceptions(self):
+        # (register type, start, count) blocks of the last read_blocks the inverter refused, the rest of the None blocks were lost
+        return self.exceptions
+
+    def getRoundTrips(self):
+        round_trips, self.round_trips = self.round_trips, []
+        return round_trips
+
+    async def _connect(self):
+        await self._close()
+        try:
+            if self.encrypted and (self.cipher is None or self.key_date != date.today()):
+                await self._getkey()
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except Exception as err:
+            logger.debug(f"{self}: connect failed {err}")
+            await self._close()
+            return False
+        self.receiver = self.loop.create_task(self._receive())
+        return True
+
+    async def _getkey(self):
+        # The inverter sends its public key on a fresh connection, then expects a reconnect
+        self.cipher = None
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            writer.write(GET_KEY)
+            key_packet = await asyncio.wait_for(reader.readexactly(25), self.timeout)
+        finally:
+            writer.close()
+        pub_key = key_packet[9:]
+        if len(pub_key) == 16 and pub_key != NO_CRYPTO1 and pub_key != NO_CRYPTO2:
+            from Cryptodome.Cipher import AES
+            self.cipher = AES.new(bytes(a ^ b for (a, b) in zip(pub_key, PRIV_KEY)), AES.MODE_ECB)
+        else:
+            self.encrypted = False
+        self.key_date = date.today()
+
+    async def _close(self):
+        if self.receiver:
+            self.receiver.cancel()
+            await asyncio.gather(self.receiver, return_exceptions=True)
+            self.receiver = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.reader = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
+        self.pending.clear()
+
+    async def _receive(self):
+        try:
+            while True:
+                if self.cipher:
+                    header = await self.reader.readexactly(4)
+                    packet_len = header[2]
+                    packet = self.cipher.decrypt(await self.reader.readexactly(packet_len + header[3]))[:packet_len]
+                else:
+                    mbap = await self.reader.readexactly(6)
+                    packet = mbap + await self.reader.readexactly(struct.unpack('>H', mbap[4:6])[0])
+                if self.cipher:
+                    # Encrypted responses carry no transaction ID, they arrive in the order sent
+                    if not self.pending:
+                        continue
+                    transaction_id, future = self.pending.popitem(last=False)
+                else:
+                    future = self.pending.pop(struct.unpack('>H', packet[0:2])[0], None)
+                if future and not future.done():
+                    future.set_result(packet[6:])
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.debug(f"{self}: receive failed {err}")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Receive failed {err}"))
+            self.pending.clear()
+            if self.writer:
+                self.writer.close()
+
+    async def _request(self, register_type, start, count):
+        if not self.is_socket_open():
+            raise ConnectionError("Not connected")
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        transaction_id = self.transaction_id
+        function_code = FUNCTION_CODES[register_type]
+        request = struct.pack('>HHHBBHH', transaction_id, 0, 6, self.slave, function_code, start, count)
+        future = self.loop.create_future()
+        self.pending[transaction_id] = future
+        if self.cipher:
+            padding = 16 - (len(request) % 16)
+            plain = HEADER + request[2:] + bytes([0xff] * padding)
+            self.writer.write(bytes([1, 0, len(request), padding]) + self.cipher.encrypt(plain))
+        else:
+            self.writer.write(request)
+        sent = time.perf_counter()
+        try:
+            pdu = await asyncio.wait_for(future, self.timeout)
+            self.round_trips.append(time.perf_counter() - sent)
+        except asyncio.TimeoutError:
+            if self.cipher and self.writer:
+                # Responses are matched by order, once one is lost the rest can not be trusted
+                self.writer.close()
+            raise
+        finally:
+            self.pending.pop(transaction_id, None)
+
+        # pdu is unit, function code, byte count then data
+        if pdu[1] == function_code | 0x80:
+            raise ModbusException(f"Modbus exception {pdu[2]} for {register_type}, {start}:{count}")
+        if pdu[1] != function_code or pdu[2] != count * 2 or len(pdu) < 3 + count * 2:
+            raise ConnectionError(f"Unexpected response for {register_type}, {start}:{count}")
+        return list(struct.unpack(f'>{count}H', pdu[3:3 + count * 2]))
+
+    async def _read_blocks(self, blocks):
+        results = [None] * len(blocks)
+        self.exceptions = set()
+        failed = await self._read_pipelined(blocks, range(len(blocks)), results, self.depth)
+
+        # Retry anything lost to timeouts or a dropped connection one request at a time
+        retries = 0
+        while failed and retries < self.retries:
+            retries += 1
+            if not self.is_socket_open():
+                await self._connect()
+            recovered = len(failed)
+            failed = await self._read_pipelined(blocks, failed, results, 1)
+            recovered -= len(failed)
+            if recovered and self.depth > 1:
+                logger.warning(f"{self}: {recovered} reads only succeeded one at a time, falling back to strict serial mode")
+                self.depth = 1
+        return results
+
+    async def _read_pipelined(self, blocks, indexes, results, depth):
+        # Returns the indexes that failed for connection reasons, Modbus exceptions are not retried
+        in_flight = asyncio.Semaphore(depth)
+        failed = []
+
+        async def read(index):
+            async with in_flight:
+                register_type, start, count = blocks[index]
+                try:
+                    results[index] = await self._request(register_type, start, count)
+                except ModbusException as err:
+                    logger.warning(f"No data returned for {register_type}, {start}:{count}")
+                    self.exceptions.add(blocks[index])
+                    logger.debug(f"{err}")
+                except Exception as err:
+                    logger.debug(f"{self}: {register_type}, {start}:{count} failed {err!r}")
+                    failed.append(index)
+
+        await asyncio.gather(*(read(index) for index in indexes))
+        if failed and self.is_socket_open():
+            # Responses may still be on their way for the failed requests, start afresh
+            await self._close()
+        return sorted(failed)
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+"""
+Offline benchmark suite, no inverter and no network.
+
+For each model and level it times register configuration, block decode,
+derived registers and the payload each export builds, then compares the
+timings against a stored baseline. Decoded values are checked against the
+values stored with the baseline, so a faster change that decodes differently
+is caught too.
+
+Run from the SunGather folder:
+  python3 benchmarks/bench.py                 compare against benchmarks/baseline.json
+  python3 benchmarks/bench.py --save          store a new baseline and expected values
+  python3 benchmarks/bench.py -m SH10RT -l 3  just the one case
+Exits 1 when decoded values changed or a stage is slower than the tolerance,
+by more microseconds than the noise floor, in the best of --repeat runs.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from offline import OfflineClient, SUNGATHER_FOLDER, capture_blocks, offline_config, offline_inverter, parse_registersfile
+
+from inverter import SungrowInverter
+from payload import PayloadEncoder
+from registercache import RegisterCache
+from prometheus import PrometheusRenderer
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MODELS = ('SH10RT', 'SH5K-20', 'SG10KTL-MT')
+LEVELS = (1, 2, 3)
+
+
+def measure(stages, batches=10):
+    # stages is {name: (stage, calls, setup)}, microseconds per call of each, the fastest of several
+    # short batches. A batch of every stage is timed in turn, so each is sampled across the whole case
+    # and a moment of other load on the box does not count. setup runs before each call, outside the timing
+    best = {}
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(batches):
+            for name, (stage, calls, setup) in stages.items():
+                batch = max(1, calls // batches)
+                elapsed = 0.0
+                for _ in range(batch):
+                    argument = setup() if setup else None
+                    start = time.perf_counter()
+                    stage(argument) if setup else stage()
+                    elapsed += time.perf_counter() - start
+                best[name] = min(best.get(name, elapsed / batch), elapsed / batch)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {name: round(elapsed * 1000000, 1) for name, elapsed in best.items()}
+
+
+def calibration_stage():
+    # A fixed pure Python workload, baselines are scaled by how fast it runs now so a
+    # slower or throttled machine does not look like a regression
+    words = list(range(200))
+    return lambda: json.dumps({str(word): word * 0.1 for word in words})
+
+
+def export_stages(inverter):
+    # Payload building of each export, exports whose packages are not installed are skipped
+    stages = {}
+    encoder = PayloadEncoder(inverter.inverter_config | inverter.client_config)
+    stages['mqtt_json'] = lambda: encoder.encode(inverter.latest_scrape)
+    binary = PayloadEncoder(inverter.inverter_config | inverter.client_config, 'msgpack')
+    if binary.format == 'msgpack':
+        stages['mqtt_msgpack'] = lambda: binary.encode(inverter.latest_scrape)
+
+    try:
+        from exports.influxdb import export_influxdb
+        influxdb = export_influxdb()
+        measurements = [{'point': inverter.getRegisterUnit(register) or 'value', 'register': register}
+                        for register, value in inverter.latest_scrape.items() if isinstance(value, (int, float)) and inverter.validateRegister(register)]
+        influxdb.configure({'token': 'offline', 'org': 'offline', 'bucket': 'offline', 'flush_interval': 86400, 'batch_size': 1000000,
+                            'buffer_file': os.path.join(tempfile.gettempdir(), 'sungather-bench.lp'), 'measurements': measurements}, inverter)
+
+        def influxdb_lines():
+            influxdb.publish(inverter)
+            influxdb.pending = []
+        stages['influxdb'] = influxdb_lines
+    except ImportError as err:
+        logging.warning(f"Benchmark: influxdb skipped, {err}")
+
+    from exports.webserver import export_webserver
+    webserver = export_webserver()
+    webserver.configure_inverter(inverter)
+    stages['webserver'] = lambda: webserver.publish(inverter)
+
+    renderer = PrometheusRenderer()
+    renderer.addInverter(inverter)
+    stages['prometheus'] = lambda: renderer.render({inverter.getName(): inverter.latest_scrape}, {inverter.getName(): inverter.getScrapeTime()})
+    return stages
+
+
+def run_case(model, level, parsed, rounds):
+    registersfile = RegisterCache(registersfile=parsed)
+    inverter = offline_inverter(model, level, registersfile)
+    blocks = capture_blocks(inverter)
+    stages = {'calibration': (calibration_stage(), rounds, None)}
+
+    def configure(registers):
+        configured = SungrowInverter(offline_config(model, level))
+        configured.configure_registers(registers)
+    # Catalog and view compiled from the parsed file, then the shared view every later inverter gets
+    stages['configure'] = (configure, max(5, rounds // 10), lambda: RegisterCache(registersfile=parsed))
+    stages['configure_cached'] = (configure, max(5, rounds // 10), lambda: registersfile)
+
+    def decode():
+        for register_type, start, count, words in blocks:
+            inverter.decode_registers(register_type, start, count, words)
+    decode()
+    decoded = dict(inverter.latest_scrape)
+    stages['decode'] = (decode, rounds, None)
+
+    def derive(scrape):
+        inverter.latest_scrape = scrape
+        inverter.derive_registers()
+    # Each turn derives from the decoded values again, the exports after it publish the full scrape
+    stages['derive'] = (derive, rounds, lambda: dict(decoded))
+    derive(dict(decoded))
+    values = json.loads(json.dumps(inverter.latest_scrape))
+
+    for name, stage in export_stages(inverter).items():
+        stages[name] = (stage, rounds, None)
+    timings = measure(stages)
+    calibration = timings.pop('calibration')
+    return {'registers': len(inverter.latest_scrape), 'ranges': len(blocks), 'calibration': calibration, 'timings': timings}, values
+
+
+def load_json(filename):
+    try:
+        with open(filename, encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+
+
+def compare_values(expected, values):
+    changed = [register for register in expected.keys() | values.keys() if expected.get(register) != values.get(register)]
+    return sorted(changed)
+
+
+def slower_stages(result, previous_case, scale, args):
+    # Stages past both the tolerance and the noise floor, a few us on the smallest stages is only timer noise
+    slower = []
+    for stage, timing in result['timings'].items():
+        previous = previous_case.get('timings', {}).get(stage)
+        if previous:
+            previous = round(previous * scale, 1)
+            if timing / previous - 1 > args.tolerance and timing - previous > args.min_us:
+                slower.append(stage)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline SunGather benchmarks")
+    parser.add_argument('-m', dest='models', action='append', help=f"Model, can be repeated. Default {', '.join(MODELS)}")
+    parser.add_argument('-l', dest='levels', action='append', type=int, help="Level, can be repeated. Default 1, 2 and 3")
+    parser.add_argument('-n', dest='rounds', type=int, default=200, help="Calls per timing, default 200")
+    parser.add_argument('-r', dest='registers', default=os.path.join(SUNGATHER_FOLDER, 'registers-sungrow.yaml'), help="Registers file")
+    parser.add_argument('--baseline', default=os.path.join(BENCHMARK_FOLDER, 'baseline.json'))
+    parser.add_argument('--expected', default=os.path.join(BENCHMARK_FOLDER, 'expected.json'))
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Slower than baseline by more than this is a regression, default 0.25")
+    parser.add_argument('--min-us', dest='min_us', type=float, default=20, help="Noise floor, a stage has to be this many us slower as well to be a regression, default 20")
+    parser.add_argument('--repeat', type=int, default=5, help="Cases that look slower are run again, the best of this many runs counts, default 5")
+    parser.add_argument('--save', action='store_true', help="Store the results as the new baseline and expected values")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, format='%(levelname)-8s %(message)s')
+
+    parsed = parse_registersfile(args.registers)
+    baseline = load_json(args.baseline) or {}
+    expected = load_json(args.expected) or {}
+    results, values, cases, failed = {}, {}, {}, False
+    print(f"SunGather offline benchmarks, python {platform.python_version()} on {platform.machine()}")
+    if baseline.get('machine'):
+        print(f"Baseline from python {baseline.get('python')} on {baseline.get('machine')}, tolerance {round(args.tolerance * 100)}% and {args.min_us} us")
+
+    for model in args.models or MODELS:
+        for level in args.levels or LEVELS:
+            case = f"{model} level {level}"
+            cases[case] = (model, level)
+            results[case], values[case] = run_case(model, level, parsed, args.rounds)
+
+    def scale(case):
+        # Baseline timings scaled to the speed of this machine right now
+        previous_case = baseline.get('results', {}).get(case, {})
+        return results[case]['calibration'] / previous_case['calibration'] if previous_case.get('calibration') else 1
+
+    for _ in range(max(1, args.repeat) - 1):
+        # A new baseline is the best of every run, otherwise only cases that look slower are run again
+        slower = list(cases) if args.save else \
+            [case for case in cases if slower_stages(results[case], baseline.get('results', {}).get(case, {}), scale(case), args)]
+        if not slower:
+            break
+        # The fastest of the runs counts for the stages and the calibration alike, so a burst of load on the box is not a regression
+        for case in slower:
+            again, _ = run_case(*cases[case], parsed, args.rounds)
+            results[case]['timings'] = {stage: min(timing, again['timings'].get(stage, timing)) for stage, timing in results[case]['timings'].items()}
+            results[case]['calibration'] = min(results[case]['calibration'], again['calibration'])
+
+    for case in cases:
+        print(f"\n{case}: {results[case]['registers']} registers in {results[case]['ranges']} ranges")
+        print(f"  {'stage':<14}{'us':>10}{'baseline':>10}{'change':>9}")
+        previous_case = baseline.get('results', {}).get(case, {})
+        slower = slower_stages(results[case], previous_case, scale(case), args)
+        for stage, timing in results[case]['timings'].items():
+            previous = previous_case.get('timings', {}).get(stage)
+            if previous:
+                previous = round(previous * scale(case), 1)
+                flag = "  SLOWER" if stage in slower else ''
+                failed = failed or (bool(flag) and not args.save)
+                print(f"  {stage:<14}{timing:>10}{previous:>10}{timing / previous - 1:>+9.0%}{flag}")
+            else:
+                print(f"  {stage:<14}{timing:>10}{'-':>10}")
+        if case in expected:
+            changed = compare_values(expected[case], values[case])
+            if changed:
+                print(f"  DECODED VALUES CHANGED: {', '.join(changed[:10])}{' ...' if len(changed) > 10 else ''}")
+                failed = failed or not args.save
+            else:
+                print(f"  decoded values unchanged")
+
+    if args.save:
+        baseline = {'python': platform.python_version(), 'machine': platform.machine(),
+                    'results': (baseline.get('results') or {}) | results}
+        with open(args.baseline, 'w', encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+        with open(args.expected, 'w', encoding="utf-8") as expected_file:
+            json.dump(expected | values, expected_file, indent=1, sort_keys=True)
+        print(f"\nSaved baseline to {args.baseline} and expected values to {args.expected}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
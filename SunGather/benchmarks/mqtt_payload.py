@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""
+Bytes and CPU per MQTT publish, the original json.dumps of the merged dicts
+against PayloadEncoder. Runs offline, the scrape is decoded from made up
+register words for every register in registers-sungrow.yaml.
+
+Run from the SunGather folder: python3 benchmarks/mqtt_payload.py [-m SH10RT] [-l 3] [-n 2000]
+"""
+
+import argparse
+import json
+import logging
+import time
+
+from offline import offline_inverter
+
+import payload
+from payload import PayloadEncoder
+
+
+def measure(encode, rounds):
+    size = len(encode())
+    start = time.process_time()
+    for _ in range(rounds):
+        encode()
+    return size, (time.process_time() - start) / rounds * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT payload bytes and CPU per publish")
+    parser.add_argument('-m', dest='model', default='SH10RT')
+    parser.add_argument('-l', dest='level', type=int, default=3)
+    parser.add_argument('-n', dest='rounds', type=int, default=2000)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    inverter = offline_inverter(args.model, args.level)
+    print(f"{args.model} level {args.level}: {len(inverter.latest_scrape)} registers, {args.rounds} publishes each")
+
+    results = [("current (json.dumps)", *measure(lambda: json.dumps(inverter.inverter_config | inverter.client_config | inverter.latest_scrape).replace('"', '\"'), args.rounds))]
+    units = {name: register.get('unit', '') for name, register in inverter.register_catalog.items()}
+    for payload_format in payload.PAYLOAD_FORMATS:
+        encoder = PayloadEncoder(inverter.inverter_config | inverter.client_config, payload_format, units)
+        if encoder.format != payload_format:
+            results.append((f"{payload_format} (not installed)", 0, 0))
+            continue
+        label = f"{payload_format} ({'orjson' if payload.orjson else 'json'})" if payload_format == 'json' else payload_format
+        results.append((label, *measure(lambda: encoder.encode(inverter.latest_scrape), args.rounds)))
+        if payload_format != 'json':
+            results.append((f"  {payload_format} schema, sent once", len(encoder.encodeSchema()), 0))
+
+    print(f"{'payload':<32}{'bytes':>8}{'us/publish':>12}")
+    for label, size, cpu in results:
+        print(f"{label:<32}{size:>8}{cpu:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
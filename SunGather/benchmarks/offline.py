@@ -0,0 +1,80 @@
+"""
+Offline inverter for the benchmarks, no inverter and no network.
+
+Register blocks are captured once from a made up register map, the same
+words every run, so timings and decoded values are comparable between runs.
+"""
+
+import os
+import sys
+import yaml
+
+SUNGATHER_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SUNGATHER_FOLDER)
+
+from inverter import SungrowInverter
+from registercache import RegisterCache, YAML_LOADER
+
+
+class WordsResponse():
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class OfflineClient():
+    """ Answers every read with the same made up words """
+
+    def read_input_registers(self, start, count, unit=None):
+        return WordsResponse([(address * 7919) % 5000 for address in range(start, start + count)])
+
+    def read_holding_registers(self, start, count, unit=None):
+        return WordsResponse([(address * 104729) % 5000 for address in range(start, start + count)])
+
+    def is_socket_open(self):
+        return True
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def parse_registersfile(filename=None):
+    with open(filename or os.path.join(SUNGATHER_FOLDER, 'registers-sungrow.yaml'), encoding="utf-8") as registersfile:
+        return yaml.load(registersfile, Loader=YAML_LOADER)
+
+
+def load_registersfile(filename=None):
+    # Without the compiled cache file, so the benchmarks do not depend on what is cached
+    return RegisterCache(registersfile=parse_registersfile(filename))
+
+
+def offline_config(model, level):
+    return {'host': '127.0.0.1', 'port': 502, 'timeout': 10, 'retries': 3, 'slave': 1, 'model': model,
+            'serial_number': 'A2012345678', 'level': level, 'smart_meter': True, 'connection': 'modbus', 'identity_cache': False}
+
+
+def offline_inverter(model, level, registersfile=None):
+    # Configured and scraped once, latest_scrape holds a full scrape
+    inverter = SungrowInverter(offline_config(model, level))
+    inverter.client = OfflineClient()
+    inverter.configure_registers(registersfile or load_registersfile())
+    inverter.scrape()
+    return inverter
+
+
+def capture_blocks(inverter):
+    # (type, start, count, words) for every range the inverter reads
+    blocks = []
+    for register_range in inverter.register_ranges:
+        register_type, start, count = register_range['type'], int(register_range['start']), int(register_range['range'])
+        if register_type == "read":
+            words = inverter.client.read_input_registers(start, count).registers
+        else:
+            words = inverter.client.read_holding_registers(start, count).registers
+        blocks.append((register_type, start, count, words))
+    return blocks
@@ -0,0 +1,125 @@
+"""
+Connection lifecycle for an inverter session: keep it open between scrapes,
+probe it cheaply before use and back off when reconnecting fails.
+"""
+
+import logging
+import random
+import select
+import socket
+import time
+from datetime import date
+from SungrowModbusTcpClient import SungrowModbusTcpClient
+
+logger = logging.getLogger(__name__)
+
+
+def socket_alive(sock):
+    """
+    Cheap liveness probe that does not send anything to the inverter. A socket
+    that is readable while we are not waiting on a reply has either been closed
+    by the other end, or holds a late reply that would break the next read.
+    """
+    if sock is None:
+        return False
+    try:
+        readable, _, errored = select.select([sock], [], [sock], 0)
+        if errored:
+            return False
+        if readable:
+            if sock.recv(1, socket.MSG_PEEK) == b'':
+                logger.debug("Connection: Closed by the other end")
+            else:
+                logger.debug("Connection: Unexpected data waiting, starting a new session")
+            return False
+    except (OSError, ValueError) as err:
+        logger.debug(f"Connection: Probe failed {err}")
+        return False
+    return True
+
+
+class SungrowSessionTcpClient(SungrowModbusTcpClient.SungrowModbusTcpClient):
+    """
+    SungrowModbusTcpClient reconnects (twice, to fetch the key) on every
+    connect() and pymodbus calls connect() before every request. Keep the open
+    session while the key is still good for today.
+    """
+
+    def connect(self):
+        if self.socket and self._key is not None and self._key_date == date.today():
+            return True
+        return SungrowModbusTcpClient.SungrowModbusTcpClient.connect(self)
+
+
+class ConnectionManager():
+    """
+    Tracks the session state of one inverter connection.
+
+    keep_alive leaves the session open between scrapes, idle_close closes it
+    anyway when the next scrape is more than idle_close seconds away (0 never
+    closes). Failed connects are retried after an exponential backoff between
+    backoff_min and backoff_max seconds, with jitter so inverters sharing a
+    dongle or network do not reconnect in lock step.
+    """
+
+    def __init__(self, keep_alive=True, idle_close=0, backoff_min=1, backoff_max=300):
+        self.keep_alive = keep_alive
+        self.idle_close = idle_close or 0
+        self.backoff_min = max(backoff_min, 0.1)
+        self.backoff_max = max(backoff_max, self.backoff_min)
+
+        self.connects = 0               # Successful handshakes, including the first
+        self.connect_failures = 0
+        self.consecutive_failures = 0
+        self.sessions_reused = 0        # Scrapes that did not need a new handshake
+        self.idle_closes = 0
+        self.handshake_last = None      # Seconds
+        self.handshake_total = 0.0
+        self.retry_at = 0               # time.monotonic() before which connects are skipped
+
+    def canConnect(self):
+        return time.monotonic() >= self.retry_at
+
+    def getRetryIn(self):
+        return max(0, self.retry_at - time.monotonic())
+
+    def connected(self, handshake):
+        self.connects += 1
+        self.consecutive_failures = 0
+        self.retry_at = 0
+        self.handshake_last = handshake
+        self.handshake_total += handshake
+
+    def failed(self):
+        self.connect_failures += 1
+        self.consecutive_failures += 1
+        # Full exponential backoff then jitter between half and all of it
+        backoff = min(self.backoff_max, self.backoff_min * 2 ** (self.consecutive_failures - 1))
+        backoff = random.uniform(backoff / 2, backoff)
+        self.retry_at = time.monotonic() + backoff
+        return backoff
+
+    def reused(self):
+        self.sessions_reused += 1
+
+    def shouldClose(self, next_scrape):
+        # After a successful scrape, should the session be closed until next_scrape secs from now
+        if not self.keep_alive:
+            return True
+        if self.idle_close and next_scrape > self.idle_close:
+            self.idle_closes += 1
+            return True
+        return False
+
+    def getStats(self):
+        return {
+            "connects": self.connects,
+            "reconnects": max(0, self.connects - 1),
+            "connect_failures": self.connect_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "sessions_reused": self.sessions_reused,
+            "idle_closes": self.idle_closes,
+            "handshake_last_ms": round(self.handshake_last * 1000, 1) if self.handshake_last is not None else None,
+            "handshake_avg_ms": round(self.handshake_total / self.connects * 1000, 1) if self.connects else None,
+            "retry_in": round(self.getRetryIn(), 1),
+        }
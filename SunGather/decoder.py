@@ -0,0 +1,199 @@
+"""
+Bulk decoder for blocks of Modbus registers returned by a range read.
+"""
+
+import logging
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Array typecode with a 4 byte item size, used to view word pairs as 32bit values
+U32_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+# Sungrow serial numbers are 10 words (20 characters), null padded
+UTF8_LENGTH = 10
+
+
+def register_width(register):
+    """ Number of words a register occupies """
+    if register.get('datatype') in ("U32", "S32"):
+        return 2
+    elif register.get('datatype') == "UTF-8":
+        return register.get('length', UTF8_LENGTH)
+    return 1
+
+
+def build_decode_table(registers):
+    """
+    Registers indexed by type then address, with datarange and datatype
+    handling resolved once, so decoding only has to do a lookup per word.
+    """
+    decode_table = {}
+    for register in registers:
+        datarange = None
+        if register.get('datarange'):
+            datarange = {}
+            for value in register.get('datarange'):
+                datarange[value['response']] = value['value']
+        decode_table.setdefault(register['type'], {}).setdefault(register['address'], []).append({
+            'name': register['name'],
+            'datatype': register.get('datatype'),
+            'width': register_width(register),
+            'mask': register.get('mask'),
+            'datarange': datarange,
+            'accuracy': register.get('accuracy'),
+        })
+    return decode_table
+
+
+class BlockDecoder():
+    """
+    Precomputed decode plan for one (type, start, count) range read.
+
+    The plan is built once from the decode table, then each block of words is
+    converted to typed values in bulk rather than branching on every word.
+    """
+
+    def __init__(self, decode_table, start, count, use_numpy=True):
+        self.count = count
+        self.fields = []        # (name, offset, mask, datarange, accuracy)
+        self.u16 = []           # (field index, offset) for each datatype
+        self.s16 = []
+        self.u32 = []
+        self.s32 = []
+        self.utf8 = []          # (field index, offset, length)
+        self.raw = []
+
+        for offset in range(0, count):
+            for register in decode_table.get(start + offset + 1, ()):
+                width = register.get('width', 1)
+                if offset + width > count:
+                    logger.debug(f"Skipping {register['name']}, {width} words at offset {offset} overruns {start}:{count}")
+                    continue
+                index = len(self.fields)
+                datatype = register['datatype']
+                mask = register['mask'] if datatype == "U16" else None
+                self.fields.append((register['name'], offset, mask, register['datarange'], register['accuracy']))
+                if datatype == "U16":
+                    self.u16.append((index, offset))
+                elif datatype == "S16":
+                    self.s16.append((index, offset))
+                elif datatype == "U32":
+                    self.u32.append((index, offset))
+                elif datatype == "S32":
+                    self.s32.append((index, offset))
+                elif datatype == "UTF-8":
+                    self.utf8.append((index, offset, width))
+                else:
+                    self.raw.append((index, offset))
+
+        self.use_numpy = bool(use_numpy and numpy is not None and self.fields)
+        if self.use_numpy:
+            self.np_u16 = numpy.array([offset for index, offset in self.u16], dtype=numpy.intp)
+            self.np_s16 = numpy.array([offset for index, offset in self.s16], dtype=numpy.intp)
+            self.np_u32 = numpy.array([offset for index, offset in self.u32], dtype=numpy.intp)
+            self.np_s32 = numpy.array([offset for index, offset in self.s32], dtype=numpy.intp)
+
+    def decode(self, words):
+        """ Returns a list of (name, value) for every register in the block, in address order """
+        if self.use_numpy:
+            values = self.typed_values_numpy(words)
+        else:
+            values = self.typed_values_array(words)
+
+        for index, offset, length in self.utf8:
+            utf_value = b''.join(word.to_bytes(2, 'big') for word in words[offset:offset + length])
+            values[index] = utf_value.decode('utf-8', errors='ignore').strip('\x00').strip()
+        for index, offset in self.raw:
+            values[index] = words[offset]
+
+        decoded = []
+        for (name, offset, mask, datarange, accuracy), register_value in zip(self.fields, values):
+            if mask:
+                # Filter the value through the mask.
+                register_value = 1 if register_value & mask != 0 else 0
+            # We convert a system response to a human value
+            if datarange is not None:
+                register_value = datarange.get(words[offset], register_value)
+            if accuracy:
+                register_value = round(register_value * accuracy, 2)
+            decoded.append((name, register_value))
+        return decoded
+
+    def typed_values_array(self, words):
+        # View the block as raw little endian bytes once, then as signed and 32bit words
+        block = array('H', words)
+        if sys.byteorder == 'big':
+            block.byteswap()
+        raw = block.tobytes()
+        signed = array('h')
+        signed.frombytes(raw)
+        values = [None] * len(self.fields)
+
+        # If xFF / xFFFF then change to 0, looks better when logging / graphing
+        for index, offset in self.u16:
+            values[index] = 0 if words[offset] == 0xFFFF else words[offset]
+        for index, offset in self.s16:
+            values[index] = 0 if words[offset] == 0xFFFF or words[offset] == 0x7FFF else signed[offset]
+
+        if self.u32 or self.s32:
+            # Every word pair starting on an even and an odd offset, low word first
+            even = array(U32_TYPECODE)
+            even.frombytes(raw[:len(raw) // 4 * 4])
+            odd = array(U32_TYPECODE)
+            odd.frombytes(raw[2:2 + (len(raw) - 2) // 4 * 4])
+            if sys.byteorder == 'big':
+                even.byteswap()
+                odd.byteswap()
+            for index, offset in self.u32:
+                if words[offset] == 0xFFFF and words[offset + 1] == 0xFFFF:
+                    values[index] = 0
+                else:
+                    values[index] = odd[offset // 2] if offset % 2 else even[offset // 2]
+            for index, offset in self.s32:
+                high = words[offset + 1]
+                if words[offset] == 0xFFFF and (high == 0xFFFF or high == 0x7FFF):
+                    values[index] = 0
+                else:
+                    register_value = odd[offset // 2] if offset % 2 else even[offset // 2]
+                    # A high word of 0x7FFF is also treated as negative, as it always has been
+                    values[index] = register_value - 0x100000000 if high >= 0x7FFF else register_value
+        return values
+
+    def typed_values_numpy(self, words):
+        block = numpy.asarray(words, dtype=numpy.uint16)
+        values = [None] * len(self.fields)
+
+        if self.u16:
+            u16 = block[self.np_u16].astype(numpy.int64)
+            u16[u16 == 0xFFFF] = 0
+            for (index, offset), register_value in zip(self.u16, u16.tolist()):
+                values[index] = register_value
+        if self.s16:
+            raw = block[self.np_s16]
+            s16 = raw.view(numpy.int16).astype(numpy.int64)
+            s16[(raw == 0xFFFF) | (raw == 0x7FFF)] = 0
+            for (index, offset), register_value in zip(self.s16, s16.tolist()):
+                values[index] = register_value
+        if self.u32:
+            low = block[self.np_u32].astype(numpy.int64)
+            high = block[self.np_u32 + 1].astype(numpy.int64)
+            u32 = low + high * 0x10000
+            u32[(low == 0xFFFF) & (high == 0xFFFF)] = 0
+            for (index, offset), register_value in zip(self.u32, u32.tolist()):
+                values[index] = register_value
+        if self.s32:
+            low = block[self.np_s32].astype(numpy.int64)
+            high = block[self.np_s32 + 1].astype(numpy.int64)
+            s32 = low + high * 0x10000
+            s32 = numpy.where(high >= 0x7FFF, s32 - 0x100000000, s32)
+            s32[(low == 0xFFFF) & ((high == 0xFFFF) | (high == 0x7FFF))] = 0
+            for (index, offset), register_value in zip(self.s32, s32.tolist()):
+                values[index] = register_value
+        return values
@@ -0,0 +1,170 @@
+"""
+Publish scrapes to exports on their own worker threads, so a slow export can
+not hold up polling the inverters.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from stats import stats
+
+logger = logging.getLogger(__name__)
+
+QUEUE_POLICIES = ('drop_oldest', 'coalesce')
+
+
+class ExportWorker():
+    """
+    Bounded queue and worker thread for one export.
+
+    drop_oldest keeps up to queue_size scrapes and drops the oldest when full,
+    coalesce keeps only the latest scrape waiting for each inverter.
+    """
+
+    def __init__(self, name, export, inverters, queue_size=10, queue_policy='drop_oldest'):
+        if queue_policy not in QUEUE_POLICIES:
+            logger.warning(f"Export {name}: Unknown queue_policy {queue_policy}, Valid options are {', '.join(QUEUE_POLICIES)}")
+            queue_policy = 'drop_oldest'
+        self.name = name
+        self.export = export
+        self.inverters = inverters
+        self.queue_size = max(1, int(queue_size))
+        self.queue_policy = queue_policy
+        self.queue = deque()            # (inverter name, snapshot, time queued)
+        self.condition = threading.Condition()
+        self.busy = False
+        self.running = True
+
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.lag_last = 0.0             # Seconds from queued to published
+        self.lag_max = 0.0
+
+        self.thread = threading.Thread(target=self.run, name=f"export-{name}", daemon=True)
+        self.thread.start()
+
+    def submit(self, snapshot):
+        with self.condition:
+            if self.queue_policy == 'coalesce':
+                for index, (name, queued, queued_at) in enumerate(self.queue):
+                    if name == snapshot.getName():
+                        # Replace the waiting scrape, but keep its place and age in the queue
+                        self.queue[index] = (name, snapshot, queued_at)
+                        self.dropped += 1
+                        break
+                else:
+                    self.queue.append((snapshot.getName(), snapshot, time.monotonic()))
+            else:
+                self.queue.append((snapshot.getName(), snapshot, time.monotonic()))
+            while len(self.queue) > self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+                logger.warning(f"Export {self.name}: Falling behind, dropped the oldest scrape ({self.dropped} dropped)")
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                name, snapshot, queued_at = self.queue.popleft()
+                self.busy = True
+            publish_start = time.perf_counter()
+            try:
+                if self.export.publish(snapshot) is False:
+                    self.failed += 1
+                    stats.increment('export_errors', export=self.name)
+                else:
+                    self.published += 1
+            except Exception as err:
+                self.failed += 1
+                stats.increment('export_errors', export=self.name)
+                logger.error(f"Export {self.name}: Publishing {name} failed: {err}")
+            stats.observe('export_publish_seconds', time.perf_counter() - publish_start, export=self.name)
+            with self.condition:
+                self.busy = False
+                self.lag_last = time.monotonic() - queued_at
+                self.lag_max = max(self.lag_max, self.lag_last)
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        # Wait until everything queued has been published, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and not self.busy, timeout)
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def getStats(self):
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "published": self.published,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "lag_last": round(self.lag_last, 3),
+                "lag_max": round(self.lag_max, 3),
+            }
+
+
+class ExportDispatcher():
+    """ Hands each scrape to the workers of the exports that publish that inverter """
+
+    def __init__(self):
+        self.workers = []
+        self.configs = {}       # Worker: (export config, inverters the export is configured with)
+
+    def add(self, name, export, inverters, queue_size=10, queue_policy='drop_oldest', config=None, configured=None):
+        # configured defaults to every inverter, the others are configured when they first connect
+        worker = ExportWorker(name, export, inverters, queue_size, queue_policy)
+        self.workers.append(worker)
+        self.configs[worker] = (config or {}, list(inverters if configured is None else configured))
+
+    def configure_inverter(self, inverter):
+        # An inverter that did not connect at startup, configured into its exports once it is up
+        for worker in self.workers:
+            config, configured = self.configs[worker]
+            if inverter not in worker.inverters or inverter in configured:
+                continue
+            try:
+                if not configured:
+                    worker.export.configure(config, inverter)
+                elif hasattr(worker.export, 'configure_inverter'):
+                    worker.export.configure_inverter(inverter)
+                configured.append(inverter)
+            except Exception as err:
+                logger.error(f"Export {worker.name}: Configuring {inverter.getName()} failed: {err}")
+
+    def publish(self, inverter):
+        # One snapshot per scrape, shared by the exports, the next scrape can start straight away
+        snapshot = inverter.getSnapshot()
+        for worker in self.workers:
+            if inverter in worker.inverters:
+                worker.submit(snapshot)
+
+    def flush(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        flushed = True
+        for worker in self.workers:
+            remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+            if not worker.flush(remaining):
+                logger.warning(f"Export {worker.name}: Still publishing after {timeout} secs")
+                flushed = False
+            elif hasattr(worker.export, 'flush'):
+                # Exports that batch writes send whatever they are holding
+                worker.export.flush()
+        return flushed
+
+    def stop(self, timeout=None):
+        for worker in self.workers:
+            worker.stop(timeout)
+
+    def getStats(self):
+        return {worker.name: worker.getStats() for worker in self.workers}
@@ -4,6 +4,9 @@ class export_console(object):
 
     # Configure Console
     def configure(self, config, inverter):
+        return self.configure_inverter(inverter)
+
+    def configure_inverter(self, inverter):
         print("+----------------------------------------------+")
         print("{:<46} {:<1}".format("| " + 'Inverter Configuration Settings',"|"))
         print("+----------------------------------------------+")
@@ -22,8 +25,9 @@ class export_console(object):
         print("| {:<7} | {:<35} | {:<20} |".format('Address', 'Register','Value'))
         print("+---------+-------------------------------------+----------------------+") 
         for register, value in inverter.latest_scrape.items():
-            print("| {:<7} | {:<35} | {:<20} |".format(str(inverter.getRegisterAddress(register)), str(register), str(value) + " " + str(inverter.getRegisterUnit(register))))
+            register_info = inverter.getRegister(register) or {}
+            print("| {:<7} | {:<35} | {:<20} |".format(str(register_info.get('address', '----')), str(register), str(value) + " " + str(register_info.get('unit', ''))))
         print("+----------------------------------------------------------------------+") 
-        print(f"Logged {len(inverter.latest_scrape)} registers to Console")
+        print(f"Logged {len(inverter.latest_scrape)} registers from {inverter.getName()} to Console")
 
         return True
\ No newline at end of file
@@ -0,0 +1,58 @@
+import logging
+import os
+import time
+
+import historystore
+from historystore import HistoryStore
+
+class export_history(object):
+    def __init__(self):
+        self.store = None
+        self.registers = {}         # Inverter name: registers to keep, None keeps every number
+
+    # Configure the local history store
+    def configure(self, config, inverter):
+        self.history_config = {
+            'file': config.get('file', os.path.join(inverter.getCacheFolder(), 'history.sqlite')),
+            'registers': config.get('registers', None),
+            'raw_hours': config.get('raw_hours', 48),
+            'rollup_5m_days': config.get('rollup_5m_days', 31),
+            'rollup_1h_days': config.get('rollup_1h_days', 730),
+            'commit_interval': config.get('commit_interval', 60)
+        }
+        try:
+            self.store = HistoryStore(self.history_config['file'], self.history_config['raw_hours'],
+                                      self.history_config['rollup_5m_days'], self.history_config['rollup_1h_days'],
+                                      self.history_config['commit_interval'])
+        except Exception as err:
+            logging.error(f"History: Can not open {self.history_config['file']}: {err}")
+            return False
+        historystore.setStore(self.store)
+        logging.info(f"History: Configured: {self.history_config['file']}")
+        return self.configure_inverter(inverter)
+
+    def configure_inverter(self, inverter):
+        if self.history_config['registers']:
+            for register in self.history_config['registers']:
+                if not inverter.validateRegister(register):
+                    logging.error(f"History: Configured to use {register} but not configured to scrape this register")
+                    return False
+        self.registers[inverter.getName()] = self.history_config['registers']
+        return True
+
+    def publish(self, inverter):
+        registers = self.registers.get(inverter.getName())
+        values = {}
+        for register, value in inverter.latest_scrape.items():
+            if registers and register not in registers:
+                continue
+            # Only numbers have a history, bool is an int but not a reading
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[register] = value
+        if not values:
+            logging.warning(f"History: No numeric registers in last scrape")
+            return False
+        return self.store.append(inverter.getName(), int(inverter.getScrapeTime() or time.time()), values, inverter.getRegisterUnit)
+
+    def flush(self):
+        return self.store.commit() if self.store else True
@@ -1,11 +1,32 @@
 import influxdb_client
 import logging
+import math
+import os
+import time
+from influxdb_client import WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
 
+def escape_key(key):
+    # Line protocol escaping for measurement names, tag keys, tag values and field keys
+    return str(key).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def line_value(value):
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return repr(value)
+
 class export_influxdb(object):
     def __init__(self):
         self.client = None
         self.write_api = None
+        self.pending = []           # Line protocol waiting for the next flush
+        self.pending_since = None
+        self.line_prefixes = {}     # Inverter name: {point: measurement and tag set}
+        self.buffered = 0           # Lines in the outage buffer file
+        self.requests = 0
 
     # Configure InfluxDB
     def configure(self, config, inverter):
@@ -15,7 +36,12 @@ class export_influxdb(object):
             'username': config.get('username', None),
             'password': config.get('password', None),
             'org': config.get('org',None),
-            'bucket': config.get('bucket',None)
+            'bucket': config.get('bucket',None),
+            'batch_size': config.get('batch_size', 5000),
+            'flush_interval': config.get('flush_interval', 60),
+            'gzip': config.get('gzip', True),
+            'buffer_file': config.get('buffer_file', os.path.join(inverter.getCacheFolder(), 'influxdb-buffer.lp')),
+            'buffer_size': config.get('buffer_size', 100000)
         }
         self.influxdb_measurements = [{}]
         self.influxdb_measurements.pop() # Remove null value from list
@@ -29,46 +55,144 @@ class export_influxdb(object):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=self.influxdb_config['token'],
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
             elif config.get('username',False) and config.get('password',False):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=f"{self.influxdb_config['username']}:{self.influxdb_config['password']}",
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
 
         except Exception as err:
             logging.error(f"InfluxDB: Error: {err}")
             return False
 
+        # Registers that share a point are written as the fields of one line
+        self.influxdb_points = {}
         for measurement in config.get('measurements'):
-            if not inverter.validateRegister(measurement['register']):
-                logging.error(f"InfluxDB: Configured to use {measurement['register']} but not configured to scrape this register")
-                return False
             self.influxdb_measurements.append(measurement)
+            self.influxdb_points.setdefault(measurement['point'], []).append(measurement['register'])
+
+        try:
+            with open(self.influxdb_config['buffer_file'], encoding="utf-8") as buffer_file:
+                self.buffered = sum(1 for line in buffer_file)
+            logging.info(f"InfluxDB: {self.buffered} lines buffered from an earlier outage, will replay")
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            logging.warning(f"InfluxDB: Can not read buffer {self.influxdb_config['buffer_file']}: {err}")
 
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
         logging.info(f"InfluxDB: Configured: {self.client.url}")
 
+        return self.configure_inverter(inverter)
+
+    def configure_inverter(self, inverter):
+        for measurement in self.influxdb_measurements:
+            if not inverter.validateRegister(measurement['register']):
+                logging.error(f"InfluxDB: Configured to use {measurement['register']} but not configured to scrape this register")
+                return False
+        # The tag set only depends on the inverter, build each line prefix once
+        tags = f",inverter={escape_key(inverter.getInverterModel(True))},inverter_name={escape_key(inverter.getName())}"
+        self.line_prefixes[inverter.getName()] = {point: escape_key(point) + tags for point in self.influxdb_points}
         return True
 
     def publish(self, inverter):
-        sequence = []
+        line_prefixes = self.line_prefixes.get(inverter.getName())
+        if line_prefixes is None:
+            self.configure_inverter(inverter)
+            line_prefixes = self.line_prefixes[inverter.getName()]
 
-        for measurement in self.influxdb_measurements:
-            register = measurement['register']
-            if not inverter.validateLatestScrape(register):
-                logging.error(f"InfluxDB: Skipped collecting data, {register} missing from last scrape")
-                return False
-            value = inverter.getRegisterValue(register) if type(inverter.getRegisterValue(register)) is str else float(inverter.getRegisterValue(register))
-            sequence.append(influxdb_client.Point(measurement['point']).tag("inverter", inverter.getInverterModel(True)).field(register, value))
+        # Time of the scrape, so buffered and batched lines keep it
+        timestamp = int(inverter.getScrapeTime() or time.time())
+
+        lines = 0
+        for point, registers in self.influxdb_points.items():
+            fields = []
+            for register in registers:
+                if not inverter.validateLatestScrape(register):
+                    logging.debug(f"InfluxDB: {register} missing from last scrape, skipped")
+                    continue
+                value = line_value(inverter.getRegisterValue(register))
+                if value is not None:
+                    fields.append(f"{escape_key(register)}={value}")
+            if fields:
+                self.pending.append(f"{line_prefixes[point]} {','.join(fields)} {timestamp}")
+                lines += 1
+        if not lines:
+            logging.error(f"InfluxDB: Skipped collecting data, no registers in last scrape")
+            return False
+
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        if len(self.pending) >= self.influxdb_config['batch_size'] or time.monotonic() - self.pending_since >= self.influxdb_config['flush_interval']:
+            return self.flush()
+
+        logging.info(f"InfluxDB: Collected, {len(self.pending)} lines waiting")
+        return True
 
+    def flush(self):
+        if not self.pending and not self.buffered:
+            return True
+        lines, self.pending, self.pending_since = self.pending, [], None
+        if lines and not self.write(lines):
+            self.buffer(lines)
+            return False
+        if self.buffered:
+            self.replay()
+        logging.info(f"InfluxDB: Published {len(lines)} lines")
+        return True
+
+    def write(self, lines):
         try:
-            self.write_api.write(self.influxdb_config['bucket'], self.client.org, sequence)
+            self.requests += 1
+            self.write_api.write(self.influxdb_config['bucket'], self.client.org, lines, write_precision=WritePrecision.S)
         except Exception as err:
             logging.error("InfluxDB: " + str(err))
+            return False
+        return True
 
-        logging.info("InfluxDB: Published")
+    def buffer(self, lines):
+        # Keep what could not be written on disk, dropping the oldest lines past buffer_size
+        try:
+            with open(self.influxdb_config['buffer_file'], 'a', encoding="utf-8") as buffer_file:
+                buffer_file.write('\n'.join(lines) + '\n')
+            self.buffered += len(lines)
+            if self.buffered > self.influxdb_config['buffer_size']:
+                with open(self.influxdb_config['buffer_file'], encoding="utf-8") as buffer_file:
+                    kept = buffer_file.readlines()[-self.influxdb_config['buffer_size']:]
+                with open(self.influxdb_config['buffer_file'], 'w', encoding="utf-8") as buffer_file:
+                    buffer_file.writelines(kept)
+                logging.warning(f"InfluxDB: Buffer full, dropped {self.buffered - len(kept)} oldest lines")
+                self.buffered = len(kept)
+            logging.warning(f"InfluxDB: Buffered {len(lines)} lines until the server is back, {self.buffered} waiting")
+        except Exception as err:
+            logging.error(f"InfluxDB: Can not buffer to {self.influxdb_config['buffer_file']}, {len(lines)} lines lost: {err}")
 
-        return True
+    def replay(self):
+        # The server is answering again, send the buffer in batch_size writes
+        try:
+            with open(self.influxdb_config['buffer_file'], encoding="utf-8") as buffer_file:
+                lines = buffer_file.read().splitlines()
+        except Exception as err:
+            logging.error(f"InfluxDB: Can not read buffer {self.influxdb_config['buffer_file']}: {err}")
+            return
+        sent = 0
+        while sent < len(lines):
+            if not self.write(lines[sent:sent + self.influxdb_config['batch_size']]):
+                break
+            sent += self.influxdb_config['batch_size']
+        try:
+            if sent >= len(lines):
+                os.remove(self.influxdb_config['buffer_file'])
+                self.buffered = 0
+            else:
+                with open(self.influxdb_config['buffer_file'], 'w', encoding="utf-8") as buffer_file:
+                    buffer_file.write('\n'.join(lines[sent:]) + '\n')
+                self.buffered = len(lines) - sent
+        except Exception as err:
+            logging.error(f"InfluxDB: Can not update buffer {self.influxdb_config['buffer_file']}: {err}")
+        logging.info(f"InfluxDB: Replayed {min(sent, len(lines))} buffered lines, {self.buffered} waiting")
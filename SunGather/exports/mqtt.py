@@ -1,13 +1,15 @@
 import logging
 import json
+import time
 import paho.mqtt.client as mqtt
+from payload import PayloadEncoder, dumps_json
 
 class export_mqtt(object):
     def __init__(self):
         self.mqtt_client = None
         self.sensor_topic = None
         self.mqtt_queue = []
-        self.ha_discovery_published = False
+        self.inverters = {}
         # Exclude ones linked to register lookups; unit_of_measurement
         self.ha_variables = ["action_topic", "action_template", "automation_type", "aux_command_topic", "aux_state_template", "aux_state_topic", "available_tones", "availability", "availability_mode", "availability_topic", "availability_template", "away_mode_command_topic", "away_mode_state_template", "away_mode_state_topic", "blue_template", "brightness_command_topic", "brightness_command_template", "brightness_scale", "brightness_state_topic", "brightness_template", "brightness_value_template", "color_temp_command_template", "battery_level_topic", "battery_level_template", "charging_topic", "charging_template", "color_temp_command_topic", "color_temp_state_topic", "color_temp_template", "color_temp_value_template", "color_mode", "color_mode_state_topic", "color_mode_value_template", "cleaning_topic", "cleaning_template", "command_off_template", "command_on_template", "command_topic", "command_template", "code_arm_required", "code_disarm_required", "code_trigger_required", "current_temperature_topic", "current_temperature_template", "device", "device_class", "docked_topic", "docked_template", "encoding", "enabled_by_default", "entity_category", "entity_picture", "error_topic", "error_template", "fan_speed_topic", "fan_speed_template", "fan_speed_list", "flash_time_long", "flash_time_short", "effect_command_topic", "effect_command_template", "effect_list", "effect_state_topic", "effect_template", "effect_value_template", "expire_after", "fan_mode_command_template", "fan_mode_command_topic", "fan_mode_state_template", "fan_mode_state_topic", "force_update", "green_template", "hold_command_template", "hold_command_topic", "hold_state_template", "hold_state_topic", "hs_command_topic", "hs_state_topic", "hs_value_template", "icon", "image_encoding", "initial", "target_humidity_command_topic", "target_humidity_command_template", "target_humidity_state_topic", "target_humidity_state_template", "json_attributes", "json_attributes_topic", "json_attributes_template", "latest_version_topic", "latest_version_template", "last_reset_topic", "last_reset_value_template", "max", "min", "max_mireds", "min_mireds", "max_temp", "min_temp", "max_humidity", "min_humidity", "mode", "mode_command_template", "mode_command_topic", "mode_state_template", "mode_state_topic", "modes", "name", "object_id", "off_delay", "on_command_type", "options", "optimistic", "oscillation_command_topic", "oscillation_command_template", "oscillation_state_topic", "oscillation_value_template", "percentage_command_topic", "percentage_command_template", "percentage_state_topic", "percentage_value_template", "pattern", "payload", "payload_arm_away", "payload_arm_home", "payload_arm_custom_bypass", "payload_arm_night", "payload_arm_vacation", "payload_press", "payload_reset", "payload_available", "payload_clean_spot", "payload_close", "payload_disarm", "payload_home", "payload_install", "payload_lock", "payload_locate", "payload_not_available", "payload_not_home", "payload_off", "payload_on", "payload_open", "payload_oscillation_off", "payload_oscillation_on", "payload_pause", "payload_stop", "payload_start", "payload_start_pause", "payload_return_to_base", "payload_reset_humidity", "payload_reset_mode", "payload_reset_percentage", "payload_reset_preset_mode", "payload_turn_off", "payload_turn_on", "payload_trigger", "payload_unlock", "position_closed", "position_open", "power_command_topic", "power_state_topic", "power_state_template", "preset_mode_command_topic", "preset_mode_command_template", "preset_mode_state_topic", "preset_mode_value_template", "preset_modes", "red_template", "release_summary", "release_url", "retain", "rgb_command_topic", "rgb_command_template", "rgb_state_topic", "rgb_value_template", "rgbw_command_topic", "rgbw_command_template", "rgbw_state_topic", "rgbw_value_template", "rgbww_command_topic", "rgbww_command_template", "rgbww_state_topic", "rgbww_value_template", "send_command_topic", "send_if_off", "set_fan_speed_topic", "set_position_template", "set_position_topic", "position_topic", "position_template", "speed_range_min", "speed_range_max", "source_type", "state_class", "state_closed", "state_closing", "state_off", "state_on", "state_open", "state_opening", "state_stopped", "state_locked", "state_unlocked", "state_topic", "state_template", "state_value_template", "step", "subtype", "supported_color_modes", "support_duration", "support_volume_set", "supported_features", "swing_mode_command_template", "swing_mode_command_topic", "swing_mode_state_template", "swing_mode_state_topic", "temperature_command_template", "temperature_command_topic", "temperature_high_command_template", "temperature_high_command_topic", "temperature_high_state_template", "temperature_high_state_topic", "temperature_low_command_template", "temperature_low_command_topic", "temperature_low_state_template", "temperature_low_state_topic", "temperature_state_template", "temperature_state_topic", "temperature_unit", "tilt_closed_value", "tilt_command_topic", "tilt_command_template", "tilt_invert_state", "tilt_max", "tilt_min", "tilt_opened_value", "tilt_optimistic", "tilt_status_topic", "tilt_status_template", "title", "topic", "unique_id", "value_template", "white_command_topic", "white_scale", "white_value_command_topic", "white_value_scale", "white_value_state_topic", "white_value_template", "xy_command_topic", "xy_state_topic", "xy_value_template"]
 
@@ -23,11 +25,14 @@ class export_mqtt(object):
             'topic': config.get('topic', f"SunGather/{self.serial_number}"),
             'username': config.get('username', None),
             'password': config.get('password',None),
-            'homeassistant': config.get('homeassistant',False)
+            'homeassistant': config.get('homeassistant',False),
+            'per_register_topics': config.get('per_register_topics',False),
+            'max_age': config.get('max_age',300),
+            'payload_format': config.get('payload_format','json')
         }
-
-        self.ha_sensors = [{}]
-        self.ha_sensors.pop() # Remove null value from list
+        self.config_ha_sensors = config.get('ha_sensors') or []
+        self.topic_configured = config.get('topic', None)
+        self.inverters = {}
 
         if not self.mqtt_config['host']:
             logging.info(f"MQTT: Host config is required")
@@ -47,18 +52,52 @@ class export_mqtt(object):
         self.mqtt_client.connect_async(self.mqtt_config['host'], port=self.mqtt_config['port'], keepalive=60)
         self.mqtt_client.loop_start()
 
+        return self.configure_inverter(inverter)
+
+    # Each inverter gets its own topic and Home Assistant device
+    def configure_inverter(self, inverter):
+        serial_number = inverter.getSerialNumber()
+        if not self.inverters:
+            topic = self.mqtt_config['topic']
+        elif self.topic_configured:
+            topic = f"{self.topic_configured}/{serial_number}"
+        else:
+            topic = f"SunGather/{serial_number}"
+        mqtt_inverter = {
+            'model': inverter.getInverterModel(True),
+            'serial_number': serial_number,
+            'topic': topic,
+            'ha_sensors': [],
+            'ha_discovery_published': False,
+            'config_published': False,
+            'published': {},        # Register: (payload, time sent), for per_register_topics
+            # Settings are serialized once here, each scan only encodes the registers
+            'encoder': PayloadEncoder(inverter.inverter_config | inverter.client_config, self.mqtt_config['payload_format'],
+                                      {name: register.get('unit', '') for name, register in inverter.register_catalog.items()}),
+            'schema_published': None    # Schema version last sent, for msgpack and cbor
+        }
+        if mqtt_inverter['encoder'].format != 'json' and self.mqtt_config['homeassistant'] and not self.mqtt_config['per_register_topics']:
+            logging.warning(f"MQTT: Home Assistant can not read {mqtt_inverter['encoder'].format} payloads, use per_register_topics: True for discovery")
+
         if self.mqtt_config['homeassistant']:
-            for ha_sensor in config.get('ha_sensors'):
+            for ha_sensor in self.config_ha_sensors:
                 if not inverter.validateRegister(ha_sensor['register']):
                     logging.error(f"MQTT: Configured to use {ha_sensor['register']} but not configured to scrape this register")
                     return False
                 else:
-                    self.ha_sensors.append(ha_sensor)
-    
+                    mqtt_inverter['ha_sensors'].append(ha_sensor)
+
+        self.inverters[inverter.getName()] = mqtt_inverter
+        logging.info(f"MQTT: Publishing {inverter.getName()} to {topic}")
         return True
 
     def on_connect(self, client, userdata, flags, rc):
         logging.info(f"MQTT: Connected to {client._host}:{client._port}")
+        # Anything sent while disconnected was lost, send every register again
+        for mqtt_inverter in self.inverters.values():
+            mqtt_inverter['published'] = {}
+            mqtt_inverter['config_published'] = False
+            mqtt_inverter['schema_published'] = None
 
     def on_disconnect(self, client, userdata, rc):
         logging.info(f"MQTT: Server Disconnected code: {rc}")
@@ -84,18 +123,24 @@ class export_mqtt(object):
         #elif self.mqtt_queue.__len__() > 10:
         #    logging.warning(f'MQTT: {self.mqtt_queue.__len__()} messages queued, this may be due to a MQTT server issue')
 
-        if self.mqtt_config['homeassistant'] and not self.ha_discovery_published:
+        mqtt_inverter = self.inverters.get(inverter.getName())
+        if not mqtt_inverter:
+            logging.warning(f"MQTT: {inverter.getName()} is not configured for this export")
+            return False
+        serial_number = mqtt_inverter['serial_number']
+
+        if self.mqtt_config['homeassistant'] and not mqtt_inverter['ha_discovery_published']:
             # Build Device, this will be the same for every message
-            ha_device = { "name":f"Sungrow {self.model}", "manufacturer":"Sungrow", "model":self.model, "identifiers":self.serial_number, "via_device": "SunGather", "connections":[["address", inverter.getHost() ]]}
+            ha_device = { "name":f"Sungrow {mqtt_inverter['model']}", "manufacturer":"Sungrow", "model":mqtt_inverter['model'], "identifiers":serial_number, "via_device": "SunGather", "connections":[["address", inverter.getHost() ]]}
 
-            for ha_sensor in self.ha_sensors:
+            for ha_sensor in mqtt_inverter['ha_sensors']:
                 config_msg = {}
                 if not (ha_sensor.get('name', False) and ha_sensor.get('sensor_type', False)):
                     logging.error(f"HomeAssistance Discovery requires at minimum; name, sensor_type")
                     break
 
                 # Set Defaults, these can be overridden below
-                config_msg['state_topic'] = self.mqtt_config['topic']
+                config_msg['state_topic'] = mqtt_inverter['topic']
                 if ha_sensor.get('register', False):
                     config_msg['value_template'] = "{{ value_json." + ha_sensor.get('register') + " }}"
 
@@ -103,26 +148,66 @@ class export_mqtt(object):
                     if ha_sensor.get(ha_variable):
                         config_msg[ha_variable] = ha_sensor[ha_variable]
 
+                if self.mqtt_config['per_register_topics'] and ha_sensor.get('register', False):
+                    # Each register has its own topic holding just its value
+                    config_msg['state_topic'] = f"{mqtt_inverter['topic']}/{ha_sensor.get('register')}"
+                    config_msg['value_template'] = config_msg['value_template'].replace("value_json." + ha_sensor.get('register'), "value_json")
+
                 # Set unique_id, include Serial so is unique
-                config_msg['unique_id'] = f"sungather_{self.cleanName(config_msg['name'])}_{self.serial_number}"
+                config_msg['unique_id'] = f"sungather_{self.cleanName(config_msg['name'])}_{serial_number}"
 
                 # Variables with links to registers
                 if ha_sensor.get('register', False):
-                    if inverter.getRegisterUnit(ha_sensor.get('register')):
-                        config_msg['unit_of_measurement'] = inverter.getRegisterUnit(ha_sensor.get('register'))
+                    register_info = inverter.getRegister(ha_sensor.get('register')) or {}
+                    if register_info.get('unit'):
+                        config_msg['unit_of_measurement'] = register_info.get('unit')
                 
                 config_msg['device'] = ha_device
 
                 # <discovery_prefix>/<component>/<object_id>/config
-                ha_topic = f"homeassistant/{ha_sensor.get('sensor_type')}/{self.serial_number}_{self.cleanName(ha_sensor.get('name'))}/config"
+                ha_topic = f"homeassistant/{ha_sensor.get('sensor_type')}/{serial_number}_{self.cleanName(ha_sensor.get('name'))}/config"
                 logging.debug(f'MQTT: Topic; {ha_topic}, Message: {config_msg}')
                 self.mqtt_queue.append(self.mqtt_client.publish(ha_topic, json.dumps(config_msg), retain=True, qos=1).mid)
-            self.ha_discovery_published = True
+            mqtt_inverter['ha_discovery_published'] = True
             logging.info("MQTT: Published Home Assistant Discovery messages")
 
-        payload = json.dumps(inverter.inverter_config | inverter.client_config | inverter.latest_scrape).replace('"', '\"')
-        logging.debug(f"MQTT: Publishing Registers: {self.mqtt_config['topic']} : {payload}")
-        self.mqtt_queue.append(self.mqtt_client.publish(self.mqtt_config['topic'], payload, qos=0).mid)
+        if self.mqtt_config['per_register_topics']:
+            return self.publish_registers(inverter, mqtt_inverter)
+
+        encoder = mqtt_inverter['encoder']
+        payload = encoder.encode(inverter.latest_scrape)
+        if encoder.format != 'json' and mqtt_inverter['schema_published'] != encoder.schema_version:
+            # Field names for the binary payload, sent again whenever new registers show up
+            message = self.mqtt_client.publish(f"{mqtt_inverter['topic']}/schema", encoder.encodeSchema(), qos=1, retain=True)
+            if message.rc == mqtt.MQTT_ERR_SUCCESS:
+                mqtt_inverter['schema_published'] = encoder.schema_version
+                logging.info(f"MQTT: Published {encoder.format} schema version {encoder.schema_version}")
+        logging.debug(f"MQTT: Publishing Registers: {mqtt_inverter['topic']} : {payload}")
+        self.mqtt_queue.append(self.mqtt_client.publish(mqtt_inverter['topic'], payload, qos=0).mid)
         logging.info(f"MQTT: Registers Published")
 
         return True
+
+    def publish_registers(self, inverter, mqtt_inverter):
+        # Settings only change on restart, publish them once
+        if not mqtt_inverter['config_published']:
+            payload = dumps_json(inverter.inverter_config | inverter.client_config)
+            message = self.mqtt_client.publish(f"{mqtt_inverter['topic']}/config", payload, qos=0, retain=True)
+            mqtt_inverter['config_published'] = message.rc == mqtt.MQTT_ERR_SUCCESS
+
+        # Retained value per register, sent when it changes or is older than max_age
+        now = time.monotonic()
+        published = mqtt_inverter['published']
+        sent = 0
+        for register, value in inverter.latest_scrape.items():
+            payload = dumps_json(value)
+            last = published.get(register)
+            if last and last[0] == payload and (not self.mqtt_config['max_age'] or now - last[1] < self.mqtt_config['max_age']):
+                continue
+            message = self.mqtt_client.publish(f"{mqtt_inverter['topic']}/{register}", payload, qos=0, retain=True)
+            if message.rc == mqtt.MQTT_ERR_SUCCESS:
+                published[register] = (payload, now)
+                sent += 1
+        logging.info(f"MQTT: Registers Published, {sent} of {len(inverter.latest_scrape)} changed")
+
+        return True
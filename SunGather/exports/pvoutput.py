@@ -1,7 +1,9 @@
 import logging
+import os
 import requests
 import datetime
 import time
+from collections import deque
 
 """
     See: https://pvoutput.org/help/api_specification.html#add-status-service
@@ -38,12 +40,17 @@ class export_pvoutput(object):
         self.url_getsystem = self.url_base + "getsystem.jsp"
         self.tid = '1618'
         self.status_interval = 5
+        self.max_batch = 30                 # Most status points addbatchstatus takes in one request
+        self.session = None
+        self.request_times = deque()        # When each request in the last hour was sent
+        self.rate_limit_reset = 0           # Epoch secs, set when PVOutput says the hourly limit is used up
 
     @property
     def headers(self):
         return {
             "X-Pvoutput-Apikey": self.pvoutput_config['api'],
             "X-Pvoutput-SystemId": self.pvoutput_config['sid'],
+            "X-Rate-Limit": "1",
             "Content-Type": "application/x-www-form-urlencoded",
             "cache-control": "no-cache",
         }
@@ -55,15 +62,17 @@ class export_pvoutput(object):
             'join_team': config.get('join_team', True),
             'rate_limit': config.get('rate_limit', 60),
             'cumulative_flag': config.get('cumulative_flag',0),
-            'batch_points': config.get('batch_points',1)
+            'batch_points': config.get('batch_points',1),
+            'backlog_file': config.get('backlog_file', os.path.join(inverter.getCacheFolder(), 'pvoutput-backlog.txt')),
+            'backlog_days': config.get('backlog_days', 14)
         }
         self.pvoutput_parameters = [{}]
         self.pvoutput_parameters.pop() # Remove null value from list
 
-        self.collected_data = {}
+        self.window_start = 0               # Scrapes from here on are averaged into the next data point
         self.batch_data = []
-        self.batch_count = 0
         self.last_run = 0
+        self.last_point = 0
         self.last_publish = 0
         
         for parameter in config.get('parameters'):
@@ -72,9 +81,21 @@ class export_pvoutput(object):
                 return False
             self.pvoutput_parameters.append(parameter)
 
+        # Averages are taken from the scrape buffer, it has to hold a whole status interval
+        if not inverter.buffer_hours:
+            logging.error(f"PVOutput: Needs the scrape buffer, set buffer_hours above 0")
+            return False
+
+        # One pooled connection for every request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.load_backlog()
+
+        invertername = self.pvoutput_config['sid']
+        team_member = None
         try:
             logging.debug(f"PVOutput: Get System ; {self.url_getsystem}, {str(self.headers)}, 'teams': '1'")
-            response = requests.post(url=self.url_getsystem,headers=self.headers, params={'teams': '1'}, timeout=3)
+            response = self.post(self.url_getsystem, {'teams': '1'})
             logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")
 
             if response.status_code == 200:
@@ -98,22 +119,82 @@ class export_pvoutput(object):
             return False
 
         try:
-            if not team_member and self.pvoutput_config['join_team']:
+            if team_member is False and self.pvoutput_config['join_team']:
                 logging.debug(f"PVOutput: Join Team; {self.url_jointeam}, {str(self.headers)}, 'tid': '{self.tid}'")
-                response = requests.post(url=self.url_jointeam,headers=self.headers, params={'tid': self.tid}, timeout=3)
+                response = self.post(self.url_jointeam, {'tid': self.tid})
                 logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")
             elif team_member and not self.pvoutput_config['join_team']:
                 logging.debug(f"PVOutput: Leave Team; {self.url_leaveteam}, {str(self.headers)}, 'tid': '{self.tid}'")
-                response = requests.post(url=self.url_leaveteam,headers=self.headers, params={'tid': self.tid}, timeout=3)
+                response = self.post(self.url_leaveteam, {'tid': self.tid})
                 logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")  
         except Exception as err:
             pass
 
+        if inverter.buffer_hours * 60 < self.status_interval:
+            logging.warning(f"PVOutput: buffer_hours {inverter.buffer_hours} is shorter than the {self.status_interval} minute status interval, averages only cover the buffer")
         logging.info(f"PVOutput: Configured export to {invertername} every {self.status_interval} minutes")
         return True
 
+    def post(self, url, params):
+        self.request_times.append(time.time())
+        response = self.session.post(url=url, params=params, timeout=3)
+        # Sent back because of the X-Rate-Limit header
+        try:
+            if int(response.headers.get('X-Rate-Limit-Remaining', 1)) <= 0:
+                self.rate_limit_reset = int(response.headers.get('X-Rate-Limit-Reset', time.time() + 3600))
+        except ValueError:
+            pass
+        return response
+
+    def can_request(self):
+        # Spread requests over the hour, never more than rate_limit an hour
+        now = time.time()
+        while self.request_times and now - self.request_times[0] >= 3600:
+            self.request_times.popleft()
+        if now < self.rate_limit_reset:
+            return False
+        if len(self.request_times) >= self.pvoutput_config['rate_limit']:
+            return False
+        if self.request_times and now - self.request_times[-1] < 3600 / self.pvoutput_config['rate_limit']:
+            return False
+        return True
+
+    def load_backlog(self):
+        # Status points not uploaded yet, one per line, kept so a restart or outage does not lose them
+        try:
+            with open(self.pvoutput_config['backlog_file'], encoding="utf-8") as backlog_file:
+                self.batch_data = [line.strip() for line in backlog_file if line.strip()]
+        except FileNotFoundError:
+            self.batch_data = []
+        except Exception as err:
+            logging.warning(f"PVOutput: Can not read backlog {self.pvoutput_config['backlog_file']}: {err}")
+            self.batch_data = []
+        self.expire_backlog()
+        if self.batch_data:
+            logging.info(f"PVOutput: {len(self.batch_data)} data points waiting to upload from before restart")
+
+    def save_backlog(self):
+        try:
+            if self.batch_data:
+                with open(self.pvoutput_config['backlog_file'] + '.tmp', 'w', encoding="utf-8") as backlog_file:
+                    backlog_file.write('\n'.join(self.batch_data) + '\n')
+                os.replace(self.pvoutput_config['backlog_file'] + '.tmp', self.pvoutput_config['backlog_file'])
+            elif os.path.exists(self.pvoutput_config['backlog_file']):
+                os.remove(self.pvoutput_config['backlog_file'])
+        except Exception as err:
+            logging.warning(f"PVOutput: Can not save backlog {self.pvoutput_config['backlog_file']}: {err}")
+
+    def expire_backlog(self):
+        # PVOutput only accepts batch status points from the last few days
+        oldest = (datetime.datetime.now() - datetime.timedelta(days=self.pvoutput_config['backlog_days'])).strftime("%Y%m%d")
+        expired = [data for data in self.batch_data if data[:8] < oldest]
+        if expired:
+            logging.warning(f"PVOutput: Dropping {len(expired)} data points older than {self.pvoutput_config['backlog_days']} days")
+            self.batch_data = [data for data in self.batch_data if data[:8] >= oldest]
+            self.save_backlog()
+
     def collect_data(self, inverter):
-        # Check all required registers have been returned by the inverter
+        # Values are kept by the inverter scrape buffer, just check all required registers have been returned by the inverter
         if not inverter.validateLatestScrape('timestamp'):
                 logging.error(f"PVOutput: Skipped collecting data, Timestamp missing from last scrape")
                 return False
@@ -121,106 +202,96 @@ class export_pvoutput(object):
             if not inverter.validateLatestScrape(parameter['register']):
                 logging.error(f"PVOutput: Skipped collecting data,  {parameter['register']} missing from last scrape")
                 return False
-
-        # Add new data to old data and increase count of data points
-        for parameter in self.pvoutput_parameters:
-            value = inverter.getRegisterValue(parameter.get('register'))
-
-            if parameter.get('multiple'):
-                value = value * parameter.get('multiple')
-
-            # If using Cumulative Energy we just need the last data point, not the average
-            if parameter.get('name') == 'v1' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                self.collected_data[parameter.get('name')] = value
-            elif parameter.get('name') == 'v3' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
-                self.collected_data[parameter.get('name')] = value
-            # Add the last data point to the previous data point if exists, otherwise set as the last data point
-            elif self.collected_data.get(parameter.get('name'),False):
-                self.collected_data[parameter.get('name')] = round(self.collected_data[parameter.get('name')] + value,3)
-            else:
-                self.collected_data[parameter.get('name')] = value
-
-        if self.collected_data.get('count',False):
-            self.collected_data['count'] +=1
-        else:
-            self.collected_data['count'] = 1
-
-        logging.debug(f'PVOutput: Data Logged: {self.collected_data}')
-
         return True
 
+    def window_value(self, inverter, parameter, start, end):
+        # Average over the status interval from the scrape buffer, cumulative energy just needs the last value
+        window = inverter.getWindow(parameter.get('register'), end - start, end)
+        if not window:
+            return None
+        cumulative = (parameter.get('name') == 'v1' and self.pvoutput_config['cumulative_flag'] in (1, 2)) or \
+                     (parameter.get('name') == 'v3' and self.pvoutput_config['cumulative_flag'] in (1, 3))
+        value = window['last'] if cumulative else window['mean']
+        if parameter.get('multiple'):
+            value = round(value * parameter.get('multiple'), 3)
+        if not value:
+            return None
+        if cumulative:
+            return int(value)
+        elif parameter.get('name') in ('v6', 'v7'):   # Round to 1 decimal place
+            return round(value, 1)
+        return int(value)                           # Getting errors when uploading decimals for power/energy so return INT
+
     def publish(self, inverter):
         if self.collect_data(inverter):
             # Process data points every status_interval
-            if((time.time() - self.last_publish) >= (self.status_interval * 60)):
+            if((time.time() - self.last_point) >= (self.status_interval * 60)):
+                end = time.time()
+                now = datetime.datetime.strptime(inverter.getRegisterValue('timestamp'), "%Y-%m-%d %H:%M:%S")
+                data_point = str(now.strftime("%Y%m%d")) + "," + str(now.strftime("%H:%M"))
+                parameters = {parameter.get('name'): parameter for parameter in self.pvoutput_parameters}
                 any_data = False
-                if inverter.validateLatestScrape('timestamp'):
-                    now = datetime.datetime.strptime(inverter.getRegisterValue('timestamp'), "%Y-%m-%d %H:%M:%S")
-                    data_point = str(now.strftime("%Y%m%d")) + "," + str(now.strftime("%H:%M"))
-                    for x in range(1, 13):
-                        field = 'v' + str(x)
-                        if self.collected_data.get(field):
-                            if x == 1  and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                                value = int(self.collected_data[field])
-                            elif x == 3 and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
-                                value = int(self.collected_data[field])
-                            elif x == 6 or x == 7:    # Round to 1 decimal place
-                                value = round(self.collected_data[field] / self.collected_data['count'], 1)
-                            else:                     # Getting errors when uploading decimals for power/energy so return INT
-                                value = int((self.collected_data[field] / self.collected_data['count']))
-                            data_point = data_point + "," + str(value)
-                            any_data = True
-                        else:
-                            data_point = data_point + ","
-                    self.collected_data = {}
+                for x in range(1, 13):
+                    field = 'v' + str(x)
+                    value = self.window_value(inverter, parameters[field], self.window_start, end) if field in parameters else None
+                    if value is not None:
+                        data_point = data_point + "," + str(value)
+                        any_data = True
+                    else:
+                        data_point = data_point + ","
+                logging.debug(f'PVOutput: Data point averaged from the scrape buffer: {data_point}')
+                self.window_start = end
 
                 if any_data:
                     self.batch_data.append(data_point)
+                    self.save_backlog()
                 else:
                     logging.warning(f"PVOutput: No data collected in last {(self.status_interval * 60)} minutes")
+                self.last_point = time.time()
 
-                # Max upload is 30, if over 30 then remove the oldest one
-                if self.batch_data.__len__() > 30:
-                    logging.warning(f"PVOutput: Over 30 data points scheduled to upload. max is 30 so removing oldest data point")
-                    self.batch_data.pop(0)
-
-                self.batch_count +=1
-                if self.batch_count >= self.pvoutput_config['batch_points']:
-                    if not self.batch_data.__len__() > 0:
-                        logging.warning(f"PVOutput: No data collected in last {((self.status_interval * 60) * self.batch_count)} minutes, Skipping upload")
-                        return False
-                    elif self.batch_data.__len__() >= 1:
-                        payload_data = None
-                        for data in self.batch_data:
-                            if payload_data:
-                                payload_data = payload_data + ";" + data
-                            else:
-                                payload_data = data
-
-                    payload = {}
-                    payload['data'] = payload_data
-
-                    if self.pvoutput_config['cumulative_flag'] > 0:
-                        payload['c1'] = self.pvoutput_config['cumulative_flag']
-
-                    try:
-                        logging.debug("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
-                        response = requests.post(url=self.url_addbatchstatus, headers=self.headers, params=payload, timeout=3)
-                        self.batch_count = 0
-
-                        if response.status_code != requests.codes.ok:
-                            logging.error(f"PVOutput: Upload Failed; {str(response.status_code)} Message; {str(response.text)}")
-                            logging.error("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
-                        else:
-                            self.batch_data = []
-                            self.last_publish = time.time()
-                            logging.info("PVOutput: Data uploaded")
-                    except Exception as err:
-                        logging.error(f"PVOutput: Failed to Upload")
-                        logging.debug(f"{err}")
-                else:
-                    logging.info("PVOutput: Data added to next batch upload")
+            # Upload once batch_points are waiting, after an outage this drains the backlog 30 points at a time
+            if len(self.batch_data) >= self.pvoutput_config['batch_points']:
+                self.upload()
+            elif self.batch_data:
+                logging.info("PVOutput: Data added to next batch upload")
             else:
-                logging.info(f"PVOutput: Data logged, next upload in {int(((self.status_interval) * 60) - (time.time() - self.last_publish))} secs")
+                logging.info(f"PVOutput: Data logged, next upload in {int(((self.status_interval) * 60) - (time.time() - self.last_point))} secs")
+
+            self.last_run = time.time()
+            return True
+        return False
 
-            self.last_run = time.time()
\ No newline at end of file
+    def upload(self):
+        if not self.can_request():
+            logging.info(f"PVOutput: Rate limit of {self.pvoutput_config['rate_limit']} an hour, {len(self.batch_data)} data points waiting")
+            return False
+        batch = self.batch_data[:self.max_batch]
+
+        payload = {}
+        payload['data'] = ";".join(batch)
+
+        if self.pvoutput_config['cumulative_flag'] > 0:
+            payload['c1'] = self.pvoutput_config['cumulative_flag']
+
+        try:
+            logging.debug("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
+            response = self.post(self.url_addbatchstatus, payload)
+
+            if response.status_code == requests.codes.ok:
+                self.batch_data = self.batch_data[len(batch):]
+                self.save_backlog()
+                self.last_publish = time.time()
+                logging.info(f"PVOutput: Data uploaded, {len(batch)} data points, {len(self.batch_data)} waiting")
+                return True
+            logging.error(f"PVOutput: Upload Failed; {str(response.status_code)} Message; {str(response.text)}")
+            logging.error("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
+            if response.status_code == 400:
+                # Rejected data will be rejected again, drop it so it does not hold up the rest
+                logging.warning(f"PVOutput: Dropping {len(batch)} rejected data points")
+                self.batch_data = self.batch_data[len(batch):]
+                self.save_backlog()
+        except Exception as err:
+            logging.error(f"PVOutput: Failed to Upload, {len(self.batch_data)} data points kept for later")
+            logging.debug(f"{err}")
+        self.expire_backlog()
+        return False
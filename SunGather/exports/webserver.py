@@ -1,22 +1,103 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus import PrometheusRenderer
+from stats import stats
 from threading import Thread
 from version import __version__
 from urllib.parse import parse_qs, urlparse
 
+import gzip
+import hashlib
+import historystore
 import json
 import logging
+import time
 import urllib
 
+HTML_HEAD = ("<html><head><title>SunGather</title>"
+             "<meta charset='UTF-8'><meta http-equiv='refresh' content='15'>"
+             '<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>'
+             "</head><body>")
+HTML_TAIL = "</table></body></html>"
+GZIP_MIN_SIZE = 512     # Smaller bodies are sent as is, gzip would not save anything
+
+def accepts_gzip(accept_encoding):
+    # Accept-Encoding allows gzip with a q-value above 0, named or through *. gzip;q=0 refuses it
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        qvalue = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qvalues:
+            return qvalues[name] > 0
+    return False
+
+class CachedResponse(object):
+    """
+    A page encoded once when it changes, with its gzip variant, ETags and
+    Last-Modified, so each request only has to write out bytes. The gzip
+    variant has its own ETag, as caches tell content codings apart by it.
+    """
+    def __init__(self, body, content_type, previous=None, status=200):
+        self.body = body.encode("utf-8")
+        self.content_type = content_type
+        self.status = status
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=8).hexdigest() + '"'
+        self.gzip_etag = self.etag[:-1] + '-gz"'
+        if previous and previous.etag == self.etag:
+            # Unchanged since the last scrape, keep serving the same bytes
+            self.body, self.gzip, self.modified = previous.body, previous.gzip, previous.modified
+        else:
+            self.gzip = gzip.compress(self.body, 6) if len(self.body) >= GZIP_MIN_SIZE else None
+            # Last-Modified has 1 sec resolution, a change within the same second still has to look newer
+            self.modified = max(int(time.time()), previous.modified + 1) if previous else int(time.time())
+        self.last_modified = formatdate(self.modified, usegmt=True)
+
+    def getETag(self, gzipped):
+        return self.gzip_etag if gzipped else self.etag
+
+    def notModified(self, headers):
+        # Either ETag is the same content, If-Modified-Since is only used by clients that sent no ETag
+        if headers.get('If-None-Match'):
+            etags = [etag.strip() for etag in headers['If-None-Match'].split(',')]
+            return self.etag in etags or self.gzip_etag in etags or headers['If-None-Match'].strip() == '*'
+        if headers.get('If-Modified-Since'):
+            try:
+                return parsedate_to_datetime(headers['If-Modified-Since']).timestamp() >= self.modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
 class export_webserver(object):
     html_body = "Pending Data Retrieval"
     metrics = ""
+    inverters = {}      # Rendered pages for each inverter, by name
+    renderer = PrometheusRenderer()
+    # Encoded pages served to every request: main, config, json and metrics
+    responses = {
+        'main': CachedResponse(HTML_HEAD + html_body + HTML_TAIL, "text/html; charset=utf-8"),
+        'config': CachedResponse(html_body, "text/html; charset=utf-8"),
+        'json': CachedResponse("{}", "application/json"),
+        'metrics': CachedResponse(metrics, "text/plain; version=0.0.4; charset=utf-8"),
+    }
     def __init__(self):
         False
 
     # Configure Webserver
     def configure(self, config, inverter):
+        export_webserver.renderer = PrometheusRenderer(config.get('metrics_prefix', 'sungather'))
         try:
-            self.webServer = HTTPServer(('', config.get('port',8080)), MyServer)
+            # One thread per request, a slow client or scraper does not hold up the others
+            self.webServer = ThreadingHTTPServer(('', config.get('port',8080)), MyServer)
+            self.webServer.daemon_threads = True
             self.t = Thread(target=self.webServer.serve_forever)
             self.t.daemon = True    # Make it a deamon, so if main loop ends the webserver dies
             self.t.start()
@@ -24,12 +105,14 @@ class export_webserver(object):
         except Exception as err:
             logging.error(f"Webserver: Error: {err}")
             return False
+        return self.configure_inverter(inverter)
+
+    def configure_inverter(self, inverter):
+        export_webserver.renderer.addInverter(inverter)
         pending_config = False
         config_body = f"""
-            <h3>SunGather v{__version__}</h3></p>
-            <h4>Configuration changes require a restart to take effect!</h4>    
             <form action="/config">
-            <label>Inverter Settings:</label><br>
+            <label>Inverter Settings: {inverter.getName()}</label><br>
             <table><tr><th>Option</th><th>Setting</th><th>Update?</th></tr>
             """
         for setting, value in inverter.client_config.items():
@@ -42,23 +125,30 @@ class export_webserver(object):
             config_body += f'<td><input type="checkbox" id="update_{str(setting)}" name="update_{str(setting)}" value="False"></td></tr>' 
         #config_body += f'</table><input type="submit" value="Submit"></form>'
         config_body += f'</table>Currently ReadOnly, No save function yet :(</form>'
-        export_webserver.config = config_body
+        export_webserver.inverters.setdefault(inverter.getName(), {})['config'] = config_body
+        export_webserver.config = f"""
+            <h3>SunGather v{__version__}</h3></p>
+            <h4>Configuration changes require a restart to take effect!</h4>    
+            """ + "".join(pages.get('config', '') for pages in export_webserver.inverters.values())
+        self.update('config', export_webserver.config)
 
         return True
 
+    def update(self, page, body):
+        # Swap in the newly encoded page, requests already being served keep the old one
+        previous = export_webserver.responses[page]
+        export_webserver.responses[page] = CachedResponse(body, previous.content_type, previous)
+
     def publish(self, inverter):
-        json_array={"registers":{}, "client_config":{}, "inverter_config":{}}
-        metrics_body = ""
-        main_body = f"""
-            <h3>SunGather v{__version__}</h3></p>
-            <h4>Need Help? <href a='https://github.com/bohdan-s/SunGather'>https://github.com/bohdan-s/SunGather</a></h4></p>
-            <h4>NEW HomeAssistant Add-on: <href a='https://github.com/bohdan-s/hassio-repository'>https://github.com/bohdan-s/SunGather</a></h4></p>
-            """
+        json_array={"registers":{}, "client_config":{}, "inverter_config":{}, "connection":{}}
+        main_body = f"<h4>Inverter: {inverter.getName()}</h4>"
         main_body += "<table><th>Address</th><tr><th>Register</th><th>Value</th></tr>"
         for register, value in inverter.latest_scrape.items():
-            main_body += f"<tr><td>{str(inverter.getRegisterAddress(register))}</td><td>{str(register)}</td><td>{str(value)} {str(inverter.getRegisterUnit(register))}</td></tr>"
-            metrics_body += f"{str(register)}{{address=\"{str(inverter.getRegisterAddress(register))}\", unit=\"{str(inverter.getRegisterUnit(register))}\"}} {str(value)}\n"
-            json_array["registers"][str(inverter.getRegisterAddress(register))]={"register": str(register), "value":str(value), "unit": str(inverter.getRegisterUnit(register))}
+            register_info = inverter.getRegister(register) or {}
+            address = str(register_info.get('address', '----'))
+            unit = str(register_info.get('unit', ''))
+            main_body += f"<tr><td>{address}</td><td>{str(register)}</td><td>{str(value)} {unit}</td></tr>"
+            json_array["registers"][address]={"register": str(register), "value":str(value), "unit": unit}
         main_body += f"</table><p>Total {len(inverter.latest_scrape)} registers"
 
         main_body += "</p></p><table><tr><th>Configuration</th><th>Value</th></tr>"
@@ -70,42 +160,134 @@ class export_webserver(object):
             json_array["inverter_config"][str(setting)]=str(value)
         main_body += f"</table></p>"
 
-        export_webserver.main = main_body
-        export_webserver.metrics = metrics_body
-        export_webserver.json = json.dumps(json_array)
+        json_array["connection"] = inverter.getConnectionStats()
+        main_body += "</p><table><tr><th>Connection</th><th>Value</th></tr>"
+        for stat, value in json_array["connection"].items():
+            main_body += f"<tr><td>{str(stat)}</td><td>{str(value)}</td></tr>"
+        main_body += f"</table></p>"
+
+        pages = export_webserver.inverters.setdefault(inverter.getName(), {})
+        pages['main'] = main_body
+        pages['scrape'] = inverter.latest_scrape
+        pages['scrape_time'] = inverter.getScrapeTime()
+        pages['json'] = json_array
+        pages['buffer'] = inverter.getBuffer()
+
+        export_webserver.main = f"""
+            <h3>SunGather v{__version__}</h3></p>
+            <h4>Need Help? <href a='https://github.com/bohdan-s/SunGather'>https://github.com/bohdan-s/SunGather</a></h4></p>
+            <h4>NEW HomeAssistant Add-on: <href a='https://github.com/bohdan-s/hassio-repository'>https://github.com/bohdan-s/SunGather</a></h4></p>
+            """ + "".join(pages.get('main', '') for pages in export_webserver.inverters.values())
+        export_webserver.metrics = export_webserver.renderer.render(
+            {name: pages['scrape'] for name, pages in export_webserver.inverters.items() if 'scrape' in pages},
+            {name: pages['scrape_time'] for name, pages in export_webserver.inverters.items() if 'scrape' in pages})
+        export_webserver.metrics += export_webserver.renderer.renderStats(stats)
+        if len(export_webserver.inverters) == 1:
+            export_webserver.json = json.dumps(json_array)
+        else:
+            # One document per inverter, keyed by inverter name
+            export_webserver.json = json.dumps({name: pages.get('json') for name, pages in export_webserver.inverters.items()})
+        self.update('main', HTML_HEAD + export_webserver.main + HTML_TAIL)
+        self.update('metrics', export_webserver.metrics)
+        self.update('json', export_webserver.json)
         return True
 
 class MyServer(BaseHTTPRequestHandler):
-    def do_GET(self):
+    # Keep connections open for scrapers and browsers, every response has a Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def route(self):
         if self.path.startswith('/metrics'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.metrics, "utf-8"))
+            return export_webserver.responses['metrics']
         elif self.path.startswith('/config'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.config, "utf-8"))
             parsed_data = parse_qs(urlparse(self.path).query)
             logging.info(f"{parsed_data}")
+            return export_webserver.responses['config']
         elif self.path.startswith('/json'):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.json, "utf-8"))
-        else:
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
+            return export_webserver.responses['json']
+        elif self.path.startswith('/debug/stats'):
+            # Changes all the time, encoded for each request
+            debug_stats = stats.getStats()
+            debug_stats["connection"] = {name: pages['json']['connection'] for name, pages in export_webserver.inverters.items() if 'json' in pages}
+            return CachedResponse(json.dumps(debug_stats), "application/json")
+        elif self.path.startswith('/history'):
+            return self.history(parse_qs(urlparse(self.path).query))
+        elif self.path.startswith('/window'):
+            return self.window(parse_qs(urlparse(self.path).query))
+        return export_webserver.responses['main']
+
+    def history(self, query):
+        # /history?register=load_power&inverter=name&from=-86400&to=now&step=300, times are unix secs,
+        # now, or negative secs before now. The step defaults to about 300 points over the range
+        store = historystore.getStore()
+        if store is None:
+            return CachedResponse(json.dumps({"error": "History export is not enabled"}), "application/json", status=404)
+        now = int(time.time())
+        try:
+            register = query['register'][0]
+            inverters = store.getInverters()
+            inverter = query.get('inverter', [inverters[0] if inverters else ''])[0]
+            start, end = [int(value) if value != 'now' else now
+                          for value in (query.get('from', ['-86400'])[0], query.get('to', ['now'])[0])]
+            start, end = (now + start if start < 0 else start), (now + end if end < 0 else end)
+            step = int(query.get('step', [str(max(1, (end - start) // 300))])[0])
+            if step < 1 or end <= start:
+                raise ValueError("step must be at least 1 and to after from")
+        except (KeyError, ValueError) as err:
+            return CachedResponse(json.dumps({"error": f"Bad request, register is required, from and to are secs or now, step is secs: {err}"}), "application/json", status=400)
+        history = store.query(inverter, register, start, end, step)
+        if history is None:
+            return CachedResponse(json.dumps({"error": f"No history for {register} of {inverter}"}), "application/json", status=404)
+        return CachedResponse(json.dumps(history), "application/json")
+
+    def window(self, query):
+        # /window?secs=300&register=load_power&inverter=name, min/max/mean/last/rate from the in memory
+        # scrape buffer, every buffered register if none is given
+        buffers = {name: pages['buffer'] for name, pages in export_webserver.inverters.items() if pages.get('buffer')}
+        try:
+            inverter = query.get('inverter', [next(iter(buffers), '')])[0]
+            secs = float(query.get('secs', ['300'])[0])
+            if secs <= 0:
+                raise ValueError("secs must be above 0")
+        except ValueError as err:
+            return CachedResponse(json.dumps({"error": f"Bad request, secs is a number of secs: {err}"}), "application/json", status=400)
+        buffer = buffers.get(inverter)
+        if buffer is None:
+            return CachedResponse(json.dumps({"error": f"No scrape buffer for {inverter}, is buffer_hours 0?"}), "application/json", status=404)
+        end = time.time()
+        registers = {register: buffer.window(register, end - secs, end) for register in query.get('register', buffer.getRegisters())}
+        return CachedResponse(json.dumps({"inverter": inverter, "secs": secs, "registers": registers}), "application/json")
+
+    def send_cached(self, response, head=False):
+        gzipped = bool(response.gzip) and accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        if response.notModified(self.headers):
+            self.send_response(304)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", response.getETag(gzipped))
+            self.send_header("Last-Modified", response.last_modified)
+            self.send_header("Cache-Control", "no-cache")
             self.end_headers()
-            self.wfile.write(bytes("<html><head><title>SunGather</title>", "utf-8"))
-            self.wfile.write(bytes("<meta charset='UTF-8'><meta http-equiv='refresh' content='15'>", "utf-8"))
-            self.wfile.write(bytes('<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>', "utf-8"))
-            self.wfile.write(bytes("</head>", "utf-8"))
-            self.wfile.write(bytes("<body>", "utf-8"))
-            self.wfile.write(bytes(export_webserver.main, "utf-8"))
-            self.wfile.write(bytes("</table>", "utf-8"))
-            self.wfile.write(bytes("</body></html>", "utf-8"))
+            return
+        body = response.body
+        self.send_response(response.status)
+        self.send_header("Content-type", response.content_type)
+        if gzipped:
+            body = response.gzip
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", response.getETag(gzipped))
+        self.send_header("Last-Modified", response.last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_cached(self.route())
+
+    def do_HEAD(self):
+        self.send_cached(self.route(), head=True)
 
     def do_POST(self):
         length = int(self.headers['Content-Length'])
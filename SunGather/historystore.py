@@ -0,0 +1,169 @@
+"""
+Local time series history of register values in SQLite.
+
+Scrapes are kept raw for raw_hours, then as 5 minute and hourly min, max
+and mean rollups with their own retention, so the file stays bounded and
+reads over long ranges only touch the rollups.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rollup tier: bucket secs
+TIERS = {'raw': 0, '5m': 300, '1h': 3600}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (id INTEGER PRIMARY KEY, inverter TEXT NOT NULL, register TEXT NOT NULL, unit TEXT, UNIQUE (inverter, register));
+CREATE TABLE IF NOT EXISTS raw (series INTEGER NOT NULL, ts INTEGER NOT NULL, value REAL, PRIMARY KEY (series, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_5m (series INTEGER NOT NULL, ts INTEGER NOT NULL, min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (series, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_1h (series INTEGER NOT NULL, ts INTEGER NOT NULL, min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (series, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+"""
+
+_store = None
+
+
+def getStore():
+    # The store the history export is writing, for the webserver
+    return _store
+
+
+def setStore(store):
+    global _store
+    _store = store
+
+
+class HistoryStore():
+    """
+    Samples are collected in memory and written in one transaction every
+    commit_interval secs, the rollups of completed buckets are brought up to
+    date in the same transaction.
+    """
+
+    def __init__(self, filename, raw_hours=48, rollup_5m_days=31, rollup_1h_days=730, commit_interval=60):
+        self.filename = filename
+        self.retention = {'raw': raw_hours * 3600, '5m': rollup_5m_days * 86400, '1h': rollup_1h_days * 86400}
+        self.commit_interval = commit_interval
+        self.pending = []           # (series, ts, value) waiting for the next commit
+        self.last_commit = time.monotonic()
+        self.series = {}            # (inverter, register): series id
+        self.lock = threading.Lock()
+
+        new = not os.path.exists(filename)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        if new:
+            # Space freed by retention is given back to the filesystem
+            self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        for series_id, inverter, register in self.db.execute("SELECT id, inverter, register FROM series"):
+            self.series[(inverter, register)] = series_id
+        self.db.commit()
+        logger.info(f"History: {filename}, {len(self.series)} series")
+
+    def getSeries(self, inverter, register, unit=None):
+        series_id = self.series.get((inverter, register))
+        if series_id is None:
+            self.db.execute("INSERT OR IGNORE INTO series (inverter, register, unit) VALUES (?, ?, ?)", (inverter, register, unit))
+            series_id = self.db.execute("SELECT id FROM series WHERE inverter = ? AND register = ?", (inverter, register)).fetchone()[0]
+            self.series[(inverter, register)] = series_id
+        return series_id
+
+    def append(self, inverter, timestamp, values, getUnit=None):
+        # values is {register: number}, getUnit(register) is only asked for registers new to the store
+        with self.lock:
+            for register, value in values.items():
+                series_id = self.series.get((inverter, register)) or self.getSeries(inverter, register, getUnit(register) if getUnit else None)
+                self.pending.append((series_id, timestamp, value))
+        if time.monotonic() - self.last_commit >= self.commit_interval:
+            return self.commit()
+        return True
+
+    def commit(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.last_commit = time.monotonic()
+            try:
+                with self.db:
+                    self.db.executemany("INSERT OR REPLACE INTO raw (series, ts, value) VALUES (?, ?, ?)", pending)
+                    self.rollup(int(time.time()))
+            except sqlite3.Error as err:
+                logger.error(f"History: Writing {len(pending)} samples failed: {err}")
+                return False
+        logger.debug(f"History: Committed {len(pending)} samples")
+        return True
+
+    def getMeta(self, key, default=0):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def rollup(self, now):
+        # Roll completed 5 minute buckets up from raw, completed hours up from the 5 minute tier
+        done_5m = self.getMeta('rollup_5m')
+        until_5m = now // 300 * 300
+        if until_5m > done_5m:
+            self.db.execute("""INSERT OR REPLACE INTO rollup_5m (series, ts, min, max, sum, count)
+                SELECT series, ts / 300 * 300, min(value), max(value), sum(value), count(value) FROM raw
+                WHERE ts >= ? AND ts < ? GROUP BY series, ts / 300""", (done_5m, until_5m))
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_5m', ?)", (until_5m,))
+        done_1h = self.getMeta('rollup_1h')
+        until_1h = until_5m // 3600 * 3600
+        if until_1h > done_1h:
+            self.db.execute("""INSERT OR REPLACE INTO rollup_1h (series, ts, min, max, sum, count)
+                SELECT series, ts / 3600 * 3600, min(min), max(max), sum(sum), sum(count) FROM rollup_5m
+                WHERE ts >= ? AND ts < ? GROUP BY series, ts / 3600""", (done_1h, until_1h))
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_1h', ?)", (until_1h,))
+
+        # Retention, checked once an hour
+        if now - self.getMeta('pruned') >= 3600:
+            self.db.execute("DELETE FROM raw WHERE ts < ?", (min(now - self.retention['raw'], done_5m),))
+            self.db.execute("DELETE FROM rollup_5m WHERE ts < ?", (min(now - self.retention['5m'], done_1h),))
+            self.db.execute("DELETE FROM rollup_1h WHERE ts < ?", (now - self.retention['1h'],))
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('pruned', ?)", (now,))
+            self.db.execute("PRAGMA incremental_vacuum")
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.db.close()
+
+    def query(self, inverter, register, start, end, step):
+        """
+        [[ts, min, max, mean]] per step from start, rounded down to the step, to end (unix secs), from the
+        coarsest tier that still has the resolution and covers start. Each
+        request uses its own read only connection, so it does not wait on writes.
+        """
+        now = int(time.time())
+        start = start // step * step
+        if step < 300 and start >= now - self.retention['raw']:
+            tier = 'raw'
+        elif step < 3600 and start >= now - self.retention['5m']:
+            tier = '5m'
+        else:
+            tier = '1h'
+        db = sqlite3.connect(f"file:{self.filename}?mode=ro", uri=True)
+        try:
+            row = db.execute("SELECT id, unit FROM series WHERE inverter = ? AND register = ?", (inverter, register)).fetchone()
+            if not row:
+                return None
+            series_id, unit = row
+            if tier == 'raw':
+                rows = db.execute("""SELECT ts / ? * ?, min(value), max(value), avg(value) FROM raw
+                    WHERE series = ? AND ts >= ? AND ts <= ? GROUP BY ts / ? ORDER BY 1""", (step, step, series_id, start, end, step))
+            else:
+                rows = db.execute(f"""SELECT ts / ? * ?, min(min), max(max), sum(sum) / sum(count) FROM rollup_{tier}
+                    WHERE series = ? AND ts >= ? AND ts <= ? GROUP BY ts / ? ORDER BY 1""", (step, step, series_id, start, end, step))
+            points = [[ts, minimum, maximum, round(mean, 6) if mean is not None else None] for ts, minimum, maximum, mean in rows]
+        finally:
+            db.close()
+        return {'inverter': inverter, 'register': register, 'unit': unit, 'tier': tier, 'step': step,
+                'from': start, 'to': end, 'points': points}
+
+    def getInverters(self):
+        return sorted({inverter for inverter, register in list(self.series)})
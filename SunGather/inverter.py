@@ -3,14 +3,37 @@ API for a Sungrow inverter.
 Primarily for running SunGather as a Home Assistant integration.
 """
 
+import copy
 import logging
+import os
+import threading
+import time
+import yaml
 from datetime import datetime
-from SungrowModbusTcpClient import SungrowModbusTcpClient
+from asyncmodbus import AsyncModbusTcpClient
+from connection import ConnectionManager, SungrowSessionTcpClient, socket_alive
+from decoder import BlockDecoder, build_decode_table, register_width
+from replay import RegisterRecorder, ReplayClient
+from ringbuffer import ScrapeBuffer
+from scanplan import POLL_TIERS, plan_scan_ranges, register_tier
+from stats import stats
+from suntimes import is_daylight, next_sunrise
 from SungrowModbusWebClient import SungrowModbusWebClient
 from pymodbus.client.sync import ModbusTcpClient
 
 logger = logging.getLogger(__name__)
 
+# Scrapes in a row an address has to be refused with a Modbus exception before it is treated as unreadable
+QUIRK_STRIKES = 2
+
+# Registers read while idle, enough to see the inverter start again. The PV power register and idle_registers are added
+HEARTBEAT_REGISTERS = ('start_stop', 'work_state_1', 'year', 'month', 'day', 'hour', 'minute', 'second')
+# Secs around sunrise and sunset counted as daylight
+SUN_MARGIN = 1800
+
+# Inverters configured together share one identity file
+IDENTITY_LOCK = threading.Lock()
+
 
 class SungrowInverter():
     
@@ -25,21 +48,84 @@ class SungrowInverter():
         self.inverter_config = {
             "slave":            config_inverter.get('slave'),
             "model":            config_inverter.get('model'),
+            "serial_number":    config_inverter.get('serial_number'),
             "level":            config_inverter.get('level'),
             "use_local_time":   config_inverter.get('use_local_time'),
             "smart_meter":      config_inverter.get('smart_meter'),
             "connection":       config_inverter.get('connection')
         }
+        self.name = config_inverter.get('name')
+        self.scan_interval = config_inverter.get('scan_interval', 30)
+        # Seconds between reads of each poll tier, static registers are read once
+        self.poll_intervals = {
+            "fast":     min(config_inverter.get('scan_interval_fast') or self.scan_interval, self.scan_interval),
+            "normal":   self.scan_interval,
+            "slow":     max(config_inverter.get('scan_interval_slow') or 300, self.scan_interval),
+        }
+        self.poll_tiers = {}        # Tier: registers
+        self.tier_ranges = {}       # Due tiers: scan plan covering just those tiers
+        self.scrape_count = 0
+        self.scrape_time = None     # Unix secs (UTC) the last scrape started, from this machine's clock
+        self.tier_last_scrape = {}  # Scrape number each tier was last read on
+        # While stopped or without PV, just the heartbeat registers are read every idle_scan_interval secs
+        self.idle_config = {
+            "scan_interval":    config_inverter.get('idle_scan_interval') or 0,
+            "after":            config_inverter.get('idle_after', 3),
+            "pv_register":      config_inverter.get('idle_pv_register', 'total_dc_power'),
+            "pv_power":         config_inverter.get('idle_pv_power', 0),
+            "registers":        config_inverter.get('idle_registers') or [],
+            "latitude":         config_inverter.get('latitude'),
+            "longitude":        config_inverter.get('longitude'),
+        }
+        self.idle = False
+        self.idle_count = 0         # Idle scrapes in a row
+        self.heartbeat_ranges = None
+        # Number of reads kept in flight by the asyncio client, 0 uses the pymodbus clients
+        self.pipeline_depth = config_inverter.get('pipeline_depth') or 0
         self.client = None
-
-        self.registers = [[]]
-        self.registers.pop()  # Remove null value from list
+        # Raw register blocks are appended to record_file, the replay connection reads them back
+        self.recorder = RegisterRecorder(config_inverter['record_file']) if config_inverter.get('record_file') else None
+        self.replay_config = {
+            "filename": config_inverter.get('replay_file'),
+            "speed":    config_inverter.get('replay_speed', 1),
+            "loop":     config_inverter.get('replay_loop', True),
+        }
+        # Recent numeric values for windowed min/max/mean, sized once the scan interval is known
+        self.buffer_hours = config_inverter.get('buffer_hours', 1)
+        self.buffer = None
+        self.connection = ConnectionManager(
+            keep_alive=config_inverter.get('keep_alive', True),
+            idle_close=config_inverter.get('idle_close', 0),
+            backoff_max=config_inverter.get('backoff_max', 300))
+
+        # Registers, decode table and scan plan shared read only with every inverter of the same model, level and smart_meter
+        self.view = None
+        self.registers = ()
         self.registers_custom = [{'name': 'export_to_grid', 'unit': 'W', 'address': 'vr001'}, 
                                  {'name': 'import_from_grid', 'unit': 'W', 'address': 'vr002'}, 
                                  {'name': 'run_state', 'address': 'vr003'}, 
                                  {'name': 'timestamp', 'address': 'vr004'}]
         self.register_ranges = [[]]
         self.register_ranges.pop()  # Remove null value from list
+        self.decode_table = {}
+        self.block_decoders = {}
+        self.build_register_catalog()
+
+        # Addresses this model/firmware will not return, learned by bisecting failed ranges
+        self.cache_folder = config_inverter.get('cache_folder') or ''
+        self.quirks_file = os.path.join(self.cache_folder, 'quirks.yaml')
+        self.scan_config = {}
+        self.unreadable = {'read': set(), 'hold': set()}
+        self.unreadable_firmware = None
+        self.quirk_strikes = {}
+        self.read_error = None      # Why the last read failed: 'modbus' when the inverter refused it, 'connection' otherwise
+
+        # Model, serial and firmware detected on an earlier start, keyed by host and slave
+        self.identity_cache = config_inverter.get('identity_cache', True)
+        self.identity_file = os.path.join(self.cache_folder, 'identity.yaml')
+        self.identity_pending = False   # Model or serial came from the identity file, not checked yet
+        self.identity_checked = False
+        self.registersfile = None
 
         self.latest_scrape = {}
 
@@ -47,41 +133,73 @@ class SungrowInverter():
 
         # Alan: changed to return client return value
         if self.client:
-            try:
-                return self.client.connect()
-            except:
-                return False
+            return self.handshake()
 
         if self.inverter_config['connection'] == "http":
             self.client_config['port'] = '8082'
             self.client = SungrowModbusWebClient.SungrowModbusWebClient(
                 **self.client_config)
+        elif self.inverter_config['connection'] == "replay":
+            try:
+                self.client = ReplayClient(**self.replay_config)
+            except Exception as err:
+                logger.error(f"Replay: Can not load {self.replay_config['filename']}: {err}")
+                return False
+        elif self.inverter_config['connection'] in ("modbus", "sungrow") and self.pipeline_depth:
+            self.client = AsyncModbusTcpClient(
+                slave=self.inverter_config['slave'], encrypted=self.inverter_config['connection'] == "sungrow",
+                depth=self.pipeline_depth, **self.client_config)
         elif self.inverter_config['connection'] == "sungrow":
-            self.client = SungrowModbusTcpClient.SungrowModbusTcpClient(
+            self.client = SungrowSessionTcpClient(
                 **self.client_config)
         elif self.inverter_config['connection'] == "modbus":
             self.client = ModbusTcpClient(**self.client_config)
         else:
             logger.warning(
-                f"Inverter: Unknown connection type {self.inverter_config['connection']}, Valid options are http, sungrow or modbus")
+                f"Inverter: Unknown connection type {self.inverter_config['connection']}, Valid options are http, sungrow, modbus or replay")
             return False
         logger.info("Connection: " + str(self.client))
 
+        return self.handshake()
+
+    def handshake(self):
         # Alan: changed to return actual client return value
+        handshake_start = time.perf_counter()
         try:
-            return self.client.connect()
+            connected = self.client.connect()
         except:
-            return False
+            connected = False
+        if connected:
+            self.connection.connected(time.perf_counter() - handshake_start)
+            stats.increment('connects', inverter=self.getName())
+            logger.info(f"Connection: Connected in {round(self.connection.handshake_last * 1000)} ms, {self.connection.connects} connects")
+        else:
+            backoff = self.connection.failed()
+            stats.increment('connect_failures', inverter=self.getName())
+            logger.info(f"Connection: Failed {self.connection.consecutive_failures} times, next attempt in {round(backoff)} secs")
+        return connected
+
+    def probeConnection(self):
+        # The asyncio client checks its own socket, pymodbus clients expose theirs, http has nothing to probe
+        if hasattr(self.client, 'probe'):
+            return self.client.probe()
+        if hasattr(self.client, 'socket'):
+            return socket_alive(self.client.socket)
+        return True
 
     def checkConnection(self):
         logger.debug("Checking Modbus Connection")
+        if self.client and self.client.is_socket_open() and self.probeConnection():
+            logger.debug("Modbus, Session is still connected")
+            self.connection.reused()
+            return True
+        if not self.connection.canConnect():
+            logger.info(f"Connection: Waiting {round(self.connection.getRetryIn())} secs before reconnecting")
+            return False
         if self.client:
-            if self.client.is_socket_open():
-                logger.debug("Modbus, Session is still connected")
-                return True
-            else:
-                logger.info(f'Modbus, Connecting new session')
-                return self.connect()
+            logger.info(f'Modbus, Connecting new session')
+            self.close()
+            return self.connect()
         else:
             logger.info(
                 f'Modbus client is not connected, attempting to reconnect')
@@ -103,88 +221,111 @@ class SungrowInverter():
         self.client = None
 
     def configure_registers(self, registersfile):
+        # registersfile is a RegisterCache, the compiled registers file
+        self.view = None
+        self.registersfile = registersfile
+        identity = self.load_identity()
+        detected = False
         # Check model so we can load only valid registers
         if self.inverter_config.get('model'):
             logger.info(
                 f"Bypassing Model Detection, Using config: {self.inverter_config.get('model')}")
+        elif identity.get('model'):
+            # Detected on an earlier start, checked again after the first scrape
+            self.inverter_config['model'] = identity['model']
+            self.identity_pending = True
+            logger.info(f"Using Cached Model: {identity['model']}")
         else:
             # Load just the register to detect model, then we can load the rest of registers based on returned model
-            for register in registersfile['registers'][0]['read']:
-                if register.get('name') == "device_type_code":
-                    register['type'] = "read"
-                    self.registers.append(register)
-                    # Needs to be address -1
-                    if self.load_registers(register['type'], register['address'] - 1, 1):
-                        if isinstance(self.latest_scrape.get('device_type_code'), int):
-                            logger.warning(
-                                f"Unknown Type Code Detected: {self.latest_scrape.get('device_type_code')}")
-                        else:
-                            self.inverter_config['model'] = self.latest_scrape.get(
-                                'device_type_code')
-                            logger.info(
-                                f"Detected Model: {self.inverter_config.get('model')}")
-                    else:
-                        logger.info(
-                            f'Model detection failed, please set model in config.py')
-                    self.registers.pop()
-                    break
-
-        # Load register list based on name and value after checking model
-        for register in registersfile['registers'][0]['read']:
-            if register.get('level', 3) <= self.inverter_config.get('level') or self.inverter_config.get('level') == 3:
-                register['type'] = "read"
-                register.pop('level')
-                if register.get('smart_meter') and self.inverter_config.get('smart_meter'):
-                    register.pop('models')
-                    self.registers.append(register)
-                elif register.get('models') and not self.inverter_config.get('level') == 3:
-                    for supported_model in register.get('models'):
-                        if supported_model == self.inverter_config.get('model'):
-                            register.pop('models')
-                            self.registers.append(register)
-                else:
-                    self.registers.append(register)
-
-        for register in registersfile['registers'][1]['hold']:
-            if register.get('level', 3) <= self.inverter_config.get('level') or self.inverter_config.get('level') == 3:
-                register['type'] = "hold"
-                register.pop('level')
-                if register.get('smart_meter') and self.inverter_config.get('smart_meter'):
-                    register.pop('models')
-                    self.registers.append(register)
-                elif register.get('models') and not self.inverter_config.get('level', 1) == 3:
-                    for supported_model in register.get('models'):
-                        if supported_model == self.inverter_config.get('model'):
-                            register.pop('models')
-                            self.registers.append(register)
-                else:
-                    self.registers.append(register)
-
-        # Load register list based om name and value after checking model
-        for register_range in registersfile['scan'][0]['read']:
-            register_range_used = False
-            register_range['type'] = "read"
-            for register in self.registers:
-                if register.get("type") == register_range.get("type"):
-                    if register.get('address') >= register_range.get("start") and register.get('address') <= (register_range.get("start") + register_range.get("range")):
-                        register_range_used = True
-                        continue
-            if register_range_used:
-                self.register_ranges.append(register_range)
-
-        for register_range in registersfile['scan'][1]['hold']:
-            register_range_used = False
-            register_range['type'] = "hold"
-            for register in self.registers:
-                if register.get("type") == register_range.get("type"):
-                    if register.get('address') >= register_range.get("start") and register.get('address') <= (register_range.get("start") + register_range.get("range")):
-                        register_range_used = True
-                        continue
-            if register_range_used:
-                self.register_ranges.append(register_range)
+            device_type_code = self.read_identity_register("device_type_code")
+            if device_type_code is None:
+                logger.info(
+                    f'Model detection failed, please set model in config.py')
+            elif isinstance(device_type_code, int):
+                logger.warning(
+                    f"Unknown Type Code Detected: {device_type_code}")
+            else:
+                self.inverter_config['model'] = device_type_code
+                detected = True
+                logger.info(
+                    f"Detected Model: {self.inverter_config.get('model')}")
+
+        if self.inverter_config.get('serial_number'):
+            logger.info(
+                f"Bypassing Serial Detection, Using config: {self.inverter_config.get('serial_number')}")
+        elif identity.get('serial_number'):
+            self.inverter_config['serial_number'] = identity['serial_number']
+            self.identity_pending = True
+            logger.info(f"Using Cached Serial: {identity['serial_number']}")
+        else:
+            # Load just the register to detect serial number, it is needed before the first scrape (MQTT topics)
+            serial_number = self.read_identity_register("serial_number")
+            if serial_number:
+                self.inverter_config['serial_number'] = serial_number
+                detected = True
+                logger.info(
+                    f"Detected Serial: {self.inverter_config.get('serial_number')}")
+            else:
+                logger.info(
+                    f'Serial detection failed, please set serial in config.yaml')
+        if detected:
+            self.save_identity()
+
+        # Registers and scan plan for this model, level and smart meter, compiled once and cached
+        self.view = registersfile.getView(self.inverter_config.get('model'), self.inverter_config.get('level'),
+                                          self.inverter_config.get('smart_meter'), self.inverter_config['connection'])
+        self.registers = self.view.registers
+        self.scan_config = self.view.getScanConfig()
+
+        self.load_quirks()
+        if self.unreadable['read'] or self.unreadable['hold']:
+            # Plan the fewest reads that cover the registers, around the addresses this inverter will not return
+            self.register_ranges = plan_scan_ranges(
+                self.registers, self.scan_config, self.inverter_config['connection'], self.unreadable)
+        else:
+            self.register_ranges = self.view.ranges[self.inverter_config['connection']]
+        self.schedule_tiers()
+
+        self.build_decode_table()
+        self.build_register_catalog()
         return True
 
+    def build_decode_table(self):
+        # Index registers by type then address, with datarange and datatype handling resolved
+        # once here, so load_registers only has to do a dict lookup per returned word
+        if self.view is not None:
+            self.decode_table = self.view.decode_table
+            self.block_decoders = self.view.block_decoders
+        else:
+            self.decode_table = build_decode_table(self.registers)
+            self.block_decoders = {}
+
+        # Precompute the decode plan for every range we scrape
+        for register_range in self.register_ranges:
+            self.getBlockDecoder(register_range['type'], int(register_range['start']), int(register_range['range']))
+
+    def getBlockDecoder(self, register_type, start, count):
+        block_decoder = self.block_decoders.get((register_type, start, count))
+        if block_decoder is None:
+            block_decoder = BlockDecoder(self.decode_table.get(register_type, {}), start, count)
+            self.block_decoders[(register_type, start, count)] = block_decoder
+        return block_decoder
+
     def load_registers(self, register_type, start, count=100):
+        if isinstance(self.client, AsyncModbusTcpClient):
+            logger.debug(f'load_registers: {register_type}, {start}:{count}')
+            words = self.client.read_blocks([(register_type, start, count)])[0]
+            self.read_error = self.getBlockError(register_type, start, count, words)
+            if self.recorder:
+                self.recorder.record(register_type, start, count, words)
+            for round_trip in self.client.getRoundTrips():
+                stats.observe('modbus_read_seconds', round_trip, inverter=self.getName())
+            if words is None:
+                stats.increment('modbus_read_errors', inverter=self.getName())
+            return self.decode_registers(register_type, start, count, words)
+
+        read_start = time.perf_counter()
+        self.read_error = 'connection'
         try:
             logger.debug(f'load_registers: {register_type}, {start}:{count}')
             if register_type == "read":
@@ -199,115 +340,364 @@ class SungrowInverter():
             logger.warning(
                 f"No data returned for {register_type}, {start}:{count}")
             logger.debug(f"{str(err)}')")
+            stats.increment('modbus_read_errors', inverter=self.getName())
+            if self.recorder:
+                self.recorder.record(register_type, start, count, None)
             return False
-
-        if rr.isError():
-            logger.warning(f"Modbus connection failed")
-            logger.debug(f"{rr}")
+        stats.observe('modbus_read_seconds', time.perf_counter() - read_start, inverter=self.getName())
+
+        if rr.isError() or not hasattr(rr, 'registers'):
+            if getattr(rr, 'exception_code', None):
+                # The inverter answered, it just will not return these addresses
+                self.read_error = 'modbus'
+                logger.warning(f"No data returned for {register_type}, {start}:{count}")
+                logger.debug(f"{rr}")
+            elif rr.isError():
+                logger.warning(f"Modbus connection failed")
+                logger.debug(f"{rr}")
+            else:
+                logger.warning("No registers returned")
+            stats.increment('modbus_read_errors', inverter=self.getName())
+            if self.recorder:
+                self.recorder.record(register_type, start, count, None)
             return False
 
-        if not hasattr(rr, 'registers'):
-            logger.warning("No registers returned")
+        if self.recorder:
+            self.recorder.record(register_type, start, count, rr.registers)
+
+        self.read_error = None
+        return self.decode_registers(register_type, start, count, rr.registers)
+
+    def getBlockError(self, register_type, start, count, words):
+        # read_error for a block from the asyncio client
+        if words is not None:
+            return None
+        return 'modbus' if (register_type, start, count) in self.client.getExceptions() else 'connection'
+
+    def decode_registers(self, register_type, start, count, words):
+        if words is None:
             return False
 
-        if len(rr.registers) != count:
+        if len(words) != count:
             logger.warning(
-                f"Mismatched number of registers read {len(rr.registers)} != {count}")
+                f"Mismatched number of registers read {len(words)} != {count}")
+            self.read_error = 'connection'
             return False
 
-        for num in range(0, count):
-            run = int(start) + num + 1
-
-            for register in self.registers:
-                if register_type == register['type'] and register['address'] == run:
-                    register_name = register['name']
-
-                    register_value = rr.registers[num]
-
-                    # Convert unsigned to signed
-                    # If xFF / xFFFF then change to 0, looks better when logging / graphing
-                    if register.get('datatype') == "U16":
-                        if register_value == 0xFFFF:
-                            register_value = 0
-                        if register.get('mask'):
-                            # Filter the value through the mask.
-                            register_value = 1 if register_value & register.get(
-                                'mask') != 0 else 0
-                    elif register.get('datatype') == "S16":
-                        if register_value == 0xFFFF or register_value == 0x7FFF:
-                            register_value = 0
-                        if register_value >= 32767:  # Anything greater than 32767 is a negative for 16bit
-                            register_value = (register_value - 65536)
-                    elif register.get('datatype') == "U32":
-                        u32_value = rr.registers[num+1]
-                        if register_value == 0xFFFF and u32_value == 0xFFFF:
-                            register_value = 0
-                        else:
-                            register_value = (
-                                register_value + u32_value * 0x10000)
-                    elif register.get('datatype') == "S32":
-                        u32_value = rr.registers[num+1]
-                        if register_value == 0xFFFF and (u32_value == 0xFFFF or u32_value == 0x7FFF):
-                            register_value = 0
-                        elif u32_value >= 32767:  # Anything greater than 32767 is a negative
-                            register_value = (
-                                register_value + u32_value * 0x10000 - 0xffffffff - 1)
-                        else:
-                            register_value = register_value + u32_value * 0x10000
-
-                    # We convert a system response to a human value
-                    if register.get('datarange'):
-                        for value in register.get('datarange'):
-                            if value['response'] == rr.registers[num]:
-                                register_value = value['value']
-
-                    if register.get('accuracy'):
-                        register_value = round(
-                            register_value * register.get('accuracy'), 2)
-
-                    # Set the final register value with adjustments above included
-                    self.latest_scrape[register_name] = register_value
+        # Set the final register values with adjustments included
+        with stats.timer('decode_seconds', inverter=self.getName()):
+            for register_name, register_value in self.getBlockDecoder(register_type, start, count).decode(words):
+                self.latest_scrape[register_name] = register_value
 
         return True
 
-    def validateRegister(self, check_register):
+    def read_identity_register(self, name):
+        # Read device_type_code or serial_number on its own, through a decode table of just that register
+        register = self.registersfile.getDetectRegister(name)
+        if not register:
+            return None
+        decode_table, block_decoders = self.decode_table, self.block_decoders
+        self.decode_table, self.block_decoders = build_decode_table((register,)), {}
+        try:
+            # Needs to be address -1
+            loaded = self.load_registers(register['type'], register['address'] - 1, register_width(register))
+        finally:
+            self.decode_table, self.block_decoders = decode_table, block_decoders
+        return self.latest_scrape.get(name) if loaded else None
+
+    def getIdentityKey(self):
+        return f"{self.client_config.get('host')}:{self.inverter_config.get('slave')}"
+
+    def load_identity(self):
+        # Identity file is {host:slave: {model, serial_number, firmware, device_type_code}}
+        if not self.identity_cache:
+            return {}
+        try:
+            with open(self.identity_file, encoding="utf-8") as identity_file:
+                identities = yaml.safe_load(identity_file) or {}
+        except FileNotFoundError:
+            return {}
+        except Exception as err:
+            logger.warning(f"Failed loading identity: {self.identity_file} {err}")
+            return {}
+        return identities.get(self.getIdentityKey()) or {}
+
+    def save_identity(self):
+        if not self.identity_cache:
+            return
+        with IDENTITY_LOCK:
+            self.write_identity()
+
+    def write_identity(self):
+        identity = {
+            'model': self.inverter_config.get('model'),
+            'serial_number': self.inverter_config.get('serial_number'),
+            'firmware': self.getFirmware(),
+            'device_type_code': self.latest_scrape.get('device_type_code', self.inverter_config.get('model')),
+        }
+        try:
+            with open(self.identity_file, encoding="utf-8") as identity_file:
+                identities = yaml.safe_load(identity_file) or {}
+        except Exception:
+            identities = {}
+        if identities.get(self.getIdentityKey()) == identity:
+            return
+        identities[self.getIdentityKey()] = identity
+        try:
+            with open(self.identity_file, 'w', encoding="utf-8") as identity_file:
+                yaml.safe_dump(identities, identity_file)
+        except Exception as err:
+            logger.warning(f"Failed saving identity: {self.identity_file} {err}")
+
+    def check_identity(self):
+        # After the first scrape, read the model and serial that came from the identity file,
+        # a different inverter at the same address is configured again
+        self.identity_checked = True
+        if self.identity_pending:
+            self.identity_pending = False
+            model = self.read_identity_register("device_type_code")
+            serial_number = self.read_identity_register("serial_number")
+            self.latest_scrape['device_type_code'] = self.inverter_config['model']
+            if isinstance(model, str) and model != self.inverter_config['model']:
+                logger.warning(f"Cached model {self.inverter_config['model']} is out of date, {self.getIdentityKey()} is a {model}. Configuring registers again")
+                self.inverter_config['model'] = model
+                self.latest_scrape['device_type_code'] = model
+                self.configure_registers(self.registersfile)
+                self.tier_last_scrape = {}
+            if serial_number and serial_number != self.inverter_config['serial_number']:
+                logger.warning(f"Cached serial {self.inverter_config['serial_number']} is out of date, now {serial_number}. Restart so exports use the new serial")
+                self.inverter_config['serial_number'] = serial_number
+            if model is None and serial_number is None:
+                logger.info(f"Could not check the cached identity, trying again next scrape")
+                self.identity_pending = True
+                self.identity_checked = False
+                return
+        self.save_identity()
+
+    def getFirmware(self):
+        versions = [str(self.latest_scrape.get(name)) for name in ('arm_software_version', 'dsp_software_version')
+                    if self.latest_scrape.get(name) is not None]
+        return '/'.join(versions) or 'unknown'
+
+    def load_quirks(self):
+        # Quirks file is {model: {firmware: {read: [addresses], hold: [addresses]}}}
+        firmware = self.getFirmware()
+        self.unreadable_firmware = firmware
+        self.unreadable = {'read': set(), 'hold': set()}
+        try:
+            with open(self.quirks_file, encoding="utf-8") as quirks_file:
+                quirks = yaml.safe_load(quirks_file) or {}
+        except FileNotFoundError:
+            return
+        except Exception as err:
+            logger.warning(f"Failed loading quirks: {self.quirks_file} {err}")
+            return
+        model_quirks = quirks.get(self.inverter_config.get('model')) or {}
+        if firmware == 'unknown' and len(model_quirks) == 1:
+            # Not scraped yet, assume the only firmware we have seen on this model
+            firmware = next(iter(model_quirks))
+            self.unreadable_firmware = firmware
+        learned = model_quirks.get(firmware) or {}
+        for register_type in self.unreadable:
+            self.unreadable[register_type].update(learned.get(register_type, []))
+        if learned:
+            logger.info(f"Loaded quirks for {self.inverter_config.get('model')} firmware {firmware}: {learned}")
+
+    def save_quirks(self):
+        if self.unreadable_firmware == 'unknown':
+            # Without arm/dsp versions (level 0 and 1) a firmware update could not be told apart, so keep them in memory
+            logger.info(f"Not saving quirks for {self.inverter_config.get('model')}, firmware is unknown")
+            return
+        try:
+            with open(self.quirks_file, encoding="utf-8") as quirks_file:
+                quirks = yaml.safe_load(quirks_file) or {}
+        except Exception:
+            quirks = {}
+        quirks.setdefault(self.inverter_config.get('model'), {})[self.unreadable_firmware] = {
+            register_type: sorted(addresses) for register_type, addresses in self.unreadable.items() if addresses}
+        try:
+            with open(self.quirks_file, 'w', encoding="utf-8") as quirks_file:
+                yaml.safe_dump(quirks, quirks_file)
+        except Exception as err:
+            logger.warning(f"Failed saving quirks: {self.quirks_file} {err}")
+
+    def plan_ranges(self):
+        self.register_ranges = plan_scan_ranges(
+            self.registers, self.scan_config, self.inverter_config['connection'], self.unreadable)
+        self.schedule_tiers()
+        self.build_decode_table()
+
+    def schedule_tiers(self):
+        # Scrape as often as the fastest tier in use, slower tiers are read every few scrapes
+        self.poll_tiers = {}
+        self.tier_ranges = {}
+        self.heartbeat_ranges = None
         for register in self.registers:
-            if check_register == register['name']:
-                return True
+            self.poll_tiers.setdefault(register_tier(register, self.scan_config), []).append(register)
+        self.scan_interval = min([self.poll_intervals[tier] for tier in self.poll_intervals if tier in self.poll_tiers],
+                                 default=self.poll_intervals['normal'])
+        logger.info(f"Scan plan: {len(self.register_ranges)} reads for {len(self.registers)} registers, " +
+                    ", ".join(f"{tier} {len(self.poll_tiers[tier])}" for tier in POLL_TIERS if tier in self.poll_tiers) +
+                    f", scraping every {self.scan_interval} secs")
+
+    def getTierRanges(self, due_tiers):
+        # Ranges covering the registers of the due tiers, planned once for each combination of tiers
+        due_tiers = tuple(tier for tier in POLL_TIERS if tier in due_tiers and tier in self.poll_tiers)
+        if len(due_tiers) == len(self.poll_tiers):
+            return self.register_ranges
+        if due_tiers not in self.tier_ranges:
+            registers = [register for tier in due_tiers for register in self.poll_tiers[tier]]
+            self.tier_ranges[due_tiers] = plan_scan_ranges(
+                registers, self.scan_config, self.inverter_config['connection'], self.unreadable)
+            logger.info(f"Scan plan: {len(self.tier_ranges[due_tiers])} reads for {', '.join(due_tiers)} registers")
+        return self.tier_ranges[due_tiers]
+
+    def getHeartbeatRanges(self):
+        # Ranges covering just the heartbeat registers, every range if none of them are configured
+        if self.heartbeat_ranges is None:
+            names = set(HEARTBEAT_REGISTERS) | set(self.idle_config['registers']) | {self.idle_config['pv_register']}
+            registers = [register for register in self.registers if register['name'] in names]
+            if registers:
+                self.heartbeat_ranges = plan_scan_ranges(
+                    registers, self.scan_config, self.inverter_config['connection'], self.unreadable)
+            else:
+                self.heartbeat_ranges = self.register_ranges
+            logger.info(f"Scan plan: {len(self.heartbeat_ranges)} reads for {len(registers)} heartbeat registers")
+        return self.heartbeat_ranges
+
+    def update_idle(self):
+        # Slow down to the heartbeat while stopped or without PV, back to full speed as soon as either changes.
+        # At night (with latitude and longitude) one idle scrape is enough, otherwise idle_after in a row
+        if not self.idle_config['scan_interval'] or self.inverter_config['connection'] == "replay":
+            return
+        # run_state is only OFF by default without start_stop and work_state_1, so needs both read
+        stopped = self.latest_scrape.get('run_state') == "OFF" and \
+            'start_stop' in self.latest_scrape and 'work_state_1' in self.latest_scrape
+        pv_power = self.latest_scrape.get(self.idle_config['pv_register'])
+        if stopped or (isinstance(pv_power, (int, float)) and pv_power <= self.idle_config['pv_power']):
+            self.idle_count += 1
+            if not self.idle and (self.idle_count >= self.idle_config['after'] or self.isNight()):
+                self.idle = True
+                logger.info(f"Idle: {self.getName()} is {'stopped' if stopped else 'not producing'}, "
+                            f"polling {len(self.getHeartbeatRanges())} heartbeat reads every {self.getScanDelay()} secs")
+        else:
+            self.idle_count = 0
+            if self.idle:
+                self.idle = False
+                # Everything but the static registers is read again on the next scrape
+                self.tier_last_scrape = {tier: scrape for tier, scrape in self.tier_last_scrape.items() if tier == 'static'}
+                logger.info(f"Idle: {self.getName()} is producing again, polling every {self.scan_interval} secs")
+
+    def getDueTiers(self):
+        # Tiers that have not been read yet, or are due on this scrape
+        due_tiers = []
+        for tier in POLL_TIERS:
+            last_scrape = self.tier_last_scrape.get(tier)
+            if last_scrape is None:
+                due_tiers.append(tier)
+            elif tier != 'static' and self.scrape_count - last_scrape >= max(1, round(self.poll_intervals[tier] / self.scan_interval)):
+                due_tiers.append(tier)
+        return due_tiers
+
+    def bisect_range(self, register_type, spans):
+        # Read the (first, last) address spans as one block, splitting in half while the inverter
+        # refuses it until the spans that can not be read on their own are isolated.
+        # None if a read was lost, nothing can be learned over a failing connection
+        first = spans[0][0]
+        last = max(span[1] for span in spans)
+        if self.load_registers(register_type, first - 1, last - first + 1):
+            self.clear_strikes(register_type, first, last)
+            return []
+        if self.read_error != 'modbus':
+            return None
+        if len(spans) == 1:
+            return spans
+        return self.bisect_halves(register_type, spans)
+
+    def bisect_halves(self, register_type, spans):
+        middle = len(spans) // 2
+        low = self.bisect_range(register_type, spans[:middle])
+        if low is None:
+            return None
+        high = self.bisect_range(register_type, spans[middle:])
+        if high is None:
+            return None
+        return low + high
+
+    def clear_strikes(self, register_type, first, last):
+        # Addresses read fine, earlier refusals were not a quirk
+        if self.quirk_strikes:
+            for key in [key for key in self.quirk_strikes if key[0] == register_type and first <= key[1] <= last]:
+                del self.quirk_strikes[key]
+
+    def heal_ranges(self, failed_ranges):
+        # Bisect ranges the inverter refused, an address refused QUIRK_STRIKES scrapes in a row is
+        # left out of the scan plan and saved to the quirks file for next time
+        learned = False
+        for register_range in failed_ranges:
+            register_type = register_range['type']
+            start = int(register_range['start'])
+            end = start + int(register_range['range'])
+            spans = set()
+            for address, registers in self.decode_table.get(register_type, {}).items():
+                if start < address <= end:
+                    for register in registers:
+                        spans.add((address, address + register['width'] - 1))
+            spans = sorted(spans)
+            unreadable = self.bisect_halves(register_type, spans) if len(spans) > 1 else spans
+            if unreadable is None:
+                logger.info(f"Scraping: Lost the connection while bisecting {register_type} {start}:{end - start}, trying again next scrape")
+                break
+            for first, last in unreadable:
+                self.quirk_strikes[(register_type, first)] = self.quirk_strikes.get((register_type, first), 0) + 1
+                if self.quirk_strikes[(register_type, first)] >= QUIRK_STRIKES:
+                    logger.warning(f"Scraping: {register_type} {first}:{last - first + 1} can not be read, skipping it from now on")
+                    self.unreadable[register_type].update(range(first, last + 1))
+                    learned = True
+        if learned:
+            self.save_quirks()
+            self.plan_ranges()
+
+    def build_register_catalog(self):
+        # Name keyed view of registers and registers_custom, first definition of a name wins
+        if self.view is not None:
+            self.register_catalog = self.view.getCatalog(self.registers_custom)
+            return
+        self.register_catalog = {}
+        for register in self.registers:
+            self.register_catalog.setdefault(register['name'], register)
         for register in self.registers_custom:
-            if check_register == register['name']:
-                return True
-        return False
+            self.register_catalog.setdefault(register['name'], register)
+
+    def getRegister(self, check_register):
+        return self.register_catalog.get(check_register)
+
+    def validateRegister(self, check_register):
+        return check_register in self.register_catalog
 
     def getRegisterAddress(self, check_register):
-        for register in self.registers:
-            if check_register == register['name']:
-                return register['address']
-        for register in self.registers_custom:
-            if check_register == register['name']:
-                return register['address']
-        return '----'
+        register = self.register_catalog.get(check_register)
+        return register['address'] if register else '----'
 
     def getRegisterUnit(self, check_register):
-        for register in self.registers:
-            if check_register == register['name']:
-                return register.get('unit', '')
-        for register in self.registers_custom:
-            if check_register == register['name']:
-                return register.get('unit', '')
-        return ''
+        register = self.register_catalog.get(check_register)
+        return register.get('unit', '') if register else ''
 
     def validateLatestScrape(self, check_register):
-        for register, value in self.latest_scrape.items():
-            if check_register == register:
-                return True
-        return False
+        return check_register in self.latest_scrape
 
     def getRegisterValue(self, check_register):
-        for register, value in self.latest_scrape.items():
-            if check_register == register:
-                return value
-        return False
+        return self.latest_scrape.get(check_register, False)
+
+    def getWindow(self, check_register, secs, end=None):
+        # min, max, mean, last and rate of a register over the last secs, None if not buffered
+        if self.buffer is None:
+            return None
+        end = end or time.time()
+        return self.buffer.window(check_register, end - secs, end)
+
+    def getBuffer(self):
+        return self.buffer
 
     def getHost(self):
         return self.client_config['host']
@@ -318,8 +708,63 @@ class SungrowInverter():
         else:
             return self.inverter_config['model']
 
+    def getSerialNumber(self):
+        return self.inverter_config['serial_number']
+
+    def getScanDelay(self):
+        # Secs from one scrape to the next, a replay is paced by its recording instead
+        if self.inverter_config['connection'] == "replay":
+            return 0
+        if self.idle:
+            # Heartbeat, but never sleep through sunrise, and in daylight no longer than the slow tier
+            delay = self.idle_config['scan_interval']
+            if self.hasSunTimes():
+                if not self.isNight():
+                    return min(delay, self.poll_intervals['slow'])
+                sunrise = next_sunrise(self.idle_config['latitude'], self.idle_config['longitude'], time.time())
+                if sunrise is not None:
+                    delay = max(self.scan_interval, min(delay, sunrise - time.time()))
+            return delay
+        return self.scan_interval
+
+    def hasSunTimes(self):
+        return self.idle_config['latitude'] is not None and self.idle_config['longitude'] is not None
+
+    def isNight(self):
+        # None without latitude and longitude
+        if not self.hasSunTimes():
+            return None
+        return not is_daylight(self.idle_config['latitude'], self.idle_config['longitude'], time.time(), SUN_MARGIN)
+
+    def isIdle(self):
+        return self.idle
+
+    def getCacheFolder(self):
+        # Where state that should survive a restart is kept, set with -d
+        return self.cache_folder
+
+    def getSnapshot(self):
+        # Copy with its own latest_scrape and a view of the buffer as it is now, exports can publish it while the next scrape runs
+        snapshot = copy.copy(self)
+        snapshot.latest_scrape = dict(self.latest_scrape)
+        if self.buffer is not None:
+            snapshot.buffer = self.buffer.getView()
+        return snapshot
+
+    def getScrapeTime(self):
+        # When the values were read, unlike the timestamp register it does not depend on the inverter clock or timezone
+        return self.scrape_time
+
+    def getConnectionStats(self):
+        return self.connection.getStats()
+
+    def getName(self):
+        # Identifies this inverter to exports when more than one is polled
+        return self.name or self.inverter_config['serial_number'] or self.client_config['host']
+
     def scrape(self):
-        scrape_start = datetime.now()
+        scrape_start = time.perf_counter()
+        self.scrape_time = time.time()
 
         # Clear previous inverter values, keep the model and run state
         if self.latest_scrape.get("run_state"):
@@ -333,15 +778,45 @@ class SungrowInverter():
         self.latest_scrape['device_type_code'] = self.inverter_config['model']
         self.latest_scrape["run_state"] = run_state
 
-        # Load all registers from inverer
+        # Load the registers of every tier that is due, the rest keep their last value
+        self.scrape_count += 1
+        if self.idle:
+            due_tiers = []
+            register_ranges = self.getHeartbeatRanges()
+            logger.debug(f"Scraping heartbeat registers")
+        else:
+            due_tiers = self.getDueTiers()
+            register_ranges = self.getTierRanges(due_tiers)
+            logger.debug(f"Scraping tiers: {', '.join(due_tiers)}")
         load_registers_count = 0
         load_registers_failed = 0
-        for range in self.register_ranges:
+        failed_ranges = []
+        if isinstance(self.client, AsyncModbusTcpClient):
+            # Send every range at once, the client keeps pipeline_depth reads in flight
+            blocks = self.client.read_blocks(
+                [(range.get('type'), int(range.get('start')), int(range.get('range'))) for range in register_ranges])
+            for round_trip in self.client.getRoundTrips():
+                stats.observe('modbus_read_seconds', round_trip, inverter=self.getName())
+            stats.increment('modbus_read_errors', blocks.count(None), inverter=self.getName())
+            if self.recorder:
+                for range, words in zip(register_ranges, blocks):
+                    self.recorder.record(range.get('type'), int(range.get('start')), int(range.get('range')), words)
+        for range_index, range in enumerate(register_ranges):
             load_registers_count += 1
             logger.debug(
                 f'Scraping: {range.get("type")}, {range.get("start")}:{range.get("range")}')
-            if not self.load_registers(range.get('type'), int(range.get('start')), int(range.get('range'))):
+            if isinstance(self.client, AsyncModbusTcpClient):
+                self.read_error = self.getBlockError(range.get('type'), int(range.get('start')), int(range.get('range')), blocks[range_index])
+                loaded = self.decode_registers(range.get('type'), int(range.get('start')), int(range.get('range')), blocks[range_index])
+            else:
+                loaded = self.load_registers(range.get('type'), int(range.get('start')), int(range.get('range')))
+            if loaded:
+                self.clear_strikes(range.get('type'), int(range.get('start')) + 1, int(range.get('start')) + int(range.get('range')))
+            else:
                 load_registers_failed += 1
+                # Only ranges the inverter refused can be healed, lost reads say nothing about the addresses
+                if self.read_error == 'modbus':
+                    failed_ranges.append(range)
         if load_registers_failed == load_registers_count:
             # If every scrape fails, disconnect the client
             logger.warning('All scrapes failed. Disconnecting client.')
@@ -350,10 +825,43 @@ class SungrowInverter():
         if load_registers_failed > 0:
             logger.info(
                 f'Scraping: {load_registers_failed}/{load_registers_count} registers failed to scrape')
+        if failed_ranges:
+            # The inverter is answering, so find out which addresses it will not return
+            self.heal_ranges(failed_ranges)
+        for tier in due_tiers:
+            self.tier_last_scrape[tier] = self.scrape_count
+
+        # Firmware is only known once scraped, switch to the quirks learned for it
+        if self.getFirmware() != self.unreadable_firmware:
+            unreadable = self.unreadable
+            self.load_quirks()
+            if self.unreadable != unreadable:
+                self.plan_ranges()
 
         # Leave connection open, see if helps resolve the connection issues
         # self.close()
 
+        self.derive_registers()
+        self.update_idle()
+        if not self.identity_checked:
+            self.check_identity()
+        if self.recorder:
+            self.recorder.flush()
+        if self.buffer_hours:
+            if self.buffer is None:
+                self.buffer = ScrapeBuffer(self.buffer_hours * 3600 / max(self.scan_interval, 1) + 1)
+                logger.debug(f"Buffer: {self.buffer.capacity} scrapes, {self.buffer_hours} hours at {self.scan_interval} secs")
+            self.buffer.append(time.time(), self.latest_scrape)
+
+        scrape_time = time.perf_counter() - scrape_start
+        stats.observe('scrape_seconds', scrape_time, inverter=self.getName())
+        logger.info(
+            f'Inverter: Successfully scraped in {scrape_time:.3f} secs')
+
+        return True
+
+    def derive_registers(self):
+        # Registers SunGather adds or rewrites from the scraped values
         # Alan: Backwards compatability for hybrid inverters
         if not self.validateRegister('export_power'):
             self.latest_scrape['export_power'] = self.latest_scrape.get('export_power_hybrid', 0)
@@ -400,7 +908,7 @@ class SungrowInverter():
         # to help with graphing.
         try:
             if self.latest_scrape.get('start_stop'):
-                if self.latest_scrape.get('start_stop', False) == 'Start' and self.latest_scrape.get('work_state_1', False).contains('Run'):
+                if self.latest_scrape.get('start_stop', False) == 'Start' and 'Run' in str(self.latest_scrape.get('work_state_1', '')):
                     self.latest_scrape["run_state"] = "ON"
                 else:
                     self.latest_scrape["run_state"] = "OFF"
@@ -414,12 +922,13 @@ class SungrowInverter():
                 "%Y-%m-%d %H:%M:%S")
             logger.debug(
                 f'Using Local Computer Time: {self.latest_scrape.get("timestamp")}')
-            del self.latest_scrape["year"]
-            del self.latest_scrape["month"]
-            del self.latest_scrape["day"]
-            del self.latest_scrape["hour"]
-            del self.latest_scrape["minute"]
-            del self.latest_scrape["second"]
+            # The clock registers are only there on scrapes that read them
+            self.latest_scrape.pop("year", None)
+            self.latest_scrape.pop("month", None)
+            self.latest_scrape.pop("day", None)
+            self.latest_scrape.pop("hour", None)
+            self.latest_scrape.pop("minute", None)
+            self.latest_scrape.pop("second", None)
         else:
             try:
                 self.latest_scrape["timestamp"] = "%s-%s-%s %s:%02d:%02d" % (
@@ -432,12 +941,12 @@ class SungrowInverter():
                 )
                 logger.debug(
                     f'Using Inverter Time: {self.latest_scrape.get("timestamp")}')
-                del self.latest_scrape["year"]
-                del self.latest_scrape["month"]
-                del self.latest_scrape["day"]
-                del self.latest_scrape["hour"]
-                del self.latest_scrape["minute"]
-                del self.latest_scrape["second"]
+                self.latest_scrape.pop("year", None)
+                self.latest_scrape.pop("month", None)
+                self.latest_scrape.pop("day", None)
+                self.latest_scrape.pop("hour", None)
+                self.latest_scrape.pop("minute", None)
+                self.latest_scrape.pop("second", None)
             except Exception:
                 pass
 
@@ -452,17 +961,11 @@ class SungrowInverter():
                     self.latest_scrape["alarm_time_minute"],
                     self.latest_scrape["alarm_time_second"],
                 )
-            del self.latest_scrape["alarm_time_year"]
-            del self.latest_scrape["alarm_time_month"]
-            del self.latest_scrape["alarm_time_day"]
-            del self.latest_scrape["alarm_time_hour"]
-            del self.latest_scrape["alarm_time_minute"]
-            del self.latest_scrape["alarm_time_second"]
+            self.latest_scrape.pop("alarm_time_year", None)
+            self.latest_scrape.pop("alarm_time_month", None)
+            self.latest_scrape.pop("alarm_time_day", None)
+            self.latest_scrape.pop("alarm_time_hour", None)
+            self.latest_scrape.pop("alarm_time_minute", None)
+            self.latest_scrape.pop("alarm_time_second", None)
         except Exception:
             pass
-
-        scrape_end = datetime.now()
-        logger.info(
-            f'Inverter: Successfully scraped in {(scrape_end - scrape_start).seconds}.{(scrape_end - scrape_start).microseconds} secs')
-
-        return True
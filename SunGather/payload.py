@@ -0,0 +1,113 @@
+"""
+Payload encoder for exports that send the whole scrape as one message.
+
+The static part (inverter and client config) is serialized once when the
+encoder is built, each publish only serializes the register values.
+"""
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_FORMATS = ('json', 'msgpack', 'cbor')
+
+
+def dumps_json(value):
+    """ JSON as bytes, using orjson when it is installed """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass    # Non str keys or types orjson does not know, json.dumps copes
+    return json.dumps(value).encode('utf-8')
+
+
+class PayloadEncoder():
+    """
+    json encodes {config..., registers...} like the original message, later
+    keys win so a register named like a config setting replaces it.
+
+    msgpack and cbor encode [schema version, [values]] with the values in
+    schema order, the schema (field names, units and the static config) is
+    published once on its own retained topic and grows when new registers
+    show up.
+    """
+
+    def __init__(self, static, payload_format='json', units=None):
+        if payload_format not in PAYLOAD_FORMATS:
+            logger.warning(f"Payload: Unknown format {payload_format}, Valid options are {', '.join(PAYLOAD_FORMATS)}")
+            payload_format = 'json'
+        if (payload_format == 'msgpack' and msgpack is None) or (payload_format == 'cbor' and cbor2 is None):
+            logger.error(f"Payload: {payload_format} is not installed, pip install {'cbor2' if payload_format == 'cbor' else payload_format}. Using json")
+            payload_format = 'json'
+        self.format = payload_format
+        self.static = dict(static)
+        self.units = units or {}
+        self.buffer = bytearray()
+
+        # Static JSON without its braces, spliced in front of the registers. Keyed by the
+        # settings a register replaces, e.g. serial_number once it has been scraped
+        self.static_json = {}
+
+        self.fields = []
+        self.field_set = set()
+        self.schema_version = 0
+
+    def encode(self, registers):
+        if self.format == 'json':
+            return self.encode_json(registers)
+        values = self.encode_values(registers)
+        if self.format == 'msgpack':
+            return msgpack.packb([self.schema_version, values])
+        return cbor2.dumps([self.schema_version, values])
+
+    def encode_json(self, registers):
+        replaced = tuple(setting for setting in self.static if setting in registers)
+        static_json = self.static_json.get(replaced)
+        if static_json is None:
+            static_json = dumps_json({setting: value for setting, value in self.static.items() if setting not in replaced})[1:-1]
+            self.static_json[replaced] = static_json
+        body = dumps_json(registers)
+        self.buffer.clear()
+        self.buffer += b'{'
+        self.buffer += static_json
+        if static_json and len(body) > 2:
+            self.buffer += b','
+        self.buffer += body[1:]
+        return bytes(self.buffer)
+
+    def encode_values(self, registers):
+        # New registers are appended to the schema, existing ones keep their position
+        if len(registers) != len(self.fields) or not self.field_set.issuperset(registers):
+            for register in registers:
+                if register not in self.field_set:
+                    self.fields.append(register)
+                    self.field_set.add(register)
+                    self.schema_version += 1
+        return [registers.get(field) for field in self.fields]
+
+    def getSchema(self):
+        return {
+            "format": self.format,
+            "version": self.schema_version,
+            "payload": "[version, [values]]",
+            "fields": [{"name": field, "unit": self.units.get(field, '')} for field in self.fields],
+            "config": self.static,
+        }
+
+    def encodeSchema(self):
+        return dumps_json(self.getSchema())
@@ -0,0 +1,201 @@
+"""
+Prometheus text exposition (version 0.0.4) of the latest scrapes.
+
+Registers are classified once, from the register file, into metric families:
+counters for lifetime totals, state sets for registers with a datarange,
+info metrics for text and gauges for everything else. Names, HELP/TYPE lines
+and label sets are built ahead of time, rendering a scrape only fills in the
+values.
+"""
+
+import calendar
+import math
+import re
+import time
+
+# Registers with more states than this are an info metric with the state as a label
+STATESET_MAX = 16
+COUNTER_UNITS = ('kWh', 'Wh', 'MWh', 'h')
+# Registers added by SunGather that are not in the register file
+DERIVED_STATES = {'run_state': ['ON', 'OFF']}
+TIMESTAMPS = ('timestamp', 'alarm_timestamp')
+# Timezones are whole quarter hours, the rest of the difference to the scrape time is the inverter clock being off
+TIMEZONE_STEP = 900
+
+
+def metric_name(name):
+    name = re.sub(r'[^a-zA-Z0-9_:]', '_', str(name))
+    return name if not name[:1].isdigit() else '_' + name
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def help_value(value):
+    # HELP text only escapes backslash and newline, a quote is sent as it is
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def clock_seconds(value):
+    # Inverter clock string as unix secs as if it were UTC, None if it is not a time
+    try:
+        return calendar.timegm(time.strptime(str(value), "%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        return None
+
+
+def clock_offset(scrape, scrape_time):
+    # Timezone of the inverter clock (timestamp register) in secs east of UTC, from when it was scraped
+    inverter_clock = clock_seconds(scrape.get('timestamp'))
+    if inverter_clock is None or not scrape_time:
+        return None
+    return round((inverter_clock - scrape_time) / TIMEZONE_STEP) * TIMEZONE_STEP
+
+
+def sample_value(value):
+    # Prometheus only takes numbers, None when there is nothing to send
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return None
+
+
+class MetricFamily():
+    """ One metric name, with its header and the sample prefix for each inverter """
+
+    def __init__(self, prefix, register, register_info=None):
+        register_info = register_info or {}
+        self.register = register
+        unit = register_info.get('unit') or ''
+        states = [value['value'] for value in register_info.get('datarange') or []] or DERIVED_STATES.get(register)
+        help_text = register + (f" in {unit}" if unit else '')
+        if register_info.get('address') and not str(register_info['address']).startswith('vr'):
+            help_text += f", {register_info.get('type', 'read')} register {register_info['address']}"
+
+        self.states = None
+        if register in TIMESTAMPS:
+            self.kind = 'timestamp'
+            self.name = f"{prefix}_{metric_name(register)}_seconds"
+            help_text += ", unix time"
+        elif register_info.get('datatype') == 'UTF-8' or (states and len(states) > STATESET_MAX):
+            self.kind = 'info'
+            self.name = f"{prefix}_{metric_name(register)}_info"
+        elif states:
+            self.kind = 'stateset'
+            self.name = f"{prefix}_{metric_name(register)}"
+            self.states = list(dict.fromkeys(str(state) for state in states))
+        elif register.startswith('total_') and unit in COUNTER_UNITS:
+            self.kind = 'counter'
+            self.name = f"{prefix}_{metric_name(register)}_total"
+        else:
+            self.kind = 'gauge'
+            self.name = f"{prefix}_{metric_name(register)}"
+        metric_type = 'counter' if self.kind == 'counter' else 'gauge'
+        self.header = f"# HELP {self.name} {help_value(help_text)}\n# TYPE {self.name} {metric_type}\n"
+        self.prefixes = {}      # Inverter name: sample prefix, or {state: prefix} for state sets
+        self.labels = {}        # Inverter name: label set
+
+    def compile(self, inverter_name, labels):
+        self.labels[inverter_name] = labels
+        if self.kind == 'stateset':
+            self.prefixes[inverter_name] = {state: f'{self.name}{{{labels},state="{label_value(state)}"}} ' for state in self.states}
+        elif self.kind == 'info':
+            self.prefixes[inverter_name] = f'{self.name}{{{labels},value="'
+        else:
+            self.prefixes[inverter_name] = f'{self.name}{{{labels}}} '
+
+    def samples(self, inverter_name, value, scrape_time=None, offset=None):
+        prefix = self.prefixes[inverter_name]
+        if self.kind == 'stateset':
+            samples = [line + ('1\n' if state == str(value) else '0\n') for state, line in prefix.items()]
+            if str(value) not in prefix and value is not None:
+                # A code the register file does not know, still show it
+                samples.append(f'{self.name}{{{self.labels[inverter_name]},state="{label_value(value)}"}} 1\n')
+            return samples
+        if self.kind == 'info':
+            return [f'{prefix}{label_value(value)}"}} 1\n']
+        if self.kind == 'timestamp':
+            # Clock strings have no timezone, timestamp is when it was scraped, alarm_timestamp is moved by the inverter's timezone
+            if self.register == 'timestamp':
+                value = int(scrape_time) if scrape_time else None
+            else:
+                value = clock_seconds(value)
+                value = value - offset if value is not None and offset is not None else None
+        value = sample_value(value)
+        return [prefix + value + '\n'] if value is not None else []
+
+
+class PrometheusRenderer():
+    """ Renders the scrapes of every inverter, each family once with a sample per inverter """
+
+    def __init__(self, prefix='sungather'):
+        self.prefix = metric_name(prefix)
+        self.families = {}      # Register: MetricFamily, in register file order
+        self.labels = {}        # Inverter name: label set identifying the inverter
+
+    def addInverter(self, inverter):
+        self.labels[inverter.getName()] = (f'inverter="{label_value(inverter.getName())}",'
+                                           f'model="{label_value(inverter.getInverterModel())}",'
+                                           f'serial="{label_value(inverter.getSerialNumber())}"')
+        for register, register_info in inverter.register_catalog.items():
+            self.getFamily(register, register_info)
+        for family in self.families.values():
+            family.compile(inverter.getName(), self.labels[inverter.getName()])
+
+    def getFamily(self, register, register_info=None):
+        family = self.families.get(register)
+        if family is None:
+            family = self.families[register] = MetricFamily(self.prefix, register, register_info)
+            for inverter_name, labels in self.labels.items():
+                family.compile(inverter_name, labels)
+        return family
+
+    def render(self, scrapes, scrape_times=None):
+        # scrapes is {inverter name: latest_scrape}, scrape_times {inverter name: unix secs it was scraped}
+        scrape_times = scrape_times or {}
+        for scrape in scrapes.values():
+            for register in scrape:
+                if register not in self.families:
+                    self.getFamily(register)
+        offsets = {inverter_name: clock_offset(scrape, scrape_times.get(inverter_name)) for inverter_name, scrape in scrapes.items()}
+        lines = []
+        for register, family in self.families.items():
+            samples = []
+            for inverter_name, scrape in scrapes.items():
+                if register in scrape and inverter_name in family.prefixes:
+                    samples += family.samples(inverter_name, scrape[register], scrape_times.get(inverter_name), offsets[inverter_name])
+            if samples:
+                lines.append(family.header)
+                lines += samples
+        return ''.join(lines)
+
+    def renderStats(self, registry):
+        # Timings and counters from stats.StatsRegistry, histograms in seconds
+        lines = []
+        for name, series in registry.metrics.items():
+            if not series:
+                continue
+            kind, help_text = registry.describe(name)
+            family = f"{self.prefix}_{metric_name(name)}" + ('_total' if kind == 'counter' else '')
+            lines.append(f"# HELP {family} {help_value(help_text)}\n# TYPE {family} {kind}\n")
+            for key, metric in list(series.items()):
+                labels = ','.join(f'{metric_name(label)}="{label_value(value)}"' for label, value in key)
+                if kind == 'counter':
+                    lines.append(f"{family}{{{labels}}} {metric.getStats()}\n")
+                    continue
+                histogram = metric.getStats()
+                separator = ',' if labels else ''
+                for bound, count in histogram['buckets'].items():
+                    lines.append(f'{family}_bucket{{{labels}{separator}le="{bound}"}} {count}\n')
+                lines.append(f'{family}_bucket{{{labels}{separator}le="+Inf"}} {histogram["count"]}\n')
+                lines.append(f"{family}_sum{{{labels}}} {histogram['sum']}\n")
+                lines.append(f"{family}_count{{{labels}}} {histogram['count']}\n")
+        return ''.join(lines)
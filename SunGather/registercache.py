@@ -0,0 +1,247 @@
+"""
+Compiled, read only catalog of the registers file.
+
+The registers file is turned once into a RegisterCatalog: every register
+frozen, with its type set, and indexed by model. A RegisterView holds the
+registers, scan plans and decode tables for one model, level and
+smart_meter, and every inverter with that combination shares it, nothing is
+copied per inverter.
+
+Parsing registers-sungrow.yaml is most of the startup time on small boards,
+so the catalog, the selections and scan plans are pickled to the cache
+folder, keyed by a hash of the registers file. The YAML is only parsed, with
+the C loader when PyYAML has it, when the cache is missing or stale.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from types import MappingProxyType
+
+import yaml
+
+from decoder import build_decode_table
+from scanplan import plan_scan_ranges
+
+logger = logging.getLogger(__name__)
+
+# Bump when the compiled layout or the selection rules change, older caches are then rebuilt
+CACHE_FORMAT = 2
+
+try:
+    YAML_LOADER = yaml.CSafeLoader
+except AttributeError:
+    YAML_LOADER = yaml.SafeLoader
+
+
+def freeze(value):
+    # Read only copy, dicts become mappingproxy and lists tuples
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def compile_registersfile(registersfile):
+    # Plain, picklable form of the registers file, read then hold registers with their type set
+    registers = []
+    for register_type, section in (('read', 0), ('hold', 1)):
+        for register in registersfile['registers'][section][register_type]:
+            registers.append(dict(register, type=register_type))
+    return {'version': registersfile.get('version', 'UNKNOWN'), 'registers': registers, 'scan': registersfile['scan']}
+
+
+def select_scan_ranges(scan, registers):
+    # Hand written scan ranges from older register files, just the ranges holding a selected register
+    register_ranges = []
+    for register_type, section in (('read', 0), ('hold', 1)):
+        for register_range in scan[section][register_type]:
+            for register in registers:
+                if register.get('type') == register_type and \
+                        register_range['start'] <= register['address'] <= register_range['start'] + register_range['range']:
+                    register_ranges.append(dict(register_range, type=register_type))
+                    break
+    return register_ranges
+
+
+class RegisterView():
+    """
+    Registers of one model, level and smart_meter, with the scan plan of
+    each connection and the decode table. Shared read only by the inverters
+    using it, block decoders are added as new ranges are read.
+    """
+
+    def __init__(self, registers, scan):
+        self.registers = registers              # Tuple of read only registers
+        self.scan = scan
+        self.ranges = {}                        # Connection: tuple of read only ranges
+        self.decode_table = build_decode_table(registers)
+        self.block_decoders = {}                # (type, start, count): BlockDecoder
+        self.catalogs = {}                      # Names of extra registers: name keyed catalog
+        self.lock = threading.Lock()
+
+    def getScanConfig(self):
+        # Planner settings, older register files have hand written ranges instead
+        return self.scan if isinstance(self.scan, MappingProxyType) else {}
+
+    def getRanges(self, connection, compile_ranges):
+        with self.lock:
+            if connection not in self.ranges:
+                self.ranges[connection] = freeze(compile_ranges())
+            return self.ranges[connection]
+
+    def getCatalog(self, extra_registers):
+        # Name keyed registers then extra_registers, the first definition of a name wins
+        key = tuple(register['name'] for register in extra_registers)
+        with self.lock:
+            if key not in self.catalogs:
+                catalog = {}
+                for register in self.registers + tuple(extra_registers):
+                    catalog.setdefault(register['name'], register)
+                self.catalogs[key] = MappingProxyType(catalog)
+            return self.catalogs[key]
+
+
+class RegisterCatalog():
+    """
+    Every register of the registers file, read only and indexed by model.
+    Registers without models are read by every model, level 3 reads every
+    register and smart_meter registers are read by any model with a smart meter.
+    """
+
+    def __init__(self, compiled):
+        self.version = compiled['version']
+        self.registers = freeze(compiled['registers'])
+        self.scan = freeze(compiled['scan'])
+        self.names = {}
+        self.unrestricted = []                  # Positions of registers without models
+        self.smart_meter = []                   # Positions of smart_meter registers
+        self.by_model = {}                      # Model: positions of its registers
+        for position, register in enumerate(self.registers):
+            self.names.setdefault(register['name'], register)
+            if register.get('smart_meter'):
+                self.smart_meter.append(position)
+            if register.get('models'):
+                for model in register['models']:
+                    self.by_model.setdefault(model, []).append(position)
+            else:
+                self.unrestricted.append(position)
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def getRegister(self, name):
+        # First read or hold register with the name, as used for model and serial detection
+        return self.names.get(name)
+
+    def select(self, model, level, smart_meter):
+        # Positions of the registers read by the model at this level
+        if level == 3:
+            return tuple(range(len(self.registers)))
+        positions = set(self.unrestricted) | set(self.by_model.get(model, ()))
+        if smart_meter:
+            positions.update(self.smart_meter)
+        return tuple(position for position in sorted(positions) if self.registers[position].get('level', 3) <= level)
+
+    def getView(self, model, level, smart_meter, positions=None):
+        key = (model, level, bool(smart_meter))
+        with self.lock:
+            view = self.views.get(key)
+            if view is None:
+                if positions is None:
+                    positions = self.select(model, level, smart_meter)
+                view = self.views[key] = RegisterView(tuple(self.registers[position] for position in positions), self.scan)
+            return view
+
+
+class RegisterCache():
+    """
+    The RegisterCatalog of a registers file, from the cache file when it was
+    compiled from the same file, otherwise from the YAML. registersfile skips
+    the file and the cache, for an already parsed registers file.
+    """
+
+    def __init__(self, filename=None, cache_folder=None, registersfile=None):
+        self.filename = filename
+        self.cache_file = None
+        self.lock = threading.Lock()
+        self.compiled = None
+        if registersfile is not None:
+            self.compiled = dict(compile_registersfile(registersfile), format=CACHE_FORMAT, hash=None, views={}, ranges={})
+        else:
+            with open(filename, 'rb') as registers:
+                file_hash = hashlib.blake2b(registers.read(), digest_size=16).hexdigest()
+            if cache_folder is not None:
+                self.cache_file = os.path.join(cache_folder, f"{os.path.splitext(os.path.basename(filename))[0]}.cache")
+                self.loadCache(file_hash)
+            if self.compiled is None:
+                parse_start = time.perf_counter()
+                with open(filename, encoding="utf-8") as registers:
+                    registersfile = yaml.load(registers, Loader=YAML_LOADER)
+                logger.info(f"Registers: Parsed {filename} with {YAML_LOADER.__name__} in {time.perf_counter() - parse_start:.3f} secs")
+                self.compiled = dict(compile_registersfile(registersfile), format=CACHE_FORMAT, hash=file_hash, views={}, ranges={})
+                self.saveCache()
+        self.catalog = RegisterCatalog(self.compiled)
+
+    def loadCache(self, file_hash):
+        load_start = time.perf_counter()
+        try:
+            with open(self.cache_file, 'rb') as cache:
+                compiled = pickle.load(cache)
+        except FileNotFoundError:
+            logger.info(f"Registers: No compiled cache at {self.cache_file} yet")
+            return
+        except Exception as err:
+            logger.warning(f"Registers: Ignoring unreadable cache {self.cache_file}: {err}")
+            return
+        if not isinstance(compiled, dict) or compiled.get('format') != CACHE_FORMAT or compiled.get('hash') != file_hash:
+            logger.info(f"Registers: {self.filename} changed since the cache was compiled, rebuilding")
+            return
+        self.compiled = compiled
+        logger.info(f"Registers: Loaded {len(compiled['views'])} compiled selections from {self.cache_file} in {time.perf_counter() - load_start:.3f} secs")
+
+    def saveCache(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file + '.tmp', 'wb') as cache:
+                pickle.dump(self.compiled, cache, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except Exception as err:
+            logger.warning(f"Registers: Can not save cache {self.cache_file}: {err}")
+
+    def getVersion(self):
+        return self.catalog.version
+
+    def getDetectRegister(self, name):
+        # device_type_code or serial_number, to read before configuring
+        return self.catalog.getRegister(name)
+
+    def getView(self, model, level, smart_meter, connection):
+        """
+        The shared RegisterView for a model, level and smart_meter, with the
+        scan plan for connection compiled. Selections and plans new to the
+        cache are saved to it.
+        """
+        key = (model, level, bool(smart_meter))
+        with self.lock:
+            changed = key not in self.compiled['views']
+            if changed:
+                self.compiled['views'][key] = self.catalog.select(model, level, smart_meter)
+            view = self.catalog.getView(model, level, smart_meter, self.compiled['views'][key])
+
+            def compile_ranges():
+                if isinstance(view.scan, tuple):
+                    return select_scan_ranges(view.scan, view.registers)
+                return plan_scan_ranges(view.registers, view.scan, connection)
+            if (key, connection) not in self.compiled['ranges']:
+                self.compiled['ranges'][(key, connection)] = compile_ranges()
+                changed = True
+            view.getRanges(connection, lambda: self.compiled['ranges'][(key, connection)])
+            if changed:
+                logger.info(f"Registers: Compiled {len(view.registers)} registers for {model} level {level}, {connection}")
+                self.saveCache()
+            return view
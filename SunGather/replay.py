@@ -0,0 +1,154 @@
+"""
+Record raw register blocks to a file, and replay them in place of an inverter.
+
+A recording starts with MAGIC, then one record per range read: a RECORD
+header (unix time, flags, start, count) followed by count big endian words.
+Reads that failed are kept with the FAILED flag and no words, so a replay
+fails the same reads.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SGREC1\n'
+RECORD = struct.Struct('>dBHH')     # time, flags, start, count
+HOLD = 0x01                         # Holding register, otherwise input register
+FAILED = 0x02
+
+
+def read_recording(filename):
+    """ Returns [(time, register type, start, count, words or None)] """
+    records = []
+    with open(filename, 'rb') as recording:
+        if recording.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a SunGather recording")
+        data = recording.read()
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        timestamp, flags, start, count = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        words = None
+        if not flags & FAILED:
+            if offset + count * 2 > len(data):
+                logger.warning(f"Replay: {filename} ends part way through a record, ignored")
+                break
+            words = list(struct.unpack_from(f'>{count}H', data, offset))
+            offset += count * 2
+        records.append((timestamp, "hold" if flags & HOLD else "read", start, count, words))
+    return records
+
+
+class RegisterRecorder():
+    """ Appends every range read, the file is flushed after each scrape """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        self.file = open(filename, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.records = 0
+        logger.info(f"Recording: Appending register blocks to {filename}")
+
+    def record(self, register_type, start, count, words):
+        flags = (HOLD if register_type == "hold" else 0) | (FAILED if words is None else 0)
+        with self.lock:
+            self.file.write(RECORD.pack(time.time(), flags, start, count))
+            if words is not None:
+                self.file.write(struct.pack(f'>{len(words)}H', *words))
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplayResponse():
+    def __init__(self, registers=None):
+        self.registers = registers
+
+    def isError(self):
+        return self.registers is None
+
+
+class ReplayClient():
+    """
+    Answers reads from a recording, in place of a pymodbus client.
+
+    Each read is answered by the next recorded block for the same range.
+    speed 1 waits for the recorded time of each block, so scrapes come as
+    often as when they were recorded, 10 is ten times as fast and 0 does not
+    wait at all. With loop the recording starts over at the end.
+    """
+
+    def __init__(self, filename, speed=1, loop=True, **kwargs):
+        self.filename = filename
+        self.speed = speed or 0
+        self.loop = loop
+        self.records = read_recording(filename)
+        if not self.records:
+            raise ValueError(f"{filename} has no register blocks")
+        self.cursor = 0
+        self.replays = 0
+        self.started = None             # time.monotonic() the recording was started from
+        logger.info(f"Replay: {len(self.records)} register blocks from {filename}, speed {self.speed or 'as fast as possible'}")
+
+    def __str__(self):
+        return f"ReplayClient({self.filename}, speed={self.speed or 'max'})"
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def is_socket_open(self):
+        return True
+
+    def read_input_registers(self, start, count, unit=None):
+        return self.read("read", start, count)
+
+    def read_holding_registers(self, start, count, unit=None):
+        return self.read("hold", start, count)
+
+    def find(self, register_type, start, count):
+        for index in range(self.cursor, len(self.records)):
+            if self.records[index][1:4] == (register_type, start, count):
+                return index
+        if not self.loop:
+            return None
+        # Start over, the range might only be recorded before the cursor
+        for index in range(0, min(self.cursor, len(self.records))):
+            if self.records[index][1:4] == (register_type, start, count):
+                self.replays += 1
+                self.started = None
+                logger.info(f"Replay: Reached the end of {self.filename}, starting over ({self.replays})")
+                return index
+        return None
+
+    def read(self, register_type, start, count):
+        index = self.find(register_type, start, count)
+        if index is None:
+            logger.warning(f"Replay: No recorded block for {register_type}, {start}:{count}")
+            return ReplayResponse()
+        timestamp, _, _, _, words = self.records[index]
+        self.cursor = index + 1
+
+        if self.started is None:
+            self.started = time.monotonic() - (timestamp - self.records[0][0]) / self.speed if self.speed else time.monotonic()
+        if self.speed:
+            # Wait until the block is due at the recorded pace
+            delay = self.started + (timestamp - self.records[0][0]) / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return ReplayResponse(words)
@@ -0,0 +1,137 @@
+"""
+Fixed size in memory window of recent scrapes.
+
+Every numeric register gets one preallocated array of doubles with a slot per
+scrape, plus one array of scrape times. The oldest slot is overwritten once
+the window is full, so memory does not grow, and a register missing from a
+scrape is NaN in that slot.
+
+Exports get a BufferView, the scrapes held when their snapshot was taken,
+so scrapes appended while they publish are not mixed in.
+"""
+
+import math
+import threading
+from array import array
+
+NAN = float('nan')
+
+
+class ScrapeBuffer():
+    def __init__(self, capacity):
+        self.capacity = max(2, int(capacity))
+        self.times = array('d', [NAN]) * self.capacity
+        self.columns = {}           # Register: array of values by slot
+        self.head = 0               # Next slot to write
+        self.size = 0
+        self.appended = 0           # Scrapes ever appended, scrape number n is in slot n % capacity
+        self.lock = threading.Lock()
+
+    def getMemory(self):
+        # Bytes held by the arrays
+        return (len(self.columns) + 1) * self.capacity * self.times.itemsize
+
+    def append(self, timestamp, scrape):
+        with self.lock:
+            slot = self.head
+            self.times[slot] = timestamp
+            for register, column in self.columns.items():
+                column[slot] = NAN
+            for register, value in scrape.items():
+                # Only numbers are kept, bool is an int but not a reading
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    column = self.columns.get(register)
+                    if column is None:
+                        column = self.columns[register] = array('d', [NAN]) * self.capacity
+                    column[slot] = value
+            self.head = (slot + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.appended += 1
+
+    def getView(self):
+        with self.lock:
+            return BufferView(self, self.appended, list(self.columns))
+
+    def slots(self, start, end, appended=None):
+        # Slots with a scrape time after start up to end, oldest first. With appended,
+        # only the scrapes that had been appended then, that are still held
+        appended = self.appended if appended is None else appended
+        found = []
+        for number in range(appended - 1, self.appended - self.size - 1, -1):
+            slot = number % self.capacity
+            timestamp = self.times[slot]
+            if timestamp <= start:
+                break
+            if timestamp <= end:
+                found.append(slot)
+        found.reverse()
+        return found
+
+    def getRegisters(self):
+        return list(self.columns)
+
+    def getSpan(self):
+        # Secs from the oldest to the newest scrape held
+        if self.size < 2:
+            return 0
+        return self.times[(self.head - 1) % self.capacity] - self.times[(self.head - self.size) % self.capacity]
+
+    def window(self, register, start, end=math.inf, appended=None):
+        """
+        min, max, mean and last of a register over scrapes after start up to
+        end (unix secs), and rate, the change per sec from the first to the last
+        value. None when the register has no value in the window. appended
+        leaves out scrapes after that many, see BufferView.
+        """
+        with self.lock:
+            column = self.columns.get(register)
+            if column is None:
+                return None
+            samples = [(self.times[slot], column[slot]) for slot in self.slots(start, end, appended) if column[slot] == column[slot]]
+        if not samples:
+            return None
+        values = [value for timestamp, value in samples]
+        first, last = samples[0], samples[-1]
+        return {
+            'min': min(values),
+            'max': max(values),
+            'mean': math.fsum(values) / len(values),
+            'last': last[1],
+            'rate': (last[1] - first[1]) / (last[0] - first[0]) if last[0] > first[0] else 0.0,
+            'count': len(values),
+            'from': first[0],
+            'to': last[0]
+        }
+
+
+class BufferView():
+    """
+    A ScrapeBuffer as it was when the view was taken. Reads go to the shared
+    arrays under their lock, scrapes appended since are left out. Nothing is
+    copied, so a scrape overwritten since (the oldest, once the buffer is
+    full) is missing.
+    """
+
+    def __init__(self, buffer, appended, registers):
+        self.buffer = buffer
+        self.appended = appended
+        self.registers = registers
+        self.capacity = buffer.capacity
+
+    def getMemory(self):
+        return self.buffer.getMemory()
+
+    def getRegisters(self):
+        return list(self.registers)
+
+    def getSpan(self):
+        with self.buffer.lock:
+            slots = self.buffer.slots(-math.inf, math.inf, self.appended)
+            if len(slots) < 2:
+                return 0
+            return self.buffer.times[slots[-1]] - self.buffer.times[slots[0]]
+
+    def window(self, register, start, end=math.inf):
+        if register not in self.registers:
+            return None
+        return self.buffer.window(register, start, end, self.appended)
@@ -0,0 +1,92 @@
+"""
+Plan the Modbus range reads needed to cover a set of registers.
+"""
+
+import logging
+from collections.abc import Mapping
+from decoder import register_width
+
+logger = logging.getLogger(__name__)
+
+# Modbus protocol limit for a single read input/holding registers request
+MODBUS_MAX_BLOCK = 125
+
+# How often a register is read: once at startup, every scan_interval_slow,
+# every scan_interval or every scan_interval_fast
+POLL_TIERS = ('static', 'slow', 'normal', 'fast')
+
+
+def max_block_size(scan_config, connection, register_type=None):
+    """
+    Largest read in words allowed for a register type and connection type,
+    never more than the protocol limit. max_block is a number, or keyed by
+    register type and/or connection type.
+    """
+    max_block = scan_config.get('max_block', {})
+    if isinstance(max_block, Mapping) and register_type in max_block:
+        max_block = max_block[register_type]
+    if isinstance(max_block, Mapping):
+        max_block = max_block.get(connection, MODBUS_MAX_BLOCK)
+    return min(int(max_block), MODBUS_MAX_BLOCK)
+
+
+def forbidden_addresses(scan_config, register_type):
+    forbidden = set()
+    for gap in scan_config.get('forbidden', {}).get(register_type, []) or []:
+        forbidden.update(range(gap['start'], gap.get('end', gap['start']) + 1))
+    return forbidden
+
+
+def register_tier(register, scan_config):
+    """ Poll tier of a register, from the register itself or the default for its type """
+    tier = register.get('poll') or (scan_config.get('poll') or {}).get(register.get('type')) or 'normal'
+    if tier not in POLL_TIERS:
+        logger.warning(f"Scan plan: {register['name']} has unknown poll tier {tier}, using normal")
+        tier = 'normal'
+    return tier
+
+
+def plan_scan_ranges(registers, scan_config, connection, unreadable=None):
+    """
+    Returns the fewest range reads that cover every register, as a list of
+    {'type', 'start', 'range'} dicts. start is 1 less than the first address.
+
+    Registers are grouped greedily in address order. A read never exceeds the
+    block size for the connection, never covers a forbidden or unreadable
+    address and always holds every word of a multi word register (U32/S32/UTF-8).
+    unreadable is {register type: set of addresses} learned from the inverter.
+    """
+    register_ranges = []
+
+    for register_type in ('read', 'hold'):
+        max_block = max_block_size(scan_config, connection, register_type)
+        forbidden = forbidden_addresses(scan_config, register_type)
+        if unreadable:
+            forbidden.update(unreadable.get(register_type, ()))
+        spans = set()
+        for register in registers:
+            if register.get('type') != register_type:
+                continue
+            first = register['address']
+            last = first + register_width(register) - 1
+            if last - first + 1 > max_block:
+                logger.warning(f"Scan plan: {register['name']} is wider than the {max_block} word block size, skipping")
+            elif forbidden.intersection(range(first, last + 1)):
+                logger.debug(f"Scan plan: {register['name']} at {register_type} {first} is in a forbidden range, skipping")
+            else:
+                spans.add((first, last))
+
+        block_first = block_last = None
+        for first, last in sorted(spans):
+            if block_first is not None:
+                new_last = max(block_last, last)
+                if new_last - block_first + 1 <= max_block and not forbidden.intersection(range(block_last + 1, new_last + 1)):
+                    block_last = new_last
+                    continue
+                register_ranges.append({'type': register_type, 'start': block_first - 1, 'range': block_last - block_first + 1})
+            block_first, block_last = first, last
+        if block_first is not None:
+            register_ranges.append({'type': register_type, 'start': block_first - 1, 'range': block_last - block_first + 1})
+
+    return register_ranges
+
@@ -0,0 +1,140 @@
+"""
+Timings and counters for the hot paths: Modbus reads, decoding, scrapes,
+exports, connections and the polling schedule.
+
+Everything is recorded in the shared registry `stats`, which the webserver
+serves at /debug/stats and adds to /metrics.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, spanning a fast register decode up to a slow export
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+METRICS = {
+    'modbus_read_seconds':      ('histogram', "Round trip of one Modbus range read"),
+    'modbus_read_errors':       ('counter', "Modbus range reads that returned no data"),
+    'decode_seconds':           ('histogram', "Time to decode one register range"),
+    'scrape_seconds':           ('histogram', "Time to scrape an inverter, reads, decoding and derived registers"),
+    'export_publish_seconds':   ('histogram', "Time an export took to publish one scrape"),
+    'export_errors':            ('counter', "Scrapes an export failed to publish"),
+    'connects':                 ('counter', "Successful connection handshakes, the first one included"),
+    'connect_failures':         ('counter', "Failed connection attempts"),
+    'scheduler_lag_seconds':    ('histogram', "How late a scrape started after it was due"),
+    'scheduler_overruns':       ('counter', "Polling cycles that took longer than the scan interval"),
+}
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def getStats(self):
+        with self.lock:
+            cumulative, buckets = 0, {}
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                buckets[bound] = cumulative
+            return {
+                "count": self.count,
+                "sum": round(self.sum, 6),
+                "avg": round(self.sum / self.count, 6) if self.count else None,
+                "max": round(self.max, 6),
+                "buckets": buckets,
+            }
+
+
+class Counter():
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def getStats(self):
+        return self.value
+
+
+class StatsRegistry():
+    """ Metrics by name then label set, label sets are tuples of (label, value) """
+
+    def __init__(self):
+        self.metrics = {name: {} for name in METRICS}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def get(self, name, labels):
+        key = tuple(sorted(labels.items()))
+        metric = self.metrics[name].get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics[name].setdefault(key, Histogram() if METRICS[name][0] == 'histogram' else Counter())
+        return metric
+
+    def describe(self, name):
+        # (type, help) of a metric
+        return METRICS[name]
+
+    def observe(self, name, value, **labels):
+        self.get(name, labels).observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        self.get(name, labels).increment(amount)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def getStats(self):
+        stats = {"uptime": round(time.time() - self.started)}
+        for name, series in self.metrics.items():
+            stats[name] = [dict(key) | {"value": metric.getStats()} for key, metric in list(series.items())]
+        return stats
+
+    def getSummary(self):
+        # One line for the periodic log, averages in ms
+        def histogram(name, **labels):
+            totals = [metric.getStats() for key, metric in list(self.metrics[name].items())
+                      if all(dict(key).get(label) == value for label, value in labels.items())]
+            count = sum(total['count'] for total in totals)
+            if not count:
+                return "-"
+            return f"{round(sum(total['sum'] for total in totals) / count * 1000, 1)}ms avg {round(max(total['max'] for total in totals) * 1000, 1)}ms max ({count})"
+
+        def counter(name, **labels):
+            return sum(metric.value for key, metric in list(self.metrics[name].items())
+                       if all(dict(key).get(label) == value for label, value in labels.items()))
+
+        summary = [f"scrape {histogram('scrape_seconds')}",
+                   f"modbus read {histogram('modbus_read_seconds')}, {counter('modbus_read_errors')} errors",
+                   f"decode {histogram('decode_seconds')}"]
+        for export in sorted({dict(key)['export'] for key in list(self.metrics['export_publish_seconds'])}):
+            summary.append(f"export {export} {histogram('export_publish_seconds', export=export)}, {counter('export_errors', export=export)} errors")
+        summary.append(f"connects {counter('connects')}, connect failures {counter('connect_failures')}, overruns {counter('scheduler_overruns')}")
+        return "; ".join(summary)
+
+
+stats = StatsRegistry()
@@ -1,23 +1,33 @@
 #!/usr/bin/python3
 
-from SungrowClient import SungrowClient
+from dispatcher import ExportDispatcher
+from inverter import SungrowInverter
+from registercache import RegisterCache
+from stats import stats
 from version import __version__
 
+from concurrent.futures import ThreadPoolExecutor
+
 import importlib
 import logging
 import logging.handlers
+import signal
 import sys
 import getopt
 import yaml
 import time
 
+SHUTDOWN_TIMEOUT = 8    # docker stop sends SIGKILL after 10 secs
+
 def main():
+    startup_start = time.perf_counter()
     configfilename = 'config.yaml'
     registersfilename = 'registers-sungrow.yaml'
     logfolder = ''
+    cachefolder = ''
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"hc:r:l:v:", "runonce")
+        opts, args = getopt.getopt(sys.argv[1:],"hc:r:l:d:v:", "runonce")
     except getopt.GetoptError:
         logging.debug(f'No options passed via command line')
 
@@ -31,6 +41,7 @@ def main():
             print(f'-c config.yaml             : Specify config file.')
             print(f'-r registers-file.yaml     : Specify registers file.')
             print(f'-l /logs/                  : Specify folder to store logs.')
+            print(f'-d /data/                  : Specify folder to store cached data.')
             print(f'-v 30                      : Logging Level, 10 = Debug, 20 = Info, 30 = Warning (default), 40 = Error')
             print(f'--runonce                  : Run once then exit')
             print(f'-h                         : print this help message and exit (also --help)')
@@ -43,6 +54,8 @@ def main():
             registersfilename = arg
         elif opt == '-l':
             logfolder = arg    
+        elif opt == '-d':
+            cachefolder = arg
         elif opt  == '-v':
             if arg.isnumeric():
                 if int(arg) >= 0 and int(arg) <= 50:
@@ -66,33 +79,30 @@ def main():
     except Exception as err:
         logging.error(f"Failed: Loading config: {configfilename} \n\t\t\t     {err}")
         sys.exit(1)
-    if not configfile.get('inverter'):
+    # inverters: is a list of inverters, inverter: is kept for single inverter configs
+    if configfile.get('inverters'):
+        inverter_configs = configfile.get('inverters')
+    elif configfile.get('inverter'):
+        inverter_configs = [configfile.get('inverter')]
+    else:
         logging.error(f"Failed Loading config, missing Inverter settings")
         sys.exit(f"Failed Loading config, missing Inverter settings")   
 
     try:
-        registersfile = yaml.safe_load(open(registersfilename, encoding="utf-8"))
-        logging.info(f"Loaded registers: {registersfilename}")
-        logging.info(f"Registers file version: {registersfile.get('version','UNKNOWN')}")
+        # Compiled selections are cached next to the other cached data, the YAML is only parsed when it changed
+        registers_start = time.perf_counter()
+        registersfile = RegisterCache(registersfilename, cachefolder)
+        logging.info(f"Loaded registers: {registersfilename} in {time.perf_counter() - registers_start:.3f} secs")
+        logging.info(f"Registers file version: {registersfile.getVersion()}")
     except Exception as err:
         logging.error(f"Failed: Loading registers: {registersfilename}  {err}")
         sys.exit(f"Failed: Loading registers: {registersfilename} {err}")
    
-    config_inverter = {
-        "host": configfile['inverter'].get('host',None),
-        "port": configfile['inverter'].get('port',502),
-        "timeout": configfile['inverter'].get('timeout',10),
-        "retries": configfile['inverter'].get('retries',3),
-        "slave": configfile['inverter'].get('slave',0x01),
-        "scan_interval": configfile['inverter'].get('scan_interval',30),
-        "connection": configfile['inverter'].get('connection',"modbus"),
-        "model": configfile['inverter'].get('model',None),
-        "smart_meter": configfile['inverter'].get('smart_meter',False),
-        "use_local_time": configfile['inverter'].get('use_local_time',False),
-        "log_console": configfile['inverter'].get('log_console','WARNING'),
-        "log_file": configfile['inverter'].get('log_file','OFF'),
-        "level": configfile['inverter'].get('level',1)
-    }
+    config_inverters = []
+    for inverter_config in inverter_configs:
+        config_inverters.append(load_inverter_config(inverter_config, cachefolder))
+    # Logging options are taken from the first inverter
+    config_inverter = config_inverters[0]
 
     if 'loglevel' in locals():
         logger.handlers[0].setLevel(loglevel)
@@ -113,68 +123,192 @@ def main():
     if logger.handlers.__len__() == 3:
         logging.info(f"Logging to file set to: {logging.getLevelName(logger.handlers[2].level)}")
     
-    logging.debug(f'Inverter Config Loaded: {config_inverter}')    
-
-    if config_inverter.get('host'):
-        inverter = SungrowClient.SungrowClient(config_inverter)
-    else:
-        logging.error(f"Error: host option in config is required")
-        sys.exit("Error: host option in config is required")
+    inverters = []
+    for config_inverter in config_inverters:
+        logging.debug(f'Inverter Config Loaded: {config_inverter}')    
+        if config_inverter.get('host') or config_inverter['connection'] == "replay":
+            inverters.append(SungrowInverter(config_inverter))
+        else:
+            logging.error(f"Error: host option in config is required")
+            sys.exit("Error: host option in config is required")
 
-    if not inverter.checkConnection():
-        logging.error(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")
-        sys.exit(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")       
+    # Poll every inverter on its own worker, so a cycle takes as long as the slowest inverter
+    pool = ThreadPoolExecutor(max_workers=len(inverters), thread_name_prefix='inverter')
+    # Inverters that do not answer yet are configured once they connect, retried with the connection backoff
+    pending = []
+    for inverter, connected in zip(inverters, pool.map(lambda inverter: inverter.checkConnection(), inverters)):
+        if not connected:
+            logging.error(f"Error: Connection to inverter failed: {inverter.client_config.get('host')}:{inverter.client_config.get('port')}, retrying in {round(inverter.connection.getRetryIn())} secs")
+            pending.append(inverter)
+    if len(pending) == len(inverters):
+        logging.error(f"Error: Connection to every inverter failed")
+        sys.exit(f"Error: Connection to every inverter failed")
+    ready = [inverter for inverter in inverters if inverter not in pending]
 
-    inverter.configure_registers(registersfile)
-    if not inverter.inverter_config['connection'] == "http": inverter.close()
+    configure_start = time.perf_counter()
+    list(pool.map(lambda inverter: inverter.configure_registers(registersfile), ready))
+    logging.info(f"Startup: Configured registers of {len(ready)} inverter(s) in {time.perf_counter() - configure_start:.3f} secs")
+    for inverter in ready:
+        if not inverter.inverter_config['connection'] == "http" and inverter.connection.shouldClose(0): inverter.close()
     
-    # Now we know the inverter is working, lets load the exports
-    exports = []
+    # Now we know at least one inverter is working, lets load the exports
+    # Exports are shared by every inverter, unless set to a single inverter with inverter: name
+    # Each export publishes from its own queue and thread, so a slow export does not delay polling
+    exports = ExportDispatcher()
     if configfile.get('exports'):
         for export in configfile.get('exports'):
             try:
                 if export.get('enabled', False):
                     export_load = importlib.import_module("exports." + export.get('name'))
                     logging.info(f"Loading Export: exports\{export.get('name')}")
-                    exports.append(getattr(export_load, "export_" + export.get('name'))())
-                    retval = exports[-1].configure(export, inverter)
+                    export_inverters = [inverter for inverter in inverters if not export.get('inverter') or inverter.getName() == export.get('inverter')]
+                    if not export_inverters:
+                        logging.error(f"Failed loading export: {export.get('name')}, no inverter named {export.get('inverter')}")
+                        continue
+                    export_object = getattr(export_load, "export_" + export.get('name'))()
+                    # Connected inverters first, the pending ones are configured into the export when they connect
+                    export_inverters.sort(key=lambda inverter: inverter in pending)
+                    configured = [inverter for inverter in export_inverters if inverter not in pending]
+                    if not hasattr(export_object, 'configure_inverter') and len(export_inverters) > 1:
+                        logging.warning(f"Export {export.get('name')} only supports one inverter, publishing {export_inverters[0].getName()}")
+                        export_inverters = export_inverters[:1]
+                        configured = configured[:1]
+                    if configured:
+                        retval = export_object.configure(export, configured[0])
+                        for inverter in configured[1:]:
+                            export_object.configure_inverter(inverter)
+                    exports.add(export.get('name'), export_object, export_inverters,
+                                export.get('queue_size', 10), export.get('queue_policy', 'drop_oldest'), export, configured)
             except Exception as err:
                 logging.error(f"Failed loading export: {err}" +
                             f"\n\t\t\t     Please make sure {export.get('name')}.py exists in the exports folder")
 
-    scan_interval = config_inverter.get('scan_interval')
+    logging.info(f"Startup: Ready in {time.perf_counter() - startup_start:.3f} secs")
 
     # Core polling loop
-    while True:
-        loop_start = time.perf_counter()
-
-        inverter.checkConnection()
+    next_scan = {inverter: 0 for inverter in inverters}
+    stats_logged = time.perf_counter()
+    # docker stop sends SIGTERM, handled like Ctrl+C so exports write the batches they hold before exiting
+    signal.signal(signal.SIGTERM, stop_signal)
+    try:
+        while True:
+            loop_start = time.perf_counter()
 
-        # Scrape the inverter
-        success = inverter.scrape()
+            # Scrape every inverter that is due
+            polls = {}
+            for inverter in inverters:
+                if next_scan[inverter] <= loop_start:
+                    if next_scan[inverter]:
+                        stats.observe('scheduler_lag_seconds', loop_start - next_scan[inverter], inverter=inverter.getName())
+                    next_scan[inverter] = loop_start + inverter.getScanDelay()
+                    if inverter in pending:
+                        polls[inverter] = pool.submit(first_poll, inverter, registersfile)
+                    else:
+                        polls[inverter] = pool.submit(poll, inverter)
 
-        if(success):
-            for export in exports:
-                export.publish(inverter)
-            if not inverter.inverter_config['connection'] == "http": inverter.close()
-        else:
-            inverter.disconnect()
-            logging.warning(f"Data collection failed, skipped exporting data. Retying in {scan_interval} secs")
+            for inverter, poll_result in polls.items():
+                if poll_result.result():
+                    if inverter in pending:
+                        exports.configure_inverter(inverter)
+                        pending.remove(inverter)
+                        logging.info(f"Connected to {inverter.getName()}, now publishing it")
+                    exports.publish(inverter)
+                else:
+                    logging.warning(f"Data collection failed for {inverter.getName()}, skipped exporting data. Retying in {inverter.scan_interval} secs")
 
-        loop_end = time.perf_counter()
-        process_time = round(loop_end - loop_start, 2)
-        logging.debug(f'Processing Time: {process_time} secs')
+            loop_end = time.perf_counter()
+            process_time = round(loop_end - loop_start, 2)
+            logging.debug(f'Processing Time: {process_time} secs')
+            logging.debug(f'Export Stats: {exports.getStats()}')
+            # Like the logging options, taken from the first inverter
+            if config_inverters[0]['stats_interval'] and loop_end - stats_logged >= config_inverters[0]['stats_interval']:
+                logging.info(f"Stats: {stats.getSummary()}")
+                stats_logged = loop_end
 
-        if 'runonce' in locals():
-            sys.exit(0)
+            if 'runonce' in locals():
+                break
         
-        # Sleep until the next scan
-        if scan_interval - process_time <= 1:
-            logging.warning(f"SunGather is taking {process_time} to process, which is longer than interval {scan_interval}, Please increase scan interval")
-            time.sleep(process_time)
-        else:
-            logging.info(f'Next scrape in {int(scan_interval - process_time)} secs')
-            time.sleep(scan_interval - process_time)    
+            # Sleep until the next inverter is due
+            scan_interval = min([inverter.getScanDelay() for inverter in polls], default=0)
+            next_scrape = min(next_scan.values()) - time.perf_counter()
+            if polls and scan_interval and scan_interval - process_time <= 1:
+                stats.increment('scheduler_overruns')
+                logging.warning(f"SunGather is taking {process_time} to process, which is longer than interval {scan_interval}, Please increase scan interval")
+                time.sleep(process_time)
+            elif next_scrape > 0:
+                logging.info(f'Next scrape in {int(next_scrape)} secs')
+                time.sleep(next_scrape)
+    except KeyboardInterrupt:
+        logging.info(f"Stopping, flushing exports")
+    finally:
+        # Batching exports (influxdb, history) send what they hold, within the time docker stop allows
+        exports.flush(60 if 'runonce' in locals() else SHUTDOWN_TIMEOUT)
+        exports.stop(1)
+
+def load_inverter_config(inverter_config, cachefolder):
+    return {
+        "name": inverter_config.get('name',None),
+        "host": inverter_config.get('host',None),
+        "port": inverter_config.get('port',502),
+        "timeout": inverter_config.get('timeout',10),
+        "retries": inverter_config.get('retries',3),
+        "slave": inverter_config.get('slave',0x01),
+        "scan_interval": inverter_config.get('scan_interval',30),
+        "scan_interval_fast": inverter_config.get('scan_interval_fast',None),
+        "scan_interval_slow": inverter_config.get('scan_interval_slow',300),
+        "connection": inverter_config.get('connection',"modbus"),
+        "model": inverter_config.get('model',None),
+        "serial_number": inverter_config.get('serial',None),
+        "smart_meter": inverter_config.get('smart_meter',False),
+        "use_local_time": inverter_config.get('use_local_time',False),
+        "log_console": inverter_config.get('log_console','WARNING'),
+        "log_file": inverter_config.get('log_file','OFF'),
+        "level": inverter_config.get('level',1),
+        "pipeline_depth": inverter_config.get('pipeline_depth',0),
+        "keep_alive": inverter_config.get('keep_alive',True),
+        "idle_close": inverter_config.get('idle_close',0),
+        "backoff_max": inverter_config.get('backoff_max',300),
+        "stats_interval": inverter_config.get('stats_interval',0),
+        "buffer_hours": inverter_config.get('buffer_hours',1),
+        "identity_cache": inverter_config.get('identity_cache',True),
+        "idle_scan_interval": inverter_config.get('idle_scan_interval',0),
+        "idle_after": inverter_config.get('idle_after',3),
+        "idle_pv_register": inverter_config.get('idle_pv_register','total_dc_power'),
+        "idle_pv_power": inverter_config.get('idle_pv_power',0),
+        "idle_registers": inverter_config.get('idle_registers',[]),
+        "latitude": inverter_config.get('latitude',None),
+        "longitude": inverter_config.get('longitude',None),
+        "record_file": inverter_config.get('record_file',None),
+        "replay_file": inverter_config.get('replay_file',None),
+        "replay_speed": inverter_config.get('replay_speed',1),
+        "replay_loop": inverter_config.get('replay_loop',True),
+        "cache_folder": cachefolder
+    }
+
+def poll(inverter):
+    if not inverter.checkConnection():
+        return False
+
+    # Scrape the inverter
+    success = inverter.scrape()
+
+    if(success):
+        # Sessions stay open between scrapes unless keep_alive or idle_close say otherwise
+        if not inverter.inverter_config['connection'] == "http" and inverter.connection.shouldClose(inverter.getScanDelay()): inverter.close()
+    else:
+        inverter.disconnect()
+    return success
+
+def stop_signal(signum, frame):
+    raise KeyboardInterrupt
+
+def first_poll(inverter, registersfile):
+    # An inverter that was not connected at startup, registers are configured on its first connection
+    if not inverter.checkConnection():
+        return False
+    if inverter.view is None:
+        inverter.configure_registers(registersfile)
+    return poll(inverter)
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
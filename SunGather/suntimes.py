@@ -0,0 +1,57 @@
+"""
+Sunrise and sunset from latitude and longitude, no network needed.
+
+Uses the sunrise equation with the usual -0.833 degree correction for
+refraction and the sun's disc, good to a minute or two away from the poles,
+which is plenty to tell night from day for polling.
+"""
+
+import math
+
+J2000 = 2451545.0           # Julian day of 2000-01-01 12:00 UTC
+UNIX_EPOCH = 2440587.5      # Julian day of 1970-01-01 00:00 UTC
+
+
+def sun_times(latitude, longitude, day):
+    """
+    (sunrise, sunset) as unix secs for day, the number of days since
+    2000-01-01 (UTC). (None, None) in polar night, (-inf, inf) in polar day.
+    """
+    solar_noon = day - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * solar_noon) % 360)
+    centre = 1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + centre + 180 + 102.9372) % 360)
+    transit = J2000 + solar_noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    hour_angle = (math.sin(math.radians(-0.833)) - math.sin(math.radians(latitude)) * math.sin(declination)) / \
+                 (math.cos(math.radians(latitude)) * math.cos(declination))
+    if hour_angle > 1:
+        return None, None
+    if hour_angle < -1:
+        return -math.inf, math.inf
+    half_day = math.degrees(math.acos(hour_angle)) / 360
+    return (transit - half_day - UNIX_EPOCH) * 86400, (transit + half_day - UNIX_EPOCH) * 86400
+
+
+def days_around(timestamp):
+    # The day holding timestamp and the days either side, so any timezone is covered
+    day = round(timestamp / 86400 + UNIX_EPOCH - J2000)
+    return (day - 1, day, day + 1, day + 2)
+
+
+def is_daylight(latitude, longitude, timestamp, margin=0):
+    """ True from margin secs before sunrise until margin secs after sunset """
+    for day in days_around(timestamp):
+        sunrise, sunset = sun_times(latitude, longitude, day)
+        if sunrise is not None and sunrise - margin <= timestamp <= sunset + margin:
+            return True
+    return False
+
+
+def next_sunrise(latitude, longitude, timestamp):
+    """ Unix secs of the next sunrise after timestamp, None if there is none in the next two days """
+    for day in days_around(timestamp):
+        sunrise, sunset = sun_times(latitude, longitude, day)
+        if sunrise is not None and timestamp < sunrise < math.inf:
+            return sunrise
+    return None
@@ -0,0 +1,180 @@
+"""
+Parity of decoder.BlockDecoder with the per-word decoding load_registers used
+before it, on both the array and the NumPy paths.
+
+Run from the repository root with: python -m pytest tests
+"""
+
+import os
+import random
+import sys
+
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'SunGather'))
+
+import decoder  # noqa: E402
+from decoder import BlockDecoder, build_decode_table, register_width  # noqa: E402
+
+REGISTERS_FILE = os.path.join(os.path.dirname(__file__), '..', 'SunGather', 'registers-sungrow.yaml')
+
+# Every word the decoders treat specially, plus either side of them
+SENTINELS = [0x0000, 0x0001, 0x7FFE, 0x7FFF, 0x8000, 0xFFFE, 0xFFFF]
+
+PATHS = [pytest.param(False, id='array'),
+         pytest.param(True, id='numpy', marks=pytest.mark.skipif(decoder.numpy is None, reason='NumPy not installed'))]
+
+
+def legacy_decode(registers, register_type, start, words):
+    """ The loop load_registers ran over every word before BlockDecoder, UTF-8 as a string """
+    latest_scrape = {}
+    count = len(words)
+    for num in range(0, count):
+        run = int(start) + num + 1
+
+        for register in registers:
+            if register_type == register['type'] and register['address'] == run:
+                register_name = register['name']
+
+                register_value = words[num]
+
+                if register.get('datatype') == "U16":
+                    if register_value == 0xFFFF:
+                        register_value = 0
+                    if register.get('mask'):
+                        register_value = 1 if register_value & register.get('mask') != 0 else 0
+                elif register.get('datatype') == "S16":
+                    if register_value == 0xFFFF or register_value == 0x7FFF:
+                        register_value = 0
+                    if register_value >= 32767:
+                        register_value = (register_value - 65536)
+                elif register.get('datatype') == "U32":
+                    # Overruns the block, the per-word loop raised IndexError, BlockDecoder leaves it out
+                    if num + 1 >= count:
+                        continue
+                    u32_value = words[num + 1]
+                    if register_value == 0xFFFF and u32_value == 0xFFFF:
+                        register_value = 0
+                    else:
+                        register_value = (register_value + u32_value * 0x10000)
+                elif register.get('datatype') == "S32":
+                    if num + 1 >= count:
+                        continue
+                    u32_value = words[num + 1]
+                    if register_value == 0xFFFF and (u32_value == 0xFFFF or u32_value == 0x7FFF):
+                        register_value = 0
+                    elif u32_value >= 32767:
+                        register_value = (register_value + u32_value * 0x10000 - 0xffffffff - 1)
+                    else:
+                        register_value = register_value + u32_value * 0x10000
+                elif register.get('datatype') == "UTF-8":
+                    # Decoded to a string since BlockDecoder, the per-word loop returned the first word
+                    length = register_width(register)
+                    if num + length > count:
+                        continue
+                    register_value = b''.join(word.to_bytes(2, 'big') for word in words[num:num + length]) \
+                        .decode('utf-8', errors='ignore').strip('\x00').strip()
+
+                if register.get('datarange'):
+                    for value in register.get('datarange'):
+                        if value['response'] == words[num]:
+                            register_value = value['value']
+
+                if register.get('accuracy'):
+                    register_value = round(register_value * register.get('accuracy'), 2)
+
+                latest_scrape[register_name] = register_value
+    return latest_scrape
+
+
+def block_decode(registers, register_type, start, words, use_numpy):
+    block_decoder = BlockDecoder(build_decode_table(registers).get(register_type, {}), start, len(words), use_numpy=use_numpy)
+    assert block_decoder.use_numpy == (use_numpy and bool(block_decoder.fields))
+    return dict(block_decoder.decode(words))
+
+
+def random_words(rnd, count):
+    return [rnd.choice(SENTINELS) if rnd.random() < 0.5 else rnd.randrange(0x10000) for _ in range(count)]
+
+
+def synthetic_registers():
+    # One of each datatype and adjustment, packed from address 5001
+    return [
+        {'name': 'u16', 'address': 5001, 'datatype': 'U16', 'type': 'read'},
+        {'name': 'u16_mask', 'address': 5002, 'datatype': 'U16', 'mask': 0x4, 'type': 'read'},
+        {'name': 'u16_datarange', 'address': 5003, 'datatype': 'U16', 'type': 'read',
+         'datarange': [{'response': 0x0, 'value': 'Run'}, {'response': 0x8000, 'value': 'Stop'}, {'response': 0xFFFF, 'value': 'Unknown'}]},
+        {'name': 's16', 'address': 5004, 'datatype': 'S16', 'type': 'read'},
+        {'name': 's16_accuracy', 'address': 5005, 'datatype': 'S16', 'accuracy': 0.1, 'type': 'read'},
+        {'name': 'u32', 'address': 5006, 'datatype': 'U32', 'type': 'read'},
+        {'name': 'u32_accuracy', 'address': 5008, 'datatype': 'U32', 'accuracy': 0.01, 'type': 'read'},
+        {'name': 's32', 'address': 5010, 'datatype': 'S32', 'type': 'read'},
+        {'name': 's32_accuracy', 'address': 5012, 'datatype': 'S32', 'accuracy': 0.1, 'type': 'read'},
+        {'name': 'u16_odd', 'address': 5014, 'datatype': 'U16', 'accuracy': 0.1, 'type': 'read'},
+        {'name': 'u32_odd', 'address': 5015, 'datatype': 'U32', 'type': 'read'},
+        {'name': 's32_odd', 'address': 5017, 'datatype': 'S32', 'type': 'read'},
+        {'name': 'serial', 'address': 5019, 'datatype': 'UTF-8', 'length': 4, 'type': 'read'},
+        {'name': 'hold_u16', 'address': 5001, 'datatype': 'U16', 'type': 'hold'},
+    ]
+
+
+@pytest.mark.parametrize('use_numpy', PATHS)
+def test_every_sentinel_pair(use_numpy):
+    # Each 32bit register sees every combination of sentinel low and high words
+    registers = synthetic_registers()
+    for low in SENTINELS:
+        for high in SENTINELS:
+            words = [low, high] * 11
+            assert block_decode(registers, 'read', 5000, words, use_numpy) == legacy_decode(registers, 'read', 5000, words)
+
+
+@pytest.mark.parametrize('use_numpy', PATHS)
+def test_random_blocks(use_numpy):
+    registers = synthetic_registers()
+    rnd = random.Random(2)
+    for _ in range(500):
+        words = random_words(rnd, 22)
+        assert block_decode(registers, 'read', 5000, words, use_numpy) == legacy_decode(registers, 'read', 5000, words)
+        assert block_decode(registers, 'hold', 5000, words, use_numpy) == legacy_decode(registers, 'hold', 5000, words)
+
+
+@pytest.mark.parametrize('use_numpy', PATHS)
+def test_block_relative_offsets(use_numpy):
+    # start is the address - 1 of the first word, blocks can start and end anywhere among the registers
+    registers = synthetic_registers()
+    rnd = random.Random(3)
+    for start in range(4995, 5020):
+        for count in (1, 2, 3, 7, 16):
+            words = random_words(rnd, count)
+            assert block_decode(registers, 'read', start, words, use_numpy) == legacy_decode(registers, 'read', start, words)
+
+
+def test_utf8():
+    registers = synthetic_registers()
+    words = [0] * 18 + [0x4131, 0x3233, 0x3400, 0x0000]
+    for use_numpy in (False, decoder.numpy is not None):
+        assert block_decode(registers, 'read', 5000, words, use_numpy)['serial'] == 'A1234'
+
+
+@pytest.mark.parametrize('use_numpy', PATHS)
+def test_registers_file(use_numpy):
+    # Every register SunGather ships, read in blocks the way the scan ranges cover them
+    with open(REGISTERS_FILE, encoding='utf-8') as registers_file:
+        registersfile = yaml.safe_load(registers_file)
+    registers = []
+    for register_type, section in (('read', 0), ('hold', 1)):
+        for register in registersfile['registers'][section][register_type]:
+            # Strings from a datarange can not be scaled, none are shipped that way
+            if not (register.get('datarange') and register.get('accuracy')):
+                registers.append(dict(register, type=register_type))
+    rnd = random.Random(4)
+    for register_type in ('read', 'hold'):
+        addresses = sorted(register['address'] for register in registers if register['type'] == register_type)
+        for first in range(0, len(addresses), 20):
+            start = addresses[first] - 1
+            count = min(addresses[min(first + 19, len(addresses) - 1)] - start + 1, 125)
+            for _ in range(20):
+                words = random_words(rnd, count)
+                assert block_decode(registers, register_type, start, words, use_numpy) == \
+                    legacy_decode(registers, register_type, start, words)
@@ -0,0 +1,124 @@
+"""
+Content negotiation of the webserver export: gzip is only sent to clients
+that accept it, and each variant carries its own ETag next to
+Vary: Accept-Encoding.
+
+Run from the repository root with: python -m pytest tests
+"""
+
+import gzip
+import http.client
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'SunGather'))
+
+from exports.webserver import CachedResponse, MyServer, accepts_gzip, export_webserver  # noqa: E402
+
+BODY = '{"registers": {' + ', '.join(f'"register_{num}": {num}' for num in range(200)) + '}}'
+
+
+@pytest.mark.parametrize('accept_encoding, expected', [
+    ('', False),
+    ('gzip', True),
+    ('gzip, deflate, br', True),
+    ('GZIP', True),
+    ('x-gzip', True),
+    ('gzip;q=0.5', True),
+    ('gzip; q=1.0, identity', True),
+    ('gzip;q=0', False),
+    ('gzip;q=0.000', False),
+    ('deflate, gzip;q=0', False),
+    ('identity', False),
+    ('*', True),
+    ('*;q=0', False),
+    ('gzip;q=0, *', False),
+    ('*;q=0, gzip', True),
+    ('gzip;q=nope', False),
+])
+def test_accepts_gzip(accept_encoding, expected):
+    assert accepts_gzip(accept_encoding) == expected
+
+
+@pytest.fixture
+def server(monkeypatch):
+    response = CachedResponse(BODY, "application/json")
+    assert response.gzip
+    monkeypatch.setitem(export_webserver.responses, 'json', response)
+    web_server = ThreadingHTTPServer(('127.0.0.1', 0), MyServer)
+    web_server.daemon_threads = True
+    thread = threading.Thread(target=web_server.serve_forever, daemon=True)
+    thread.start()
+    yield web_server.server_address[1], response
+    web_server.shutdown()
+    web_server.server_close()
+
+
+def request(port, method='GET', **headers):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request(method, '/json', headers={name.replace('_', '-'): value for name, value in headers.items()})
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+def test_identity(server):
+    port, response = server
+    status, headers, body = request(port)
+    assert status == 200
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Content-Encoding'] is None
+    assert headers['ETag'] == response.etag
+    assert body == BODY.encode('utf-8')
+
+
+def test_gzip(server):
+    port, response = server
+    status, headers, body = request(port, Accept_Encoding='gzip, deflate')
+    assert status == 200
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['ETag'] == response.gzip_etag != response.etag
+    assert int(headers['Content-Length']) == len(body)
+    assert gzip.decompress(body) == BODY.encode('utf-8')
+
+
+def test_gzip_refused(server):
+    port, response = server
+    status, headers, body = request(port, Accept_Encoding='gzip;q=0, deflate')
+    assert status == 200
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Content-Encoding'] is None
+    assert headers['ETag'] == response.etag
+    assert body == BODY.encode('utf-8')
+
+
+def test_head(server):
+    port, response = server
+    status, headers, body = request(port, 'HEAD', Accept_Encoding='gzip')
+    assert status == 200
+    assert headers['ETag'] == response.gzip_etag
+    assert int(headers['Content-Length']) == len(response.gzip)
+    assert body == b''
+
+
+@pytest.mark.parametrize('accept_encoding', ['gzip', 'gzip;q=0'])
+def test_not_modified(server, accept_encoding):
+    # Either ETag revalidates, the 304 carries the ETag of the variant this client would get
+    port, response = server
+    expected = response.gzip_etag if accept_encoding == 'gzip' else response.etag
+    for etag in (response.etag, response.gzip_etag):
+        status, headers, body = request(port, Accept_Encoding=accept_encoding, If_None_Match=etag)
+        assert status == 304
+        assert headers['Vary'] == 'Accept-Encoding'
+        assert headers['ETag'] == expected
+        assert body == b''
+    status, headers, _ = request(port, Accept_Encoding=accept_encoding, If_None_Match='"stale"')
+    assert status == 200
+    assert headers['ETag'] == expected